@@ -1,3 +1,5 @@
+import sys
+
 from .antiseptic import main
 
-main()
+sys.exit(main())
@@ -1,28 +1,28 @@
 import argparse
+import contextlib
 import errno
+import functools
+import itertools
 import json
 import logging
 import os
 import sys
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque, namedtuple
 
-from .cleaner import RegexCleaner
+from .report import REPORT_FORMATS
 from .utils import (
-    check_latest,
+    COMPANION_EXTENSIONS,
+    MEDIA_EXTENSIONS,
+    close_cleaners,
     get_config,
-    get_new_rules,
     green,
-    list_dirs,
-    list_files,
+    group_companions,
+    in_shard,
+    parse_shard,
     prompt,
+    walk,
 )
 
-GUESSIT = True
-try:
-    from .cleaner import GuessitCleaner
-except ImportError:
-    GUESSIT = False
-
 __progname__ = 'antiseptic'
 __version__ = '0.1.2'
 __author__ = 'Naglis Jonaitis'
@@ -33,9 +33,47 @@ LOG = logging.getLogger(__name__)
 CONSOLE_MESSAGE_FORMAT = '%(message)s'
 LOG_FILE_MESSAGE_FORMAT = '[%(asctime)s] %(levelname)-8s %(name)s %(message)s'
 DEFAULT_VERBOSE_LEVEL = 1
+# Number of names cleaned per task, and tasks in flight per worker, when
+# cleaning in a process pool.
+JOBS_CHUNK_SIZE = 16
+JOBS_PENDING_PER_WORKER = 4
+# Number of names cleaned together by the cleaner cascade.
+CASCADE_CHUNK_SIZE = 256
+
+# Output formats of `clean`, the size of the chunks its input is read in,
+# and the number of names its output is written in.
+CLEAN_FORMATS = ('plain', 'tsv', 'jsonl')
+CLEAN_READ_SIZE = 64 * 1024
+CLEAN_WRITE_BATCH = 1024
+
+# The cleaners of a worker process, see `_init_worker`.
+_worker_cleaners = None
+
+# What operate_helper did with an entry. Status is one of "dry-run",
+# "declined", "done", "failed" or, with an executor, "pending" (see future).
+Outcome = namedtuple('Outcome', 'status new_name future')
+# A process pool for cleaning names (see `make_pool`), and its number of
+# worker processes.
+Pool = namedtuple('Pool', 'executor workers')
+
+
+def open_cache(args, config):
+    """Return the result cache if it is enabled, otherwise `None`."""
+    enabled = getattr(args, 'cache', None)
+    if enabled is None:
+        enabled = config.get('cache', False)
+    if not enabled:
+        return None
+    from .cache import ResultCache
+
+    LOG.debug('Using result cache: %s' % config['cache_filename'])
+    return ResultCache(config['cache_filename'],
+                       max_entries=config['cache_max_entries'])
+
 
+def setup_cleaners(args, config, cache=None, metrics=None):
+    from .cleaner import GuessitCleaner, RegexCleaner, guessit_available
 
-def setup_cleaners(args, config):
     cleaners = {}
 
     disabled = set(config.get('disabled_rules', []))
@@ -43,9 +81,14 @@ def setup_cleaners(args, config):
         LOG.info('Disabled rules: %s' % (', '.join(disabled)))
     rules_filename = config['rules_filename']
 
-    c = RegexCleaner(disabled=disabled)
+    # Fused rules would show up as one in the rule profile.
+    optimize = not (getattr(args, 'no_optimize_rules', False) or
+                    getattr(args, 'profile_rules', None))
+    c = RegexCleaner(disabled=disabled, optimize=optimize)
     try:
-        c.load_rules(rules_filename)
+        with (metrics.timer('antiseptic_rules_load_seconds')
+              if metrics is not None else contextlib.nullcontext()):
+            c.load_rules(rules_filename)
     except OSError as e:
         if e.errno == errno.ENOENT:
             raise SystemExit('The rules file: %s does not exist. '
@@ -56,74 +99,271 @@ def setup_cleaners(args, config):
     else:
         cleaners[1] = c
 
-    if GUESSIT:
+    timeout = getattr(args, 'rule_timeout', None)
+    if timeout is None:
+        timeout = config.get('rule_timeout')
+    if timeout and not getattr(args, 'profile_rules', None):
+        from .guard import GuardedCleaner
+
+        LOG.debug('Cleaning with a time budget of %gs per title' % timeout)
+        cleaners[1] = GuardedCleaner(c, timeout)
+
+    if config.get('guessit', True) and guessit_available():
         priority = 0 if args.prefer_guessit else 10
         cleaners[priority] = GuessitCleaner()
 
+    if metrics is not None and not getattr(args, 'profile_rules', None):
+        from .metrics import TimedCleaner
+
+        cleaners = {k: TimedCleaner(c, metrics) for k, c in cleaners.items()}
+
+    if cache is not None:
+        from .cache import CachedCleaner
+
+        cleaners = {k: CachedCleaner(c, cache) for k, c in cleaners.items()}
+
     return [cleaners[k] for k in sorted(cleaners.keys())]
 
 
+def entry_name(path, action='rename'):
+    """
+    Return the part of `path` the cleaners operate on. For the "name"
+    action, `path` is a name, and cleaned as it is.
+    """
+    if action == 'name':
+        return path
+    _, name = os.path.split(os.path.normpath(path))
+    if action != 'rename':
+        name, _ = os.path.splitext(name)
+    return name
+
+
+def _init_worker(args, config):
+    global _worker_cleaners
+
+    # The result cache is only used by the parent process.
+    _worker_cleaners = setup_cleaners(args, config)
+
+
+def _clean_in_worker(names, threshold=None):
+    return clean_cascade(_worker_cleaners, names, threshold=threshold)
+
+
+def make_pool(args, config):
+    """
+    Return a `Pool` for cleaning names if more than one job was requested,
+    otherwise `None`. Each worker sets up the cleaners once.
+    """
+    jobs = getattr(args, 'jobs', 1)
+    if jobs == 1:
+        return None
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = jobs or os.cpu_count() or 1
+    LOG.debug('Cleaning names in %d worker processes' % workers)
+    return Pool(ProcessPoolExecutor(max_workers=workers,
+                                    initializer=_init_worker,
+                                    initargs=(args, config)), workers)
+
+
+def clean_cascade(cleaners, names, threshold=None):
+    """
+    Return the new names (see `iter_new_names`) of a batch of `names`.
+
+    If a confidence `threshold` is given, the cleaners run in order, each
+    only on the names none of the previous cleaners was confident about.
+    """
+    new = [OrderedDict() for _ in names]
+    pending = list(range(len(names)))
+    for c in cleaners:
+        if not pending:
+            break
+        results = c.clean_many([names[i] for i in pending])
+        for i, result in zip(pending, results):
+            new[i][c.name] = result
+        if threshold is not None:
+            pending = [i for i in pending
+                       if c.confidence(new[i][c.name]) < threshold]
+    return new
+
+
+def iter_new_names(paths, cleaners, action='rename', pool=None,
+                   threshold=None):
+    """
+    Yield a (path, new names) tuple for each of `paths`, in order. New names
+    map the cleaner names to the cleaned names. With a confidence
+    `threshold`, only the cleaners needed to reach it run (see
+    `clean_cascade`).
+
+    If a `Pool` is given, the names are cleaned in its workers, a
+    bounded number of tasks ahead. Cached results are then looked up and
+    stored in this process, and only the missing names are sent out.
+    """
+    cleaner_names = [c.name for c in cleaners]
+
+    if pool is None and threshold is None:
+        paths, *copies = itertools.tee(paths, len(cleaners) + 1)
+        results = [
+            c.clean_many(entry_name(p, action) for p in it)
+            for c, it in zip(cleaners, copies)
+        ]
+        for path, *new in zip(paths, *results):
+            yield path, OrderedDict(zip(cleaner_names, new))
+        return
+
+    if pool is None:
+        paths = iter(paths)
+        while True:
+            chunk = list(itertools.islice(paths, CASCADE_CHUNK_SIZE))
+            if not chunk:
+                break
+            names = [entry_name(p, action) for p in chunk]
+            yield from zip(chunk, clean_cascade(cleaners, names, threshold))
+        return
+
+    cached = all(hasattr(c, 'lookup') for c in cleaners)
+    max_pending = pool.workers * JOBS_PENDING_PER_WORKER
+    pending = deque()
+
+    def lookup(name):
+        new = OrderedDict()
+        for c in cleaners:
+            found, result = c.lookup(name)
+            if not found:
+                return None
+            new[c.name] = result
+            if threshold is not None and c.confidence(result) >= threshold:
+                break
+        return new
+
+    def submit(chunk):
+        names = [entry_name(p, action) for p in chunk]
+        known = {}
+        for name in names:
+            if not cached or name in known:
+                continue
+            new = lookup(name)
+            if new is not None:
+                known[name] = new
+        missing = [n for n in OrderedDict.fromkeys(names) if n not in known]
+        future = None
+        if missing:
+            future = pool.executor.submit(_clean_in_worker, missing,
+                                          threshold)
+        pending.append((chunk, names, known, missing, future))
+
+    def collect():
+        chunk, names, known, missing, future = pending.popleft()
+        if future is not None:
+            for name, new in zip(missing, future.result()):
+                known[name] = new
+                if cached:
+                    for c in cleaners:
+                        if c.name in new:
+                            c.store(name, new[c.name])
+        for path, name in zip(chunk, names):
+            yield path, OrderedDict(known[name])
+
+    paths = iter(paths)
+    while True:
+        chunk = list(itertools.islice(paths, JOBS_CHUNK_SIZE))
+        if not chunk:
+            break
+        submit(chunk)
+        if len(pending) >= max_pending:
+            yield from collect()
+    while pending:
+        yield from collect()
+
+
+def choose_confident(items, cleaners, threshold, tiers):
+    """
+    Yield the (path, new names) `items` with the chosen new name first: the
+    first one with at least the `threshold` confidence, otherwise the most
+    confident one. The chosen cleaners are counted in `tiers`.
+    """
+    confidence = {c.name: c.confidence for c in cleaners}
+    for path, new_names in items:
+        scored = [(confidence[n](r), n) for n, r in new_names.items()]
+        chosen = next((n for score, n in scored if score >= threshold), None)
+        if chosen is None:
+            _, chosen = max(scored, key=lambda s: s[0])
+            tiers[None] += 1
+        tiers[chosen] += 1
+        new_names.move_to_end(chosen, last=False)
+        yield path, new_names
+
+
+def cascade_threshold(args, config):
+    """Return the confidence threshold of the cleaner cascade, or `None`."""
+    if getattr(args, 'no_cascade', False):
+        return None
+    threshold = getattr(args, 'threshold', None)
+    if threshold is None:
+        threshold = config.get('confidence_threshold')
+    return threshold
+
+
+def log_tiers(tiers):
+    if not tiers:
+        return
+    LOG.info('Cleaners used: %s (%d below the threshold)' % (', '.join(
+        '%d %s' % (n, name) for name, n in tiers.most_common()
+        if name is not None), tiers[None]))
+
+
 def operate_helper(path, cleaners, action='rename', dry_run=False,
-                   default_choice='n', auto=False):
+                   default_choice='n', auto=False, new_names=None,
+                   executor=None, companions=(), quiet=False, lock=False,
+                   into=None):
+    from . import fsops
 
-    def wrap(path, dir_name):
-        base, fname = os.path.split(path)
-        new_dir_path = os.path.join(base, dir_name)
-        new_file_path = os.path.join(new_dir_path, fname)
-        try:
-            LOG.debug('Creating a new directory: {0:s}'.format(new_dir_path))
-            os.mkdir(new_dir_path)
-            LOG.debug('Moving: {path:s} to {new_file_path:s}'.format(
-                path=path, new_file_path=new_file_path))
-            os.rename(path, new_file_path)
-        except OSError as e:
-            LOG.exception(e)
-            return
-        else:
-            LOG.info('Wraped successfully.')
+    if action == 'rename':
+        op = functools.partial(fsops.rename, lock=lock)
+    else:
+        op = functools.partial(fsops.wrap, companions=companions, lock=lock,
+                               into=into)
 
-    def rename(path, new_name):
-        base, _ = os.path.split(path)
+    def f(path, new_name):
+        if executor is not None:
+            future = executor.submit(path, op, path, new_name)
+            return Outcome('pending', new_name, future)
         try:
-            new_path = os.path.join(base, new_name)
-            LOG.debug('Renaming: {path:s} to {new_path:s}'.format(
-                path=path, new_path=new_path))
-            os.rename(path, new_path)
+            op(path, new_name)
         except OSError as e:
             LOG.exception(e)
-            return
-        else:
-            LOG.info('Renamed successfully.')
-
-    if action == 'rename':
-        f = rename
-    else:
-        f = wrap
+            return Outcome('failed', new_name, None)
+        return Outcome('done', new_name, None)
 
     path = os.path.normpath(path)
     base, old_name = os.path.split(path)
-    if action == 'rename':
-        name = old_name
-    else:
-        name, _ = os.path.splitext(old_name)
 
-    new_names = OrderedDict()
-    for c in cleaners:
-        new_names[c.name] = c.clean(name)
+    if new_names is None:
+        name = entry_name(path, action)
+        new_names = OrderedDict()
+        for c in cleaners:
+            new_names[c.name] = c.clean(name)
 
-    LOG.info('{0:s}: {1:s}'.format(
-        action == 'rename' and 'Renaming' or 'Wraping', path))
-    print('Old name: {0:s}'.format(old_name))
-    print(action == 'rename' and 'New names:' or 'Directory names:')
-    for i, (c, n) in enumerate(new_names.items(), start=1):
-        print('{0:d}) [{1:s}] {2:s}'.format(i, green(c), n))
+    if not quiet:
+        LOG.info('{0:s}: {1:s}'.format(
+            action == 'rename' and 'Renaming' or 'Wraping', path))
+        # The lines of an entry are printed at once.
+        lines = ['Old name: {0:s}'.format(old_name)]
+        if companions:
+            lines.append('Companions: {0:s}'.format(
+                ', '.join(os.path.basename(c) for c in companions)))
+        lines.append(action == 'rename' and 'New names:' or
+                     'Directory names:')
+        for i, (c, n) in enumerate(new_names.items(), start=1):
+            lines.append('{0:d}) [{1:s}] {2:s}'.format(i, green(c), n))
+        if dry_run:
+            lines.append('')
+        print('\n'.join(lines))
 
     if dry_run:
-        print()
-        return
+        return Outcome('dry-run', None, None)
     elif auto:
-        f(path, new_names[list(new_names.keys())[0]])
-        return
+        return f(path, new_names[list(new_names.keys())[0]])
 
     choice_nums = list(map(str, range(1, len(new_names.keys()) + 1)))
     choice = prompt(action == 'rename' and 'Rename' or 'Wrap',
@@ -131,14 +371,134 @@ def operate_helper(path, cleaners, action='rename', dry_run=False,
     if choice == 'q':
         sys.exit(0)
     elif choice in choice_nums:
-        f(path, new_names[list(new_names.keys())[int(choice) - 1]])
+        return f(path, new_names[list(new_names.keys())[int(choice) - 1]])
     else:
-        return
+        return Outcome('declined', None, None)
+
+
+def walk_options(args, config, files=False):
+    """Return the keyword arguments of `walk` for the given command line."""
+    options = {
+        'files': files,
+        'min_depth': args.min_depth,
+        'max_depth': args.depth or None,
+        'include': args.include,
+        'exclude': args.exclude,
+    }
+    if files:
+        options['extensions'] = media_extensions(config)
+    return options
+
+
+def media_extensions(config):
+    extensions = config.get('media_extensions')
+    if extensions:
+        return {e.lower() for e in extensions}
+    return MEDIA_EXTENSIONS
+
+
+def companion_extensions(config):
+    extensions = config.get('companion_extensions')
+    if extensions is not None:
+        return {e.lower() for e in extensions}
+    return COMPANION_EXTENSIONS
+
+
+def read_names(files, delimiter=b'\n'):
+    """
+    Yield the names in `files` ("-" for stdin), which are separated by
+    `delimiter`, one chunk at a time.
+    """
+    for filename in files or ['-']:
+        f = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+        try:
+            rest = b''
+            while True:
+                chunk = f.read1(CLEAN_READ_SIZE)
+                if not chunk:
+                    break
+                *names, rest = (rest + chunk).split(delimiter)
+                for name in names:
+                    yield os.fsdecode(name.rstrip(b'\r'))
+            if rest:
+                yield os.fsdecode(rest.rstrip(b'\r'))
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+
+def format_clean(name, new_names, chosen, fmt, delimiter=b'\n'):
+    """Return an output record of `clean` as bytes."""
+    if fmt == 'jsonl':
+        return json.dumps({'name': name, 'new': new_names}).encode(
+            'utf-8', 'surrogateescape') + b'\n'
+    if fmt == 'tsv':
+        fields = [name] + [n or '' for n in new_names.values()]
+        return os.fsencode('\t'.join(fields)) + delimiter
+    return os.fsencode(chosen or '') + delimiter
+
+
+def do_clean(args, config):
+    """Clean the names read from files or stdin, writing them to stdout"""
+    delimiter = args.null and b'\0' or b'\n'
+    out = sys.stdout.buffer
+    names = read_names(args.files, delimiter)
+    # The plain output only needs one name, so the cleaners cascade.
+    tiers = Counter()
+    cascade = args.format == 'plain' and not args.cleaner
+    counts, batch = Counter(), []
+    try:
+        for name, new_names in new_names_for(
+                args, config, names, action='name',
+                tiers=tiers if cascade else None):
+            if args.cleaner:
+                if args.cleaner not in new_names:
+                    raise SystemExit(
+                        'Cleaner "%s" is not available' % args.cleaner)
+                chosen = new_names[args.cleaner]
+            else:
+                chosen = next(iter(new_names.values()))
+            counts[chosen is None and 'failed' or 'cleaned'] += 1
+            batch.append(format_clean(name, new_names, chosen, args.format,
+                                      delimiter))
+            if len(batch) >= CLEAN_WRITE_BATCH:
+                out.write(b''.join(batch))
+                batch = []
+        out.write(b''.join(batch))
+        out.flush()
+    except BrokenPipeError:
+        # The reader went away, e.g. `antiseptic clean | head`. The output
+        # left is flushed at exit, so it goes to /dev/null instead.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    LOG.debug('Cleaned %d names, %d failed' % (
+        counts['cleaned'], counts['failed']))
+    log_tiers(tiers)
+
+
+def do_serve(args, config):
+    """Answer clean requests with warm cleaners until interrupted"""
+    from .serve import CleaningService, serve
+
+    if args.port is not None and args.socket is None:
+        path = None
+    else:
+        path = args.socket or config['socket_filename']
+    service = CleaningService(
+        functools.partial(setup_cleaners, args, config),
+        rules_filename=config['rules_filename'])
+    try:
+        serve(service, path=path, port=args.port)
+    finally:
+        service.close()
 
 
 def do_check(args, config):
+    from .update import check_latest
+
     up_to_date, latest_version = check_latest(
-        config['rules_filename'], config['update_server'])
+        config['rules_filename'], config['update_server'],
+        ttl=0 if args.refresh else config['check_ttl'])
     if up_to_date:
         LOG.info('You have the latest version of the rules.')
     else:
@@ -146,79 +506,722 @@ def do_check(args, config):
                     'Type `antiseptic update` to update' % latest_version)
 
 
+def library_names(path, config):
+    """
+    Yield the names of the directories and the stems of the movie files in
+    `path`, i.e. the names rename and wrap would clean, from one listing.
+    """
+    extensions = media_extensions(config)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                yield entry.name
+            elif os.path.splitext(entry.name)[1].lower() in extensions:
+                yield entry_name(entry.path, 'wrap')
+
+
+def format_impact(record, fmt):
+    """Return an output record of a rule change as text."""
+    if fmt == 'jsonl':
+        return json.dumps(record) + '\n'
+    return '{0:s}\n  - {1:s}\n  + {2:s}\n  rules: {3:s}\n'.format(
+        record['name'], record['old'] or '', record['new'] or '',
+        ', '.join(record['rules']) or '-')
+
+
+def report_impact(args, config, old_filename, new_filename, names):
+    """
+    Write the names which the rules of `new_filename` clean differently
+    from the rules of `old_filename`, see `impact.rule_impact`.
+    """
+    from .impact import rule_impact
+
+    out = sys.stdout
+    counts, causes, batch = Counter(), Counter(), []
+    for record in rule_impact(
+            old_filename, new_filename, names, counts, jobs=args.jobs,
+            disabled=config.get('disabled_rules', [])):
+        counts['changed'] += 1
+        causes.update(record['rules'])
+        batch.append(format_impact(record, args.format))
+        if len(batch) >= CLEAN_WRITE_BATCH:
+            out.write(''.join(batch))
+            batch = []
+    out.write(''.join(batch))
+    out.flush()
+    LOG.info('%d of %d distinct names (%d in total) change' % (
+        counts['changed'], counts['distinct'], counts['total']))
+    if causes:
+        LOG.info('Changes by rule: %s' % ', '.join(
+            '%s %d' % i for i in causes.most_common()))
+
+
+def do_rules_diff(args, config):
+    """Report the names which change between two rule files"""
+    if args.library is not None:
+        if not os.path.isdir(args.library):
+            raise SystemExit('Path "%s" does not exist or is not a '
+                             'directory' % args.library)
+        names = library_names(args.library, config)
+    else:
+        names = read_names(args.corpus)
+    report_impact(args, config, args.old, args.new, names)
+
+
+def do_rules_lint(args, config):
+    """Report the problems of the rules, e.g. catastrophic backtracking"""
+    from .cleaner import lint_rules
+
+    filename = args.file or config['rules_filename']
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SystemExit('Failed to read the rules file: %s: %s' % (
+            filename, e))
+    problems = lint_rules(data)
+    for rule_id, problem in problems:
+        print('%s: %s' % (rule_id, problem))
+    LOG.info('%d problems in %d rules' % (
+        len(problems), len(data.get('rules', []))))
+    return 1 if problems else 0
+
+
+def preview_update(args, config, new_data):
+    """Report the names of the library which the new rules would change."""
+    import tempfile
+
+    from .update import write_json
+
+    if not os.path.isdir(args.preview):
+        raise SystemExit(
+            'Path "%s" does not exist or is not a directory' % args.preview)
+    with tempfile.TemporaryDirectory(prefix='antiseptic-') as tmp_dir:
+        new_filename = os.path.join(tmp_dir, 'rules.json')
+        write_json(new_filename, new_data)
+        old_filename = config['rules_filename']
+        if not os.path.exists(old_filename):
+            old_filename = os.path.join(tmp_dir, 'empty.json')
+            write_json(old_filename, {'rules': []})
+        report_impact(args, config, old_filename, new_filename,
+                      library_names(args.preview, config))
+    LOG.info('The rules were not installed. Type `antiseptic update` to '
+             'install version %s' % new_data.get('version'))
+
+
 def do_update(args, config):
-    up_to_date, latest_version = check_latest(
-        config['rules_filename'], config['update_server'])
-    if not args.force and up_to_date:
+    from . import metrics
+    from .update import fetch_rules, install_rules, save_meta
+
+    rules_filename = config['rules_filename']
+    with metrics.timing('antiseptic_update_download_seconds'):
+        new_data, meta = fetch_rules(
+            rules_filename, config['update_server'], force=args.force)
+    if new_data is None:
+        save_meta(rules_filename, meta)
         LOG.info('You already have the latest version of the rules.')
         return
+    if args.preview is not None:
+        # The metadata is not saved either, so that updating downloads
+        # the new rules.
+        return preview_update(args, config, new_data)
 
-    rules_filename = config['rules_filename']
-    if os.path.exists(rules_filename):
-        with open(rules_filename) as f:
-            try:
-                old_rules = json.load(f).get('rules', [])
-            except ValueError:
-                LOG.warning('Failed to load the old rules.')
-                old_rules = []
-    else:
-        old_rules = []
+    install_rules(rules_filename, new_data, meta)
+    LOG.info('The rules were successfully updated.')
 
-    custom_rules = list(filter(lambda r: r['id'].startswith('_'), old_rules))
-    if custom_rules:
-        LOG.debug('%d custom rules found.' % len(custom_rules))
+    # Loading the new rules writes their snapshot for the following runs.
+    from .cleaner import RegexCleaner
 
-    new_data = get_new_rules(config['update_server'])
-    for cr in custom_rules:
-        new_data['rules'].append(cr)
+    with metrics.timing('antiseptic_rules_load_seconds'):
+        RegexCleaner(
+            disabled=set(config.get('disabled_rules', []))).load_rules(
+                rules_filename)
 
-    with open(rules_filename, 'w') as f:
-        json.dump(new_data, f, indent='\t', sort_keys=True)
-    LOG.info('The rules were successfully updated.')
+    if os.path.exists(config['cache_filename']):
+        from .cache import ResultCache
 
+        LOG.debug('Invalidating cached results of the old rules')
+        with ResultCache(config['cache_filename'],
+                         max_entries=config['cache_max_entries']) as cache:
+            cache.invalidate(RegexCleaner.name)
 
-def do_rename(args, config):
-    if not os.path.isdir(args.path):
-        raise SystemExit(
-            'Path "%s" does not exist or is not a directory' % args.path)
 
-    cleaners = setup_cleaners(args, config)
+def setup_profile(args):
+    """Return a `RuleProfile` if the rules are profiled, otherwise `None`."""
+    if getattr(args, 'profile_rules', None) is None:
+        return None
+    from .cleaner import RuleProfile
+
+    return RuleProfile()
+
+
+def write_profile(profile, filename):
+    """Dump the rule `profile` as JSON to `filename`, or report it."""
+    if filename == '-':
+        profile.report(file=sys.stderr)
+        return
+    with open(filename, 'w') as f:
+        json.dump(profile.as_dict(), f, indent=2)
+    LOG.info('Wrote the rule profile to {0:s}'.format(filename))
+
+
+@contextlib.contextmanager
+def cleaning(args, config):
+    """
+    Set up the cleaners (and the result cache and process pool, if enabled)
+    and provide them as a (cleaners, pool) tuple.
+    """
+    profile = setup_profile(args)
+    if profile is None:
+        cache = open_cache(args, config)
+    else:
+        # Every name is cleaned in this process, so that all the work done
+        # by the rules is recorded.
+        LOG.debug('Profiling the rules, the cache, --jobs and rule fusion '
+                  'are disabled')
+        cache = None
+    from . import metrics
+
+    cleaners = setup_cleaners(args, config, cache=cache,
+                              metrics=metrics.current)
     if not cleaners:
         raise SystemExit('Failed to initialize at least on cleaner, exiting.')
+    if profile is not None:
+        for c in cleaners:
+            if hasattr(c, 'profile'):
+                c.profile = profile
+
+    pool = make_pool(args, config) if profile is None else None
+    try:
+        yield cleaners, pool
+    finally:
+        if pool is not None:
+            pool.executor.shutdown(cancel_futures=True)
+        close_cleaners(cleaners)
+        if cache is not None:
+            cache.close()
+        if profile is not None:
+            write_profile(profile, args.profile_rules)
+
+
+def new_names_for(args, config, paths, action='rename', tiers=None):
+    """
+    Yield the `iter_new_names` results for `paths`. If `tiers` (a `Counter`)
+    is given, the cleaners cascade, see `choose_confident`.
+    """
+    threshold = None if tiers is None else cascade_threshold(args, config)
+    with cleaning(args, config) as (cleaners, pool):
+        items = iter_new_names(paths, cleaners, action=action, pool=pool,
+                               threshold=threshold)
+        if threshold is not None:
+            items = choose_confident(items, cleaners, threshold, tiers)
+        yield from items
+
+
+def rules_version(cleaners):
+    """Return a string identifying the cleaners and the rules they use."""
+    return ';'.join('{0:s}={1:s}:{2:s}'.format(
+        c.name, str(getattr(c, 'version', None) or ''),
+        ','.join(sorted(getattr(c, 'disabled', None) or ())))
+        for c in cleaners)
+
+
+def open_state(args, config, cleaners):
+    """Return the state index if incremental mode is enabled."""
+    if not (getattr(args, 'incremental', False) or
+            config.get('incremental', False)):
+        return None
+    from .state import StateIndex
+
+    LOG.debug('Using state index: %s' % config['state_filename'])
+    return StateIndex(config['state_filename'], rules_version(cleaners))
+
+
+def skip_processed(entries, state, counts):
+    """Yield the `entries` which are not in the state index."""
+    from .state import entry_key
+
+    for entry in entries:
+        try:
+            if isinstance(entry, str):
+                key = entry_key(os.lstat(entry), os.path.basename(entry))
+            else:
+                key = entry_key(entry.stat(follow_symlinks=False),
+                                entry.name)
+        except OSError:
+            yield entry
+            continue
+        if key in state:
+            counts['skipped'] += 1
+            continue
+        yield entry
+
+
+def record_outcome(state, path, outcome, action='rename'):
+    """Remember a processed or declined entry in the state index."""
+    from .state import DECLINED, PROCESSED, entry_key
+
+    if outcome.status == 'declined':
+        status = DECLINED
+    elif outcome.status == 'done':
+        status = PROCESSED
+        if action == 'wrap':
+            # Wrapped files are moved out of the way.
+            return
+        path = os.path.join(os.path.dirname(path), outcome.new_name)
+    else:
+        return
+    try:
+        state.add(entry_key(os.lstat(path), os.path.basename(path)), status)
+    except OSError as e:
+        LOG.debug('Not recording %s: %s' % (path, e))
+
+
+def check_path(args, action='rename'):
+    """Exit if the path given on the command line does not suit `action`."""
+    into = getattr(args, 'into', None)
+    if into is not None:
+        if action != 'wrap':
+            raise SystemExit('--into only applies to wrapping')
+        if not os.path.isdir(into):
+            raise SystemExit(
+                'Path "%s" does not exist or is not a directory' % into)
+    if action == 'rename' or args.directory:
+        if not os.path.isdir(args.path):
+            raise SystemExit(
+                'Path "%s" does not exist or is not a directory' % args.path)
+    elif not os.path.isfile(args.path):
+        raise SystemExit(
+            'File "%s" does not exist or is not a file' % args.path)
+
+
+def shard_arg(value):
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def select_shard(args, items, key=None):
+    """Return the `items` of the shard given on the command line, if any."""
+    if getattr(args, 'shard', None) is None:
+        return items
+    return in_shard(items, args.path, args.shard, key=key)
+
+
+def select_entries(args, config, action='rename'):
+    """
+    Return the entries selected on the command line for `action`, as
+    `os.DirEntry` objects or, for a single path, a string.
+    """
+    check_path(args, action=action)
+    if not args.directory:
+        return select_shard(args, [os.path.normpath(args.path)])
+    return select_shard(args, walk(args.path, **walk_options(
+        args, config, files=action == 'wrap')))
+
 
+def select_groups(args, config):
+    """
+    Return (entry, companion paths) tuples of the movie files selected on
+    the command line for wrap, see `group_companions`. The movie files and
+    their companions are found in a single listing of each directory.
+    """
+    if args.no_companions:
+        return ((e, []) for e in select_entries(args, config, action='wrap'))
+    check_path(args, action='wrap')
+    extensions = media_extensions(config)
+    options = walk_options(args, config, files=True)
+    options['extensions'] = extensions | companion_extensions(config)
     if args.directory:
-        for dn in list_dirs(args.path):
-            operate_helper(dn, cleaners, dry_run=args.dry_run,
-                           default_choice=args.choice, auto=args.auto)
+        groups = group_companions(walk(args.path, **options), extensions)
+        # The companions go to the shard of their movie file.
+        return ((e, [c.path for c in companions])
+                for e, companions in select_shard(
+                    args, groups, key=lambda group: group[0].path))
+
+    path = os.path.normpath(args.path)
+    options.update(min_depth=1, max_depth=1, include=None, exclude=None)
+    group = (path, [])
+    for entry, companions in group_companions(
+            walk(os.path.dirname(path) or '.', **options), extensions):
+        if os.path.normpath(entry.path) == path:
+            group = (path, [c.path for c in companions])
+            break
+    return select_shard(args, [group], key=lambda group: group[0])
+
+
+def with_companions(groups, companions):
+    """
+    Yield the entries of (entry, companion paths) `groups`, remembering the
+    companions by the entry paths in `companions`.
+    """
+    for entry, paths in groups:
+        if paths:
+            companions[getattr(entry, 'path', entry)] = paths
+        yield entry
+
+
+def select_paths(args, config, action='rename'):
+    """Return the paths selected on the command line for `action`."""
+    return (getattr(e, 'path', e)
+            for e in select_entries(args, config, action=action))
+
+
+def make_executor(args):
+    """
+    Return a filesystem executor if more than one thread was requested,
+    otherwise `None`.
+    """
+    if getattr(args, 'threads', 1) <= 1:
+        return None
+    from .fsops import FSExecutor
+
+    LOG.debug('Running filesystem operations in %d threads' % args.threads)
+    return FSExecutor(args.threads, per_device=args.per_device)
+
+
+def open_report(args, out=None):
+    """Return a `Report` if a report format was requested, else `None`."""
+    if getattr(args, 'format', None) is None:
+        return None
+    from .report import Report
+
+    return Report(args.format, out or sys.stdout)
+
+
+def log_summary(report):
+    LOG.info('Summary: %s' % ', '.join(
+        '%d %s' % (n, name) for name, n in report.summary().items()))
+
+
+def count_outcome(m, outcome, record=None, action='rename'):
+    """Count the outcome of an entry in the metrics `m`."""
+    if outcome.status == 'done':
+        m.inc('antiseptic_entries_renamed_total', action=action)
+    elif outcome.status == 'failed':
+        m.inc('antiseptic_entries_failed_total', action=action)
     else:
-        operate_helper(args.path, cleaners, dry_run=args.dry_run,
-                       default_choice=args.choice, auto=args.auto)
+        # A report's record tells why a dry run skipped the entry.
+        reason = record is not None and record['status'] or outcome.status
+        m.inc('antiseptic_entries_skipped_total', reason=reason)
+
+
+def process_entries(args, config, action='rename'):
+    from . import metrics
+
+    m = metrics.current
+    report = open_report(args)
+    if report is not None and not (args.dry_run or args.auto):
+        raise SystemExit('--format requires --dry-run or --auto')
+    # The companions of the wrapped movie files, by the movie file paths.
+    companions = {}
+    if action == 'wrap':
+        entries = with_companions(select_groups(args, config), companions)
+    else:
+        entries = select_entries(args, config, action=action)
+    # Rename has no --into.
+    into = getattr(args, 'into', None)
+    # Only automatic runs are sped up, prompts are answered one at a time.
+    executor = args.auto and make_executor(args) or None
+    counts, tiers = Counter(), Counter()
+    # Only the chosen name is used, so the cleaners cascade.
+    auto = args.auto or report is not None
+    threshold = cascade_threshold(args, config) if auto else None
+    # The shards of a library may move entries to the same targets.
+    lock = args.shard is not None
+    submitted = deque()
+    if report is not None:
+        from .plan import OK, TargetIndex, plan_entry
+
+        index = TargetIndex()
+
+    def record_submitted(wait=False):
+        while submitted and (wait or submitted[0][1].future is None or
+                             submitted[0][1].future.done()):
+            path, outcome, record = submitted.popleft()
+            if outcome.future is not None:
+                failed = outcome.future.exception() is not None
+                outcome = outcome._replace(
+                    status=failed and 'failed' or 'done')
+            finish(path, outcome, record)
+
+    def finish(path, outcome, record=None):
+        if m is not None:
+            count_outcome(m, outcome, record, action=action)
+        if state is not None:
+            record_outcome(state, path, outcome, action=action)
+        if record is not None:
+            if outcome.status in ('done', 'failed'):
+                record['status'] = outcome.status
+            report.add(record)
+
+    def operate(path, new_names):
+        """Operate on `path` with the results of a report, if any."""
+        if report is None:
+            return operate_helper(
+                path, None, action=action, dry_run=args.dry_run,
+                default_choice=args.choice, auto=args.auto,
+                new_names=new_names, executor=executor,
+                companions=companions.pop(path, ()), lock=lock,
+                into=into), None
+        cleaner, new_name = next(iter(new_names.items()))
+        record = plan_entry(path, new_name, cleaner, index, action=action,
+                            companions=companions.pop(path, ()),
+                            shard=args.shard, into=into)
+        if args.dry_run or record['status'] != OK:
+            return Outcome('dry-run', None, None), record
+        companion_paths = [c['source'] for c in record.get('companions', ())]
+        return operate_helper(
+            path, None, action=action, auto=True,
+            new_names=OrderedDict([(cleaner, new_name)]), executor=executor,
+            companions=companion_paths, quiet=True, lock=lock,
+            into=into), record
+
+    with cleaning(args, config) as (cleaners, pool):
+        state = not args.dry_run and open_state(args, config, cleaners) or None
+        if m is not None:
+            entries = metrics.counted(
+                entries, m, 'antiseptic_entries_scanned_total')
+        if state is not None and not args.full:
+            entries = skip_processed(entries, state, counts)
+        paths = (getattr(e, 'path', e) for e in entries)
+        items = iter_new_names(paths, cleaners, action, pool=pool,
+                               threshold=threshold)
+        if threshold is not None:
+            items = choose_confident(items, cleaners, threshold, tiers)
+        if m is not None:
+            items = metrics.counted(
+                items, m, 'antiseptic_entries_cleaned_total')
+        try:
+            for path, new_names in items:
+                outcome, record = operate(path, new_names)
+                if outcome.status == 'failed':
+                    # Operations run by the executor are counted by it.
+                    counts['failed'] += 1
+                if state is None and record is None and m is None:
+                    continue
+                if outcome.status == 'pending' or submitted:
+                    # The outcomes are recorded in order.
+                    submitted.append((path, outcome, record))
+                    record_submitted()
+                else:
+                    finish(path, outcome, record)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+                LOG.info('%d done, %d failed' % (
+                    executor.done, executor.failed))
+            record_submitted(wait=True)
+            if state is not None:
+                state.close()
+            if report is not None:
+                report.close()
+    if counts['skipped']:
+        LOG.info('Skipped %d already processed entries.' % counts['skipped'])
+        if m is not None:
+            m.inc('antiseptic_entries_skipped_total', counts['skipped'],
+                  reason='processed')
+    if report is not None:
+        log_summary(report)
+    log_tiers(tiers)
+    if counts['failed'] or executor is not None and executor.failed:
+        return 1
+
+
+def do_rename(args, config):
+    return process_entries(args, config)
 
 
 def do_wrap(args, config):
     """Wrap an existing movie inside a directory with a clean name"""
-    if args.directory and not os.path.isdir(args.path):
+    return process_entries(args, config, action='wrap')
+
+
+def do_plan(args, config):
+    """Write a plan of the renames (or wraps), to be executed by `apply`"""
+    from .plan import TargetIndex, plan_entry
+
+    action = args.wrap and 'wrap' or 'rename'
+    companions = {}
+    if action == 'wrap':
+        paths = (getattr(e, 'path', e) for e in with_companions(
+            select_groups(args, config), companions))
+    else:
+        paths = select_paths(args, config, action=action)
+    index, tiers = TargetIndex(), Counter()
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        with open_report(args, out) as report:
+            for path, new_names in new_names_for(
+                    args, config, paths, action,
+                    tiers=None if args.cleaner else tiers):
+                cleaner = args.cleaner or next(iter(new_names))
+                if cleaner not in new_names:
+                    raise SystemExit(
+                        'Cleaner "%s" is not available' % cleaner)
+                report.add(plan_entry(
+                    path, new_names[cleaner], cleaner, index, action=action,
+                    companions=companions.pop(path, ()), shard=args.shard,
+                    into=args.into))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    LOG.info('Planned: %s' % ', '.join(
+        '%d %s' % (n, status)
+        for status, n in sorted(report.counts.items())))
+    log_summary(report)
+    log_tiers(tiers)
+
+
+def do_merge(args, config):
+    """Combine the plans or journals of the shards of a library"""
+    from .plan import COLLISION, FAILED, merge
+    from .report import Report
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        with Report(args.format, out) as report:
+            for record in merge(args.files):
+                report.add(record)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    log_summary(report)
+    if report.counts[COLLISION] or report.counts[FAILED]:
+        return 1
+
+
+def do_apply(args, config):
+    """Execute a plan written by `plan`"""
+    from .plan import apply_plan, read_jsonl
+
+    journal = args.journal or args.plan + '.journal'
+    LOG.info('Journal: %s' % journal)
+    executor = make_executor(args)
+    try:
+        counts = apply_plan(read_jsonl(args.plan), journal,
+                            batch_size=args.batch_size, executor=executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    LOG.info('Applied: %s' % ', '.join(
+        '%d %s' % (n, status) for status, n in sorted(counts.items())))
+    if counts['failed']:
+        return 1
+
+
+def do_undo(args, config):
+    """Reverse the moves recorded in an `apply` journal"""
+    from .plan import undo
+
+    counts = undo(args.journal)
+    LOG.info('Undo: %s' % ', '.join(
+        '%d %s' % (n, status) for status, n in sorted(counts.items())))
+    if counts['failed']:
+        return 1
+
+
+def do_watch(args, config):
+    """Rename (or wrap) the entries arriving in a directory as they settle"""
+    from . import fsops, metrics
+    from .watch import watch
+
+    if not os.path.isdir(args.path):
         raise SystemExit(
             'Path "%s" does not exist or is not a directory' % args.path)
-    elif not args.directory and not os.path.isfile(args.path):
-        raise SystemExit(
-            'File "%s" does not exist or is not a file' % args.path)
 
-    cleaners = setup_cleaners(args, config)
-    if not cleaners:
-        raise SystemExit('Failed to initialize at least on cleaner, exiting.')
+    action = args.wrap and 'wrap' or 'rename'
+    op = action == 'rename' and fsops.rename or fsops.wrap
+    extensions = media_extensions(config)
+    # Paths created by the renames themselves, which must not be cleaned
+    # again.
+    produced = set()
+    m = metrics.current
 
-    if args.directory:
-        for fp in list_files(args.path):
-            operate_helper(fp, cleaners, action='wrap', dry_run=args.dry_run,
-                           default_choice=args.choice, auto=args.auto)
-    else:
-        operate_helper(args.path, cleaners, action='wrap',
-                       dry_run=args.dry_run, default_choice=args.choice,
-                       auto=args.auto)
+    def operate(path):
+        """Return the status of `path`, or `None` if it is not an entry."""
+        if path in produced:
+            produced.discard(path)
+            return None
+        is_dir = os.path.isdir(path)
+        if action == 'rename' and not is_dir:
+            return None
+        if action == 'wrap' and (is_dir or os.path.splitext(
+                path)[1].lower() not in extensions):
+            return None
+        new_name = cleaners[0].clean(entry_name(path, action))
+        if not new_name:
+            LOG.warning('Failed to clean: %s' % path)
+            return 'unclean'
+        new_path = os.path.join(os.path.dirname(path), new_name)
+        LOG.info('{0:s}: {1:s} -> {2:s}'.format(
+            action == 'rename' and 'Renaming' or 'Wraping', path, new_name))
+        try:
+            op(path, new_name)
+        except OSError as e:
+            LOG.error('{0:s}: {1!s}'.format(path, e))
+            return 'failed'
+        if new_path != path:
+            produced.add(new_path)
+        return 'done'
+
+    def handle(path):
+        status = operate(path)
+        if m is None or status is None:
+            return
+        m.inc('antiseptic_entries_scanned_total')
+        if status != 'unclean':
+            m.inc('antiseptic_entries_cleaned_total')
+        count_outcome(m, Outcome(status, None, None), action=action)
+        # The watch runs until it is interrupted, so the metrics are
+        # written as they change.
+        try:
+            m.write()
+        except OSError as e:
+            LOG.warning('Failed to write the metrics: %s' % e)
+
+    with cleaning(args, config) as (cleaners, _):
+        try:
+            watch(os.path.normpath(args.path), handle, settle=args.settle,
+                  poll_interval=args.poll)
+        except KeyboardInterrupt:
+            pass
 
 
-def main():
+def do_cache_stats(args, config):
+    from .cache import ResultCache
+
+    if not os.path.exists(config['cache_filename']):
+        LOG.info('The result cache is empty.')
+        return
+    with ResultCache(config['cache_filename'],
+                     max_entries=config['cache_max_entries']) as cache:
+        stats = cache.stats()
+    print('Cache file: {0:s}'.format(stats['filename']))
+    print('Size: {0:d} bytes'.format(stats['size']))
+    print('Entries: {0:d} (max. {1:d})'.format(
+        stats['entries'], stats['max_entries']))
+    for c in stats['cleaners']:
+        print('  [{0:s}] version {1:s}: {2:d}'.format(
+            green(c['cleaner']), c['version'] or '-', c['entries']))
+
+
+def do_cache_clear(args, config):
+    from .cache import ResultCache
+
+    if os.path.exists(config['cache_filename']):
+        with ResultCache(config['cache_filename'],
+                         max_entries=config['cache_max_entries']) as cache:
+            cache.clear()
+    LOG.info('The result cache was cleared.')
+
+
+def make_parser():
     p = argparse.ArgumentParser(prog=__progname__, description=__description__)
     p.add_argument('--version', action='version',
                    version='%(prog)s ' + __version__)
@@ -237,15 +1240,98 @@ def main():
         const=0, help='suppress output except warnings and errors',)
     subparsers = p.add_subparsers()
 
+    # common arguments for cleaning names
+    cleaner_parser = argparse.ArgumentParser(add_help=False)
+    cleaner_parser.add_argument('-g', '--guessit', action='store_true',
+                                dest='prefer_guessit',
+                                help='prefer guessit renamer (if available)')
+    cleaner_parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='N',
+        help='clean the names in N worker processes (0 for one per CPU, '
+             'default: 1)')
+    cleaner_parser.add_argument(
+        '--profile-rules', action='store_const', const='-',
+        help='record the evaluations, matches and time of each rule, and '
+             'report them at the end')
+    cleaner_parser.add_argument(
+        '--profile-rules-json', dest='profile_rules', metavar='FILE',
+        help='like --profile-rules, but dump the profile as JSON to FILE')
+    cleaner_parser.add_argument(
+        '--no-optimize-rules', action='store_true',
+        help='apply the rules one by one, without fusing compatible ones '
+             '(for debugging)')
+    cleaner_parser.add_argument(
+        '--rule-timeout', type=float, metavar='SECONDS',
+        help='clean the names in a guarded worker process, quarantining '
+             'the rules which take longer than SECONDS on a name '
+             '(rule_timeout in the config)')
+    cascade_group = cleaner_parser.add_mutually_exclusive_group()
+    cascade_group.add_argument(
+        '--threshold', type=float, metavar='CONFIDENCE',
+        help='when choosing automatically, use the first cleaner whose '
+             'result has at least this confidence (0-1), and only run the '
+             'following cleaners as a fallback (default: 0.6)')
+    cascade_group.add_argument(
+        '--no-cascade', action='store_true',
+        help='run every cleaner and use the first one')
+    cache_group = cleaner_parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        '--cache', action='store_true', dest='cache', default=None,
+        help='cache the cleaned names on disk')
+    cache_group.add_argument(
+        '--no-cache', action='store_false', dest='cache',
+        help='don\'t use the result cache')
+
+    # common arguments for selecting and cleaning entries
+    selection_parser = argparse.ArgumentParser(
+        add_help=False, parents=[cleaner_parser])
+    selection_parser.add_argument('path', metavar='PATH')
+    selection_parser.add_argument(
+        '--depth', type=int, default=1, metavar='N',
+        help='with -d, descend up to N levels below PATH (0 for no limit, '
+             'default: 1)')
+    selection_parser.add_argument(
+        '--min-depth', type=int, default=1, metavar='N',
+        help='with -d, skip the entries less than N levels below PATH')
+    selection_parser.add_argument(
+        '--include', action='append', metavar='GLOB',
+        help='with -d, only process the entries matching GLOB. '
+             'Can be repeated.')
+    selection_parser.add_argument(
+        '--exclude', action='append', metavar='GLOB',
+        help='with -d, skip (and don\'t descend into) the entries matching '
+             'GLOB. Can be repeated.')
+    selection_parser.add_argument(
+        '--shard', type=shard_arg, metavar='K/N',
+        help='only process the K-th of N shards of the entries, by their '
+             'paths relative to PATH, e.g. 1/3 on the first of three nodes '
+             'sharing the library. Moves lock their directories.')
+
+    # common arguments for commands changing the filesystem
+    fs_parser = argparse.ArgumentParser(add_help=False)
+    fs_parser.add_argument(
+        '-t', '--threads', type=int, default=1, metavar='N',
+        help='run up to N filesystem operations at once, e.g. on network '
+             'filesystems (default: 1)')
+    fs_parser.add_argument(
+        '--per-device', type=int, default=8, metavar='N',
+        help='with --threads, run up to N operations at once on each '
+             'device (default: 8)')
+
+    # common arguments for commands run unattended
+    metrics_parser = argparse.ArgumentParser(add_help=False)
+    metrics_parser.add_argument(
+        '--metrics-file', metavar='FILE',
+        help='write counters and latency histograms of the run to FILE, in '
+             'the Prometheus text format (e.g. for node_exporter\'s textfile '
+             'collector)')
+
     # common arguments for rename and wrap
-    common_parser = argparse.ArgumentParser(add_help=False)
-    common_parser.add_argument('path', metavar='PATH')
+    common_parser = argparse.ArgumentParser(
+        add_help=False, parents=[selection_parser, fs_parser, metrics_parser])
     common_parser.add_argument(
         '-y', '--yes', action='store_const', const='1', default='n',
         dest='choice', help='make the prefered cleaner the default choice')
-    common_parser.add_argument('-g', '--guessit', action='store_true',
-                               dest='prefer_guessit',
-                               help='prefer guessit renamer (if available)')
     # -n and -a can't be used together
     mutex_group = common_parser.add_mutually_exclusive_group()
     mutex_group.add_argument(
@@ -254,6 +1340,17 @@ def main():
     mutex_group.add_argument(
         '-a', '--auto', action='store_true',
         help='don\'t ask questions, rename everything automatically')
+    common_parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='skip the entries processed or declined by earlier runs, '
+             'unless they or the rules changed')
+    common_parser.add_argument(
+        '--full', action='store_true',
+        help='with --incremental, re-evaluate all entries')
+    common_parser.add_argument(
+        '-f', '--format', choices=REPORT_FORMATS,
+        help='with -n or -a, report the entries in this format instead of '
+             'describing them')
 
     rename_parser = subparsers.add_parser('rename', help='rename directories',
                                           parents=[common_parser])
@@ -268,28 +1365,204 @@ def main():
     wrap_parser.add_argument(
         '-d', '--dir', action='store_true', dest='directory',
         help='wrap all files inside PATH')
+    wrap_parser.add_argument(
+        '--no-companions', action='store_true',
+        help='only move the movie files, not their subtitles, nfo files and '
+             'samples')
+    wrap_parser.add_argument(
+        '--into', metavar='DIR',
+        help='create the directories in DIR instead of next to the files, '
+             'copying the files if DIR is on another filesystem')
     wrap_parser.set_defaults(func=do_wrap)
 
+    plan_parser = subparsers.add_parser(
+        'plan', help='write a plan of the renames, to be executed by apply',
+        parents=[selection_parser])
+    plan_parser.add_argument(
+        '-d', '--dir', action='store_true', dest='directory',
+        help='plan all entries inside PATH')
+    plan_parser.add_argument(
+        '-w', '--wrap', action='store_true',
+        help='plan wrapping movie files instead of renaming directories')
+    plan_parser.add_argument(
+        '--no-companions', action='store_true',
+        help='with -w, only move the movie files, not their subtitles, nfo '
+             'files and samples')
+    plan_parser.add_argument(
+        '--into', metavar='DIR',
+        help='with -w, create the directories in DIR instead of next to the '
+             'files')
+    plan_parser.add_argument(
+        '-c', '--cleaner', metavar='NAME',
+        help='use the names of this cleaner (default: the prefered one)')
+    plan_parser.add_argument(
+        '-o', '--output', metavar='PLAN', default='-',
+        help='write the plan to this file (default: stdout)')
+    plan_parser.add_argument(
+        '-f', '--format', choices=REPORT_FORMATS, default='jsonl',
+        help='format of the plan; apply reads jsonl, the default')
+    plan_parser.set_defaults(func=do_plan)
+
+    merge_parser = subparsers.add_parser(
+        'merge', help='combine the plans or journals of shards into one '
+                      'report')
+    merge_parser.add_argument('files', nargs='+', metavar='FILE')
+    merge_parser.add_argument(
+        '-o', '--output', metavar='FILE', default='-',
+        help='write the report to this file (default: stdout)')
+    merge_parser.add_argument(
+        '-f', '--format', choices=REPORT_FORMATS, default='table',
+        help='format of the report (default: table); a jsonl report of plans '
+             'is a plan of all the shards')
+    merge_parser.set_defaults(func=do_merge)
+
+    apply_parser = subparsers.add_parser('apply', help='execute a plan',
+                                         parents=[fs_parser])
+    apply_parser.add_argument('plan', metavar='PLAN')
+    apply_parser.add_argument(
+        '--journal', metavar='JOURNAL',
+        help='record the executed moves in this file '
+             '(default: PLAN.journal). Re-running resumes from it.')
+    apply_parser.add_argument(
+        '--batch-size', type=int, default=100, metavar='N',
+        help='sync the journal to disk every N moves (default: 100)')
+    apply_parser.set_defaults(func=do_apply)
+
+    undo_parser = subparsers.add_parser(
+        'undo', help='reverse the moves recorded in a journal')
+    undo_parser.add_argument('journal', metavar='JOURNAL')
+    undo_parser.set_defaults(func=do_undo)
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='rename new entries of a directory as they arrive',
+        parents=[metrics_parser])
+    watch_parser.add_argument('path', metavar='PATH')
+    watch_parser.add_argument(
+        '-w', '--wrap', action='store_true',
+        help='wrap new movie files instead of renaming new directories')
+    watch_parser.add_argument('-g', '--guessit', action='store_true',
+                              dest='prefer_guessit',
+                              help='prefer guessit renamer (if available)')
+    watch_parser.add_argument(
+        '--settle', type=float, default=0.5, metavar='SECONDS',
+        help='wait until an entry has not changed for SECONDS '
+             '(default: 0.5)')
+    watch_parser.add_argument(
+        '--poll', type=float, metavar='SECONDS',
+        help='list the directory every SECONDS instead of using inotify')
+    watch_parser.set_defaults(func=do_watch)
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='keep the cleaners warm and serve clean requests')
+    serve_parser.add_argument(
+        '-s', '--socket', metavar='PATH',
+        help='listen on the Unix socket PATH (default: serve.sock in the '
+             'data directory)')
+    serve_parser.add_argument(
+        '-p', '--port', type=int, metavar='PORT',
+        help='serve HTTP on localhost:PORT (instead of the default socket)')
+    serve_parser.add_argument('-g', '--guessit', action='store_true',
+                              dest='prefer_guessit',
+                              help='prefer guessit renamer (if available)')
+    serve_parser.set_defaults(func=do_serve)
+
+    clean_parser = subparsers.add_parser(
+        'clean', help='clean names read from files or stdin',
+        parents=[cleaner_parser])
+    clean_parser.add_argument(
+        'files', nargs='*', metavar='FILE',
+        help='files with a name per line ("-" or none for stdin)')
+    clean_parser.add_argument(
+        '-0', '--null', action='store_true',
+        help='names are separated by NUL characters, not newlines, and so '
+             'are the cleaned names')
+    clean_parser.add_argument(
+        '-f', '--format', choices=CLEAN_FORMATS, default='plain',
+        help='output the cleaned name (plain, the default), or the name and '
+             'the names of each cleaner (tsv or jsonl)')
+    clean_parser.add_argument(
+        '-c', '--cleaner', help='with plain output, use the names of CLEANER')
+    clean_parser.set_defaults(func=do_clean)
+
     check_parser = subparsers.add_parser(
         'check', help='check for rule updates')
+    check_parser.add_argument(
+        '--refresh', action='store_true',
+        help='ignore the recently checked latest version')
     check_parser.set_defaults(func=do_check)
 
-    update_parser = subparsers.add_parser('update', help='update rules')
+    # common arguments for reporting the impact of rule changes
+    impact_parser = argparse.ArgumentParser(add_help=False)
+    impact_parser.add_argument(
+        '-j', '--jobs', type=int, default=0, metavar='N',
+        help='clean the names in N worker processes (0 for one per CPU, '
+             'the default)')
+    impact_parser.add_argument(
+        '--format', choices=('plain', 'jsonl'), default='plain',
+        help='output the changed names as text (plain, the default) or '
+             'JSON objects (jsonl)')
+
+    update_parser = subparsers.add_parser(
+        'update', help='update rules',
+        parents=[impact_parser, metrics_parser])
     update_parser.add_argument(
         '-f', '--force', action='store_true',
         help='force update even if already on the latest version')
+    update_parser.add_argument(
+        '--preview', metavar='PATH',
+        help='don\'t install the new rules, report which names of the '
+             'library at PATH they would change, and why')
     update_parser.set_defaults(func=do_update)
 
+    rules_parser = subparsers.add_parser(
+        'rules', help='compare and check rule files')
+    rules_subparsers = rules_parser.add_subparsers()
+    rules_diff_parser = rules_subparsers.add_parser(
+        'diff', help='report the names which change between two rule files',
+        parents=[impact_parser])
+    rules_diff_parser.add_argument('old', metavar='OLD')
+    rules_diff_parser.add_argument('new', metavar='NEW')
+    source_group = rules_diff_parser.add_mutually_exclusive_group()
+    source_group.add_argument(
+        '--corpus', action='append', metavar='FILE',
+        help='clean the names in FILE, one per line ("-" for stdin, the '
+             'default). Can be repeated.')
+    source_group.add_argument(
+        '--library', metavar='PATH',
+        help='clean the names of the directories and movie files in PATH')
+    rules_diff_parser.set_defaults(func=do_rules_diff)
+    rules_lint_parser = rules_subparsers.add_parser(
+        'lint', help='report rules which fail to compile, are duplicated or '
+                     'may backtrack catastrophically')
+    rules_lint_parser.add_argument(
+        'file', metavar='FILE', nargs='?',
+        help='the rules file to check (default: the installed rules)')
+    rules_lint_parser.set_defaults(func=do_rules_lint)
+
+    cache_parser = subparsers.add_parser(
+        'cache', help='manage the result cache')
+    cache_subparsers = cache_parser.add_subparsers()
+    cache_stats_parser = cache_subparsers.add_parser(
+        'stats', help='show result cache statistics')
+    cache_stats_parser.set_defaults(func=do_cache_stats)
+    cache_clear_parser = cache_subparsers.add_parser(
+        'clear', help='remove all cached results')
+    cache_clear_parser.set_defaults(func=do_cache_clear)
+    return p
+
+
+def main():
+    p = make_parser()
     args = p.parse_args()
 
     root_logger = logging.getLogger()
-    root_logger.setLevel(logging.DEBUG)
 
     # Set up logging to a file.
     if args.log_file:
         file_handler = logging.FileHandler(
             filename=args.log_file,
         )
+        file_handler.setLevel(logging.DEBUG)
         formatter = logging.Formatter(LOG_FILE_MESSAGE_FORMAT)
         file_handler.setFormatter(formatter)
         root_logger.addHandler(file_handler)
@@ -305,11 +1578,19 @@ def main():
     formatter = logging.Formatter(CONSOLE_MESSAGE_FORMAT)
     console.setFormatter(formatter)
     root_logger.addHandler(console)
+    # Debug messages, e.g. the applied rules, are not even created unless
+    # a handler outputs them.
+    root_logger.setLevel(min(h.level for h in root_logger.handlers))
 
     try:
         config = get_config()
         if hasattr(args, 'func'):
-            getattr(args, 'func')(args, config)
+            if getattr(args, 'metrics_file', None):
+                from .metrics import recording
+
+                with recording(args.metrics_file):
+                    return getattr(args, 'func')(args, config)
+            return getattr(args, 'func')(args, config)
         else:
             p.print_help()
     except Exception as err:
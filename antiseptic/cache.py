@@ -0,0 +1,181 @@
+import logging
+import os
+import sqlite3
+
+from .cleaner import Cleaner
+from .utils import close_cleaners
+
+LOG = logging.getLogger(__name__)
+DEFAULT_MAX_ENTRIES = 100000
+# Pending writes are committed after this many new results.
+COMMIT_EVERY = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    cleaner TEXT NOT NULL,
+    version TEXT NOT NULL,
+    disabled TEXT NOT NULL,
+    name TEXT NOT NULL,
+    result TEXT,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (cleaner, version, disabled, name)
+);
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+'''
+
+
+class ResultCache(object):
+    """
+    A persistent, size-bounded LRU cache of cleaner results.
+
+    Results are keyed by the cleaner name, the version of its rules, the set
+    of disabled rules and the input name.
+    """
+
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._touched = {}
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript(SCHEMA)
+        self._tick = self._conn.execute(
+            'SELECT COALESCE(MAX(used), 0) FROM results').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _next_tick(self):
+        self._tick += 1
+        return self._tick
+
+    def get(self, key):
+        """
+        Return a (found, result) tuple for `key`, which is a (cleaner,
+        version, disabled, name) tuple.
+        """
+        row = self._conn.execute(
+            'SELECT result FROM results WHERE cleaner = ? AND version = ? '
+            'AND disabled = ? AND name = ?', key).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        # Recency updates are written together with the next commit.
+        self._touched[key] = self._next_tick()
+        return True, row[0]
+
+    def put(self, key, result):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+            key + (result, self._next_tick()))
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE results SET used = ? WHERE cleaner = ? AND '
+                'version = ? AND disabled = ? AND name = ?',
+                ((used,) + key for key, used in self._touched.items()))
+            self._touched = {}
+        self._evict()
+        self._conn.commit()
+        self._pending = 0
+
+    def _evict(self):
+        count = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()
+        excess = count[0] - self.max_entries
+        if excess > 0:
+            LOG.debug('Evicting %d cached results' % excess)
+            self._conn.execute(
+                'DELETE FROM results WHERE rowid IN (SELECT rowid FROM '
+                'results ORDER BY used LIMIT ?)', (excess,))
+
+    def invalidate(self, cleaner=None):
+        """Drop the cached results of `cleaner`, or all of them."""
+        if cleaner is None:
+            self._conn.execute('DELETE FROM results')
+        else:
+            self._conn.execute(
+                'DELETE FROM results WHERE cleaner = ?', (cleaner,))
+        self._touched = {}
+        self._conn.commit()
+
+    def clear(self):
+        self.invalidate()
+        self._conn.execute('VACUUM')
+
+    def stats(self):
+        rows = self._conn.execute(
+            'SELECT cleaner, version, COUNT(*) FROM results '
+            'GROUP BY cleaner, version ORDER BY cleaner, version').fetchall()
+        return {
+            'filename': self.filename,
+            'size': os.path.getsize(self.filename),
+            'max_entries': self.max_entries,
+            'entries': sum(r[2] for r in rows),
+            'cleaners': [
+                {'cleaner': c, 'version': v, 'entries': n}
+                for c, v, n in rows
+            ],
+        }
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.commit()
+        self._conn.close()
+        self._conn = None
+
+
+class CachedCleaner(Cleaner):
+    """Wraps a cleaner, serving its results from a `ResultCache`."""
+
+    def __init__(self, cleaner, cache):
+        self.cleaner = cleaner
+        self.cache = cache
+        self.name = cleaner.name
+        self.version = getattr(cleaner, 'version', None)
+        self.disabled = getattr(cleaner, 'disabled', None)
+        self._update_key()
+
+    def _update_key(self):
+        # A guarded cleaner disables the rules it quarantines as it runs.
+        self._disabled_count = len(self.disabled or ())
+        self._key = (
+            self.cleaner.name,
+            str(self.version or ''),
+            ','.join(sorted(self.disabled or ())),
+        )
+
+    def _cache_key(self, title):
+        if len(self.disabled or ()) != self._disabled_count:
+            self._update_key()
+        return self._key + (title,)
+
+    def lookup(self, title):
+        """Return a (found, result) tuple for the cached result of title."""
+        return self.cache.get(self._cache_key(title))
+
+    def store(self, title, result):
+        self.cache.put(self._cache_key(title), result)
+
+    def confidence(self, result):
+        return self.cleaner.confidence(result)
+
+    def close(self):
+        close_cleaners([self.cleaner])
+
+    def clean(self, title):
+        found, result = self.lookup(title)
+        if not found:
+            result = self.cleaner.clean(title)
+            self.store(title, result)
+        return result
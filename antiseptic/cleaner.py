@@ -1,13 +1,390 @@
+import functools
+import importlib.util
 import logging
+import os
+import pickle
 import re
 import json
+import sys
+import time
 
 from abc import abstractmethod, ABCMeta
 
-from .utils import diff
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from .utils import LazyDiff
 
 LOG = logging.getLogger(__name__)
 
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+SNAPSHOT_SUFFIX = '.snapshot'
+# Number of distinct titles whose results clean_many remembers.
+CLEAN_MANY_MEMO_SIZE = 65536
+# Release tags, brackets and dotted words, left in a name by an incomplete
+# clean.
+_NOISE = re.compile(
+    r'(?i)\b(?:xvid|divx|[xh]\.?26[45]|hevc|\d{3,4}p|bluray|'
+    r'(?:dvd|bd|br|web|hd)[\.\-]?(?:rip|scr|dl|tv)|ac3|aac|dts|repack|'
+    r'proper|limited|unrated)\b|[\[\]{}_]|\w{2,}\.\w{2,}')
+_YEAR = re.compile(r'\((?:19|20)\d{2}\)$')
+# Bump whenever the layout of the snapshot or of the rule index changes.
+SNAPSHOT_FORMAT = 2
+
+
+def confidence(name):
+    """
+    Return how likely `name` is a clean movie name, from 0 to 1. Names with
+    a year score higher, and each leftover release tag scores lower.
+    """
+    if not name:
+        return 0.0
+    score = 0.6
+    if _YEAR.search(name):
+        score += 0.4
+    score -= 0.5 * len(_NOISE.findall(name))
+    return round(min(max(score, 0.0), 1.0), 2)
+
+
+def _is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _required_literals(parsed):
+    """Yield the literal substrings every match of `parsed` must contain."""
+    run = []
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            yield ''.join(run)
+            run = []
+        if op == sre_parse.SUBPATTERN:
+            # Groups that change flags, e.g. (?i:...), are not descended
+            # into, since their literals would match differently.
+            if len(av) == 2 or not (av[1] or av[2]):
+                yield from _required_literals(av[-1])
+        elif op in _REPEATS and av[0] >= 1:
+            yield from _required_literals(av[2])
+    if run:
+        yield ''.join(run)
+
+
+def required_literal(pattern):
+    """
+    Return the longest ASCII literal which must appear in any text matched by
+    the compiled `pattern`, or `None` if there is no such literal.
+    """
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    literals = [lit for lit in _required_literals(parsed) if _is_ascii(lit)]
+    if not literals:
+        return None
+    return max(literals, key=len)
+
+
+# Largest character range considered by the rule fusion analysis.
+_MAX_RANGE = 256
+_CONTEXT_OPS = (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT,
+                sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+_INLINE_FLAGS = re.compile(r'^(?:\(\?[aiLmsux]+\))+')
+_FLAG_LETTERS = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'),
+                 (re.DOTALL, 's'), (re.ASCII, 'a'))
+
+
+def _consumed(parsed):
+    """
+    Return the characters any match of `parsed` may consume and whether it
+    looks at its context (anchors, lookarounds, backreferences), or `None`
+    if the characters are unbounded.
+    """
+    chars, context = set(), False
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op == sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op == sre_parse.LITERAL:
+                    chars.add(chr(item_av))
+                elif item_op == sre_parse.RANGE and \
+                        item_av[1] - item_av[0] < _MAX_RANGE:
+                    chars.update(map(chr, range(item_av[0],
+                                                item_av[1] + 1)))
+                else:
+                    return None
+        elif op in _CONTEXT_OPS:
+            context = True
+            if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                # Lookarounds only look, but what they look for must be
+                # bounded as well.
+                if _consumed(av[1]) is None:
+                    return None
+            elif op != sre_parse.AT:
+                return None
+        elif op == sre_parse.SUBPATTERN:
+            if len(av) == 4 and (av[1] or av[2]):
+                # Scoped flags change what the characters match.
+                return None
+            sub = _consumed(av[-1])
+            if sub is None:
+                return None
+            chars |= sub[0]
+            context = context or sub[1]
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                sub = _consumed(branch)
+                if sub is None:
+                    return None
+                chars |= sub[0]
+                context = context or sub[1]
+        elif op in _REPEATS:
+            sub = _consumed(av[2])
+            if sub is None:
+                return None
+            chars |= sub[0]
+            context = context or sub[1]
+        else:
+            return None
+    return chars, context
+
+
+def _is_class_rule(parsed):
+    """Whether `parsed` matches one or more characters of a set, e.g. [._]+"""
+    if len(parsed) != 1:
+        return False
+    op, av = parsed[0]
+    if op in _REPEATS:
+        if av[0] != 1 or len(av[2]) != 1:
+            return False
+        op, av = av[2][0]
+    return op in (sre_parse.LITERAL, sre_parse.IN)
+
+
+def _fusion_info(rule):
+    """
+    Return what `fuse_rules` needs to know of a rule as a (characters,
+    looks at context, is a class rule) tuple, or `None` if the rule is not
+    fusable.
+    """
+    pattern, sub = rule['pattern'], rule.get('sub', '')
+    if '\\' in sub or pattern.flags & re.VERBOSE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    if parsed.getwidth()[0] == 0:
+        # May match the empty string.
+        return None
+    consumed = _consumed(parsed)
+    if consumed is None:
+        return None
+    chars, context = consumed
+    if pattern.flags & re.IGNORECASE:
+        if not all(_is_ascii(c) for c in chars):
+            return None
+        chars = {v for c in chars for v in (c.lower(), c.upper())}
+    return chars, context, _is_class_rule(parsed)
+
+
+def _can_follow(infos, info, sub):
+    """Whether a rule can join a run of rules to fuse, see `fuse_rules`."""
+    chars, context, is_class = info
+    if context or (not sub and not is_class):
+        return False
+    return all(not (chars & other) for other, _, _ in infos)
+
+
+def _fused(rules):
+    flags = rules[0]['pattern'].flags
+    source = ''.join('(?%s)' % letter for flag, letter in _FLAG_LETTERS
+                     if flags & flag)
+    source += '|'.join(
+        '(?:%s)' % _INLINE_FLAGS.sub('', r['pattern'].pattern)
+        for r in rules)
+    return {
+        'id': '+'.join(r['id'] for r in rules),
+        'rule': source,
+        'pattern': re.compile(source),
+        'sub': rules[0].get('sub', ''),
+        'weight': rules[0].get('weight', 0),
+        'fused': [r['id'] for r in rules],
+        # The alternation has no required literal of its own, but it can
+        # only match if one of the fused rules can.
+        'literals': [required_literal(r['pattern']) for r in rules],
+    }
+
+
+def fuse_rules(rules):
+    """
+    Return the sorted `rules`, with runs of adjacent rules fused into one
+    alternation where that provably gives the same result as applying them
+    in turn, so that a title is scanned once instead of once per rule.
+
+    The rules of a run have the same flags and the same literal `sub`, and
+    may consume disjoint, bounded sets of characters only, none of which
+    occur in the `sub`. The first rule may look at its context (e.g. be
+    anchored), the following ones may not, and if the `sub` is empty, they
+    must match one or more characters of a set (e.g. [._]+). Then no rule
+    can create or break the matches of another: each one replaces the same
+    characters, whether it runs alone or in the alternation.
+    """
+    fused, run, infos = [], [], []
+
+    def flush():
+        rule = None
+        if len(run) > 1:
+            try:
+                rule = _fused(run)
+            except re.error:
+                # E.g. the rules use the same group name.
+                pass
+        if rule is None:
+            fused.extend(run)
+        else:
+            LOG.debug('Fused rules: %s' % ', '.join(r['id'] for r in run))
+            fused.append(rule)
+        del run[:], infos[:]
+
+    for rule in rules:
+        info, sub = _fusion_info(rule), rule.get('sub', '')
+        if info is None or info[0] & set(sub):
+            flush()
+            fused.append(rule)
+            continue
+        if not run or rule['pattern'].flags != run[0]['pattern'].flags or \
+                sub != run[0].get('sub', '') or \
+                not _can_follow(infos, info, sub):
+            flush()
+        run.append(rule)
+        infos.append(info)
+    flush()
+    return fused
+
+
+# Repeats of up to this many iterations are not screened by `risky_constructs`.
+_FEW = 16
+
+
+def _unbounded(repeat_av):
+    return repeat_av[1] == sre_parse.MAXREPEAT or repeat_av[1] > _FEW
+
+
+def _unwrap(parsed):
+    """Return the items of `parsed`, without the groups wrapping them."""
+    items = list(parsed)
+    while len(items) == 1 and items[0][0] == sre_parse.SUBPATTERN:
+        items = list(items[0][1][-1])
+    return items
+
+
+def _first_chars(items, ignorecase):
+    """
+    Return the characters a match of `items` may start with, or `None` if
+    they are not known.
+    """
+    if not items:
+        return None
+    op, av = items[0]
+    if op == sre_parse.LITERAL:
+        chars = {chr(av)}
+    elif op == sre_parse.IN:
+        consumed = _consumed([(op, av)])
+        if consumed is None:
+            return None
+        chars = consumed[0]
+    elif op == sre_parse.SUBPATTERN:
+        return _first_chars(list(av[-1]) + items[1:], ignorecase)
+    elif op == sre_parse.BRANCH:
+        chars = set()
+        for branch in av[1]:
+            first = _first_chars(list(branch) + items[1:], ignorecase)
+            if first is None:
+                return None
+            chars |= first
+    elif op in _REPEATS and av[0] >= 1:
+        return _first_chars(list(av[2]), ignorecase)
+    else:
+        return None
+    if ignorecase:
+        chars = {v for c in chars for v in (c.lower(), c.upper())}
+    return chars
+
+
+def _screen(parsed, ignorecase):
+    for op, av in parsed:
+        if op in _REPEATS:
+            body = _unwrap(av[2])
+            if _unbounded(av):
+                for i, (item_op, item_av) in enumerate(body):
+                    if item_op not in _REPEATS or not _unbounded(item_av):
+                        continue
+                    rest = sre_parse.SubPattern(
+                        av[2].state, body[:i] + body[i + 1:])
+                    if rest.getwidth()[0] == 0:
+                        yield 'nested quantifier'
+                        break
+                branches = [item_av[1] for item_op, item_av in body
+                            if item_op == sre_parse.BRANCH]
+                for alternatives in branches:
+                    seen = set()
+                    for branch in alternatives:
+                        first = _first_chars(list(branch), ignorecase)
+                        if first is None or first & seen:
+                            yield 'overlapping alternatives in a repeat'
+                            break
+                        seen |= first
+            yield from _screen(av[2], ignorecase)
+        elif op == sre_parse.SUBPATTERN:
+            yield from _screen(av[-1], ignorecase)
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                yield from _screen(branch, ignorecase)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            yield from _screen(av[1], ignorecase)
+
+
+def risky_constructs(pattern):
+    """
+    Return the constructs of the compiled `pattern` known to backtrack
+    catastrophically on some texts, e.g. nested quantifiers like (a+)+ or
+    overlapping alternatives in a repeat like (a|ab)*.
+    """
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return []
+    return sorted(set(_screen(parsed, bool(pattern.flags & re.IGNORECASE))))
+
+
+def lint_rules(data):
+    """Return (rule ID, problem) tuples for the problems of rules `data`."""
+    problems, rule_ids = [], set()
+    for rule in data.get('rules', []):
+        rule_id = rule.get('id')
+        if rule_id is None:
+            problems.append((None, 'missing rule ID'))
+            continue
+        if rule_id in rule_ids:
+            problems.append((rule_id, 'duplicate rule ID'))
+        rule_ids.add(rule_id)
+        try:
+            pattern = re.compile(rule.get('rule', ''))
+        except re.error as e:
+            problems.append((rule_id, 'failed to compile: %s' % e))
+            continue
+        problems.extend((rule_id, r) for r in risky_constructs(pattern))
+    return problems
+
 
 class Cleaner(metaclass=ABCMeta):
 
@@ -15,17 +392,118 @@ class Cleaner(metaclass=ABCMeta):
     def clean(self, title):
         pass
 
+    def clean_many(self, titles):
+        """
+        Clean an iterable of titles, yielding the results in order.
+
+        Identical titles within the batch are cleaned only once.
+        """
+        return self._clean_many(self.clean, titles)
+
+    def confidence(self, result):
+        """Return the confidence, from 0 to 1, in a `result` of clean."""
+        return confidence(result)
+
+    @staticmethod
+    def _clean_many(clean, titles):
+        seen = {}
+        for title in titles:
+            try:
+                yield seen[title]
+            except KeyError:
+                if len(seen) >= CLEAN_MANY_MEMO_SIZE:
+                    # Bounds the memory used by long streams of titles.
+                    seen.clear()
+                result = seen[title] = clean(title)
+                yield result
+
+
+class RuleProfile(object):
+    """
+    Per rule counts of evaluations, matches and substitutions, and the time
+    spent evaluating the rule.
+    """
+
+    def __init__(self):
+        self.titles = 0
+        # rule ID -> [evaluations, matches, substitutions, seconds]
+        self.stats = {}
+
+    def record(self, rule_id, substitutions, seconds):
+        try:
+            stats = self.stats[rule_id]
+        except KeyError:
+            stats = self.stats[rule_id] = [0, 0, 0, 0.0]
+        stats[0] += 1
+        if substitutions:
+            stats[1] += 1
+            stats[2] += substitutions
+        stats[3] += seconds
+
+    def as_dict(self):
+        """Return the profile, with the slowest rules first."""
+        return {
+            'titles': self.titles,
+            'rules': [
+                {
+                    'id': rule_id,
+                    'evaluations': evaluations,
+                    'matches': matches,
+                    'substitutions': substitutions,
+                    'seconds': seconds,
+                }
+                for rule_id, (evaluations, matches, substitutions, seconds)
+                in sorted(self.stats.items(), key=lambda i: -i[1][3])
+            ],
+        }
+
+    def report(self, file=sys.stdout):
+        data = self.as_dict()
+        total = sum(r['seconds'] for r in data['rules'])
+        print('Cleaned {0:d} titles, {1:.1f} ms in rules'.format(
+            data['titles'], total * 1000), file=file)
+        print('{0:<24s} {1:>10s} {2:>9s} {3:>9s} {4:>10s} {5:>6s}'.format(
+            'Rule', 'Evaluated', 'Matched', 'Subs', 'Time (ms)', '%'),
+            file=file)
+        for r in data['rules']:
+            print('{0:<24s} {1:10d} {2:9d} {3:9d} {4:10.2f} {5:6.1f}'.format(
+                r['id'], r['evaluations'], r['matches'], r['substitutions'],
+                r['seconds'] * 1000,
+                r['seconds'] / total * 100 if total else 0), file=file)
+
 
 class RegexCleaner(Cleaner):
     name = 'regex'
 
-    def __init__(self, disabled=None):
+    def __init__(self, disabled=None, optimize=True):
         self.rules = []
+        self.version = None
+        # A `RuleProfile` which, if set, records the work done per rule.
+        self.profile = None
+        # A shared integer which, if set, holds the position of the rule
+        # being evaluated (see `antiseptic.guard`).
+        self.progress = None
         if disabled is None:
             disabled = set()
         self.disabled = disabled
+        # Whether compatible rules are fused, see `fuse_rules`.
+        self.optimize = optimize
+        # Prefilter index: (literal, ignorecase) -> rule positions, plus the
+        # positions of rules without a usable literal.
+        self._index = {}
+        self._unindexed = []
+
+    def load_rules(self, filename, snapshot=True):
+        """
+        Load the rules from the JSON file `filename`.
+
+        If `snapshot` is true, the validated and indexed rules are loaded
+        from a snapshot next to the rules file when it is up to date, and the
+        snapshot is (re)written otherwise.
+        """
+        if snapshot and not self.rules and self.load_snapshot(filename):
+            return
 
-    def load_rules(self, filename):
         rule_ids = set()
 
         with open(filename) as f:
@@ -35,6 +513,7 @@ class RegexCleaner(Cleaner):
                 raise SystemExit('No rules in the rule file')
 
             rules = data.get('rules')
+            self.version = data.get('version')
 
             for rule in rules:
                 if 'id' not in rule:
@@ -53,49 +532,260 @@ class RegexCleaner(Cleaner):
                     except:
                         LOG.warning('Rule: %s failed to compile' % rule['id'])
                     else:
+                        for reason in risky_constructs(p):
+                            LOG.warning('Rule: %s may backtrack '
+                                        'catastrophically (%s)' % (
+                                            rule['id'], reason))
                         rule['pattern'] = p
                         self.rules.append(rule)
                     finally:
                         rule_ids.add(rule['id'])
 
         self.rules = sorted(self.rules, key=lambda x: x.get('weight', 0))
+        if self.optimize:
+            self.rules = fuse_rules(self.rules)
+        self.build_index()
+        if snapshot:
+            self.write_snapshot(filename)
+
+    def _snapshot_header(self, filename):
+        st = os.stat(filename)
+        return {
+            'format': SNAPSHOT_FORMAT,
+            'python': tuple(sys.version_info[:2]),
+            'mtime': st.st_mtime_ns,
+            'size': st.st_size,
+            'disabled': sorted(self.disabled),
+            'optimize': self.optimize,
+        }
+
+    def write_snapshot(self, filename):
+        """Write the loaded rules to the snapshot of the rules `filename`."""
+        data = {
+            'header': self._snapshot_header(filename),
+            'version': self.version,
+            'rules': [
+                {k: v for k, v in rule.items() if k != 'pattern'}
+                for rule in self.rules
+            ],
+            'index': self._index,
+            'unindexed': self._unindexed,
+        }
+        import tempfile
+
+        snapshot_filename = filename + SNAPSHOT_SUFFIX
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(snapshot_filename) or '.',
+                    prefix='.rules-', delete=False) as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, snapshot_filename)
+        except OSError as e:
+            LOG.debug('Failed to write the rules snapshot: %s' % e)
+        else:
+            LOG.debug('Wrote rules snapshot: %s' % snapshot_filename)
+
+    def load_snapshot(self, filename):
+        """
+        Load the rules from the snapshot of the rules `filename`. Returns
+        `False` if there is no snapshot or it is out of date.
+        """
+        snapshot_filename = filename + SNAPSHOT_SUFFIX
+        try:
+            with open(snapshot_filename, 'rb') as f:
+                data = pickle.load(f)
+            header = self._snapshot_header(filename)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            LOG.debug('Failed to load the rules snapshot: %s' % e)
+            return False
+        if data.get('header') != header:
+            LOG.debug('The rules snapshot is out of date')
+            return False
+        # Patterns are compiled lazily, on their first use.
+        self.rules = data['rules']
+        self.version = data['version']
+        self._index = data['index']
+        self._unindexed = data['unindexed']
+        LOG.debug('Loaded %d rules from snapshot: %s' % (
+            len(self.rules), snapshot_filename))
+        return True
+
+    def remove_rules(self, rule_ids):
+        """
+        Disable the rules `rule_ids` of the loaded rules. A fused rule is
+        removed if any of the rules it is made of is.
+        """
+        rule_ids = set(rule_ids)
+        self.disabled |= rule_ids
+        # The index is filtered rather than rebuilt, as the rules loaded from
+        # a snapshot are only compiled when they are first evaluated.
+        positions, rules = {}, []
+        for pos, rule in enumerate(self.rules):
+            if rule_ids.isdisjoint(rule.get('fused', (rule['id'],))):
+                positions[pos] = len(rules)
+                rules.append(rule)
+        self.rules = rules
+        self._unindexed = [positions[p] for p in self._unindexed
+                           if p in positions]
+        index = {}
+        for key, found in self._index.items():
+            found = [positions[p] for p in found if p in positions]
+            if found:
+                index[key] = found
+        self._index = index
+
+    def build_index(self):
+        """
+        Index the loaded rules by the literal substring they require, so that
+        rules which cannot match a title are skipped without being run.
+        """
+        self._index, self._unindexed = {}, []
+        for pos, rule in enumerate(self.rules):
+            pattern = rule['pattern']
+            if 'literals' in rule:
+                literals = set(rule['literals'])
+            else:
+                literals = {required_literal(pattern)}
+            if None in literals:
+                self._unindexed.append(pos)
+                continue
+            ignorecase = bool(pattern.flags & re.IGNORECASE)
+            for literal in literals:
+                if ignorecase:
+                    literal = literal.lower()
+                positions = self._index.setdefault((literal, ignorecase), [])
+                if pos not in positions:
+                    positions.append(pos)
+        LOG.debug('Indexed %d of %d rules by literal' % (
+            len(self.rules) - len(self._unindexed), len(self.rules)))
+
+    def candidates(self, title):
+        """Return the sorted positions of the rules which may match title."""
+        # Case-insensitive matching of non-ASCII text has special cases
+        # (e.g. KELVIN SIGN matches "k"), so such titles skip the
+        # case-insensitive part of the index.
+        folded = title.lower() if _is_ascii(title) else None
+        found = list(self._unindexed)
+        for (literal, ignorecase), positions in self._index.items():
+            if ignorecase:
+                if folded is None or literal in folded:
+                    found.extend(positions)
+            elif literal in title:
+                found.extend(positions)
+        # Fused rules may be found by several of their literals.
+        return sorted(set(found))
 
     def clean(self, title):
-        for rule in self.rules:
-            applied, new_title = RegexCleaner.apply_rule(rule, title)
-            if not applied:
+        return self._clean(title, LOG.isEnabledFor(logging.DEBUG))
+
+    def clean_many(self, titles):
+        # Decide once per batch whether the applied rules are logged.
+        clean = functools.partial(
+            self._clean, log_rules=LOG.isEnabledFor(logging.DEBUG))
+        return self._clean_many(clean, titles)
+
+    def trace(self, title, start=0, stop=None):
+        """
+        Return a (result, rule IDs) tuple for `title`, where the rule IDs are
+        the ones which changed the title, in order. Only the rules from
+        position `start` up to `stop` are applied.
+        """
+        applied = []
+        return self._clean(title, log_rules=False, applied=applied,
+                           start=start, stop=stop), applied
+
+    def _clean(self, title, log_rules=True, applied=None, start=0,
+               stop=None):
+        rules, candidates, profile = self.rules, self.candidates, self.profile
+        progress = self.progress
+        if profile is not None:
+            profile.titles += 1
+        if stop is None:
+            stop = len(rules)
+        positions, i = candidates(title), 0
+        if start or stop < len(rules):
+            positions = [p for p in positions if start <= p < stop]
+        while i < len(positions):
+            pos = positions[i]
+            i += 1
+            rule = rules[pos]
+            if 'pattern' not in rule:
+                rule['pattern'] = re.compile(rule['rule'])
+            if progress is not None:
+                progress.value = pos
+            if profile is None:
+                new_title, n = rule['pattern'].subn(
+                    rule.get('sub', ''), title)
+            else:
+                t0 = time.perf_counter()
+                new_title, n = rule['pattern'].subn(
+                    rule.get('sub', ''), title)
+                profile.record(rule['id'], n, time.perf_counter() - t0)
+            if not n:
                 continue
-            d = ''.join(diff(title, new_title))
-            LOG.debug('Applied rule: {rule_id:s}, diff:\n{diff:s}'.format(
-                      rule_id=rule['id'], diff=d))
-            title = new_title
+            if log_rules:
+                # The diff is only computed if the message is emitted.
+                LOG.debug('Applied rule: %s, diff:\n%s', rule['id'],
+                          LazyDiff(title, new_title))
+            if new_title != title:
+                if applied is not None:
+                    applied.append(rule['id'])
+                # The substitution may have introduced literals required by
+                # the following rules, so pick their candidates again.
+                title = new_title
+                positions = [p for p in candidates(title) if pos < p < stop]
+                i = 0
 
         return title
 
+
+def guessit_available():
+    """Check whether guessit is installed, without importing it."""
+    return importlib.util.find_spec('guessit') is not None
+
+
+class GuessitCleaner(Cleaner):
+    name = 'guessit'
+
+    def __init__(self):
+        from importlib import metadata
+
+        self._guess_movie_info = None
+        # Read from the package metadata, so that guessit is not imported.
+        try:
+            self.version = metadata.version('guessit')
+        except metadata.PackageNotFoundError:
+            self.version = None
+
+    @property
+    def guess_movie_info(self):
+        # guessit has a large dependency tree, so it is only imported once
+        # the cleaner cleans a name.
+        if self._guess_movie_info is None:
+            import guessit
+
+            self._guess_movie_info = guessit.guess_movie_info
+        return self._guess_movie_info
+
+    def clean(self, title):
+        return self._format(title, self.guess_movie_info(title))
+
     @staticmethod
-    def apply_rule(rule, text):
-        m = rule['pattern'].search(text)
-        if m:
-            return True, rule['pattern'].sub(rule.get('sub', ''), text)
-        return False, text
+    def _format(title, guess):
+        if 'title' in guess and 'year' in guess:
+            tpl = '{title:} ({year:})'
+        elif 'title' in guess:
+            tpl = '{title:}'
+        else:
+            LOG.warning('Unable to determine title: {0:}'.format(title))
+            return
+        return tpl.format(**guess)
 
+    def clean_many(self, titles):
+        guess_movie_info = self.guess_movie_info
 
-try:
-    import guessit
-except ImportError:
-    pass
-else:
-    class GuessitCleaner(Cleaner):
-        name = 'guessit'
-
-        def clean(self, title):
-
-            guess = guessit.guess_movie_info(title)
-            if 'title' in guess and 'year' in guess:
-                tpl = '{title:} ({year:})'
-            elif 'title' in guess:
-                tpl = '{title:}'
-            else:
-                LOG.warning('Unable to determine title: {0:}'.format(title))
-                return
-            return tpl.format(**guess)
+        def clean(title):
+            return self._format(title, guess_movie_info(title))
+        return self._clean_many(clean, titles)
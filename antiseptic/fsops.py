@@ -0,0 +1,383 @@
+import contextlib
+import errno
+import itertools
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+DEFAULT_PER_DEVICE = 8
+# Bytes copied per system call when moving a file to another filesystem, and
+# the number of bytes after which the progress of such a copy is logged.
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_PROGRESS_INTERVAL = 1024 ** 3
+# The FICLONE ioctl, which makes the destination share the extents of the
+# source on filesystems supporting reflinks (e.g. btrfs, XFS).
+_FICLONE = 0x40049409
+# Errors of the copy system calls meaning they cannot copy between the given
+# files, so the next method is tried.
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                     errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP}
+# The advisory lock file of a directory, see `directory_lock`.
+LOCK_FILENAME = '.antiseptic.lock'
+# The locks of the directories, between the threads of this process, which
+# share its POSIX locks.
+_directory_locks = defaultdict(threading.Lock)
+_directory_locks_lock = threading.Lock()
+
+
+def _reflink(src_fd, dst_fd):
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def _copy_range(copy, src_fd, dst_fd, size, progress):
+    """
+    Copy `size` bytes with `copy(src_fd, dst_fd, offset, count)`, which
+    returns the number of bytes copied. Returns `False` if `copy` is not
+    supported for the files, or copied nothing before reaching `size` (as
+    happens with some FUSE and procfs files), for the next way to be tried.
+    """
+    copied = 0
+    while copied < size:
+        count = min(COPY_CHUNK_SIZE, size - copied)
+        try:
+            n = copy(src_fd, dst_fd, copied, count)
+        except OSError as e:
+            if copied == 0 and e.errno in _COPY_UNSUPPORTED:
+                return False
+            raise
+        if n == 0:
+            return False
+        copied += n
+        progress(copied)
+    return True
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _read_write(src_fd, dst_fd, offset, count):
+    data = os.pread(src_fd, count, offset)
+    return os.pwrite(dst_fd, data, offset)
+
+
+# The ways of copying data tried in turn, the last one through userspace.
+_COPIES = tuple(copy for available, copy in (
+    (hasattr(os, 'copy_file_range'), _copy_file_range),
+    (hasattr(os, 'sendfile'), _sendfile),
+    (True, _read_write),
+) if available)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _copy_owner(st, dst, fd=None):
+    """
+    Give `dst` (or its open `fd`) the owner and group of the stat result
+    `st`, if this process may.
+    """
+    try:
+        if fd is not None:
+            os.fchown(fd, st.st_uid, st.st_gid)
+        else:
+            os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        LOG.debug('Not keeping the owner of {0:s}'.format(dst))
+
+
+def copy_file(src, dst):
+    """
+    Copy the file `src` to the new file `dst`, with its metadata (including
+    its owner and group, if permitted), and fsync it. The data is cloned if
+    the filesystem supports reflinks, otherwise it is copied in the kernel
+    (with `copy_file_range` or `sendfile`) where possible. The progress of
+    large copies is logged.
+    """
+    import shutil
+
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        _copy_owner(os.lstat(src), dst)
+        return
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        st = os.fstat(src_fd)
+        size = st.st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            logged = [0]
+
+            def progress(copied):
+                if copied - logged[0] >= COPY_PROGRESS_INTERVAL:
+                    logged[0] = copied
+                    LOG.info('Copied {0:d} of {1:d} MiB of {2:s}'.format(
+                        copied // 1024 ** 2, size // 1024 ** 2, src))
+
+            if not _reflink(src_fd, dst_fd):
+                for copy in _COPIES:
+                    if _copy_range(copy, src_fd, dst_fd, size, progress):
+                        break
+            copied = os.fstat(dst_fd).st_size
+            if copied != size:
+                raise OSError(errno.EIO, 'Copied {0:d} of {1:d} bytes'.format(
+                    copied, size), dst)
+            # Before the mode is copied, as chown clears setuid bits.
+            _copy_owner(st, dst, fd=dst_fd)
+            shutil.copystat(src, dst)
+            os.fsync(dst_fd)
+        except BaseException:
+            os.close(dst_fd)
+            os.unlink(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    _fsync_dir(os.path.dirname(dst) or '.')
+
+
+def copy_tree(src, dst):
+    """Copy the directory `src` to the new directory `dst`, see `copy_file`."""
+    import shutil
+
+    os.mkdir(dst)
+    try:
+        with os.scandir(src) as it:
+            entries = list(it)
+        for entry in entries:
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                copy_tree(entry.path, target)
+            else:
+                copy_file(entry.path, target)
+        _copy_owner(os.stat(src), dst)
+        shutil.copystat(src, dst)
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+
+def move(src, dst):
+    """
+    Rename `src` to `dst`. Across filesystems, where renaming fails, `src` is
+    copied (see `copy_file` and `copy_tree`) and only removed once the copy
+    is complete and synced.
+    """
+    try:
+        metrics.timed('antiseptic_fs_op_seconds', os.rename, src, dst,
+                      op='rename')
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    import shutil
+
+    if os.path.lexists(dst):
+        raise FileExistsError('Target already exists: {0:s}'.format(dst))
+    LOG.info('Copying {0:s} to {1:s} on another filesystem'.format(src, dst))
+    if os.path.isdir(src) and not os.path.islink(src):
+        metrics.timed('antiseptic_fs_op_seconds', copy_tree, src, dst,
+                      op='copy')
+        shutil.rmtree(src)
+    else:
+        metrics.timed('antiseptic_fs_op_seconds', copy_file, src, dst,
+                      op='copy')
+        os.unlink(src)
+
+
+def _thread_lock(directory):
+    """Return the lock of `directory` among the threads of this process."""
+    with _directory_locks_lock:
+        return _directory_locks[directory]
+
+
+@contextlib.contextmanager
+def directory_lock(directory):
+    """
+    Hold the advisory lock of `directory`, so that the processes sharing a
+    library, on this or other nodes, don't move entries into it at once.
+
+    The lock file is left in place, as removing it would race with the
+    processes waiting for it.
+    """
+    import fcntl
+
+    with _thread_lock(directory):
+        fd = os.open(os.path.join(directory, LOCK_FILENAME),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Unlike flock, lockf locks work on NFS.
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+
+def rename(path, new_name, lock=False):
+    """
+    Rename `path` to `new_name` in the same directory. The target is checked
+    and the entry renamed under the lock of the directory among the threads
+    (see `FSExecutor`) or, with `lock`, also the other processes.
+    """
+    base, _ = os.path.split(path)
+    if lock:
+        with directory_lock(base or '.'):
+            return _rename(path, new_name)
+    with _thread_lock(base or '.'):
+        return _rename(path, new_name)
+
+
+def _rename(path, new_name):
+    base, _ = os.path.split(path)
+    new_path = os.path.join(base, new_name)
+    if new_path == path:
+        LOG.info('The name is already clean.')
+        return
+    if os.path.lexists(new_path):
+        raise FileExistsError(
+            'Target already exists: {0:s}'.format(new_path))
+    LOG.debug('Renaming: {path:s} to {new_path:s}'.format(
+        path=path, new_path=new_path))
+    move(path, new_path)
+    LOG.info('Renamed successfully.')
+
+
+def wrap(path, dir_name, companions=(), lock=False, into=None):
+    """
+    Move `path`, and its `companions` from the same directory, into a new
+    directory `dir_name` next to it, or in the directory `into`, which may
+    be on another filesystem (see `move`). With `lock`, the directory the
+    new directory is created in is locked meanwhile.
+    """
+    base, _ = os.path.split(path)
+    if into is not None:
+        base = into
+    if lock:
+        with directory_lock(base or '.'):
+            return wrap(path, dir_name, companions=companions, into=into)
+    new_dir_path = os.path.join(base, dir_name)
+    LOG.debug('Creating a new directory: {0:s}'.format(new_dir_path))
+    metrics.timed('antiseptic_fs_op_seconds', os.mkdir, new_dir_path,
+                  op='mkdir')
+    for p in itertools.chain([path], companions):
+        new_file_path = os.path.join(new_dir_path, os.path.basename(p))
+        LOG.debug('Moving: {path:s} to {new_file_path:s}'.format(
+            path=p, new_file_path=new_file_path))
+        move(p, new_file_path)
+    LOG.info('Wraped successfully.')
+
+
+class FSExecutor(object):
+    """
+    Runs filesystem operations in a thread pool, so that the latency of
+    network filesystems is overlapped.
+
+    At most `per_device` operations run concurrently on each device (by
+    `st_dev` of the source's directory). An operation on a path waits for
+    the pending operations below that path, e.g. the renames inside a
+    directory complete before the directory itself is renamed. Operations
+    which depend on each other, like the mkdir and the move of a wrap, are
+    submitted together as one function.
+    """
+
+    def __init__(self, max_workers, per_device=DEFAULT_PER_DEVICE):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.per_device = per_device
+        self.done = 0
+        self.failed = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._semaphores = {}
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def _semaphore(self, path):
+        parent = os.path.dirname(path)
+        try:
+            dev = self._devices[parent]
+        except KeyError:
+            try:
+                dev = os.stat(parent or '.').st_dev
+            except OSError:
+                dev = None
+            self._devices[parent] = dev
+        try:
+            return self._semaphores[dev]
+        except KeyError:
+            sem = threading.BoundedSemaphore(self.per_device)
+            return self._semaphores.setdefault(dev, sem)
+
+    def _wait_below(self, path):
+        prefix = os.path.join(path, '')
+        with self._lock:
+            pending = [f for p, f in self._pending.items()
+                       if p.startswith(prefix)]
+        for f in pending:
+            f.exception()
+
+    def submit(self, path, fn, *args, **kwargs):
+        """
+        Schedule `fn(*args, **kwargs)`, an operation on `path`. Returns a
+        `concurrent.futures.Future`. Failures are logged and counted.
+        """
+        self._wait_below(path)
+        sem = self._semaphore(path)
+        # Blocks the submitter while the device is saturated.
+        sem.acquire()
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            sem.release()
+            raise
+        with self._lock:
+            self._pending[path] = future
+
+        def done(f):
+            sem.release()
+            with self._lock:
+                if self._pending.get(path) is f:
+                    del self._pending[path]
+                if f.exception() is None:
+                    self.done += 1
+                else:
+                    self.failed += 1
+            if f.exception() is not None:
+                LOG.error('{0:s}: {1!s}'.format(path, f.exception()))
+
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,129 @@
+import itertools
+import logging
+import multiprocessing
+
+from .cleaner import CLEAN_MANY_MEMO_SIZE, Cleaner
+
+LOG = logging.getLogger(__name__)
+# Number of titles sent to the worker process at once.
+GUARD_CHUNK_SIZE = 256
+
+
+def _serve(cleaner, conn, progress):
+    """Clean the titles received over `conn` until `None` is received."""
+    cleaner.progress = progress
+    conn.send(True)
+    while True:
+        titles = conn.recv()
+        if titles is None:
+            break
+        for title in titles:
+            progress.value = -1
+            conn.send(cleaner.clean(title))
+
+
+class GuardedCleaner(Cleaner):
+    """
+    Wraps a `RegexCleaner`, cleaning the titles in a worker process which
+    has `timeout` seconds per title.
+
+    When a title runs out of time, the worker is killed, the rule it was
+    evaluating is quarantined (disabled for the rest of the run) and the
+    title is cleaned again by a new worker without it.
+    """
+
+    def __init__(self, cleaner, timeout):
+        self.cleaner = cleaner
+        self.timeout = timeout
+        self.name = cleaner.name
+        self.version = cleaner.version
+        self.disabled = cleaner.disabled
+        self.quarantined = []
+        self._process = self._conn = self._progress = None
+
+    def _start(self):
+        ctx = multiprocessing.get_context()
+        self._conn, child_conn = ctx.Pipe()
+        self._progress = ctx.RawValue('i', -1)
+        self._process = ctx.Process(
+            target=_serve, args=(self.cleaner, child_conn, self._progress),
+            daemon=True)
+        self._process.start()
+        child_conn.close()
+        # The time budget starts once the worker is ready.
+        self._conn.recv()
+
+    def _kill(self):
+        self._process.kill()
+        self._process.join()
+        self._conn.close()
+        self._process = self._conn = self._progress = None
+
+    def close(self):
+        if self._process is None:
+            return
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join(self.timeout)
+        if self._process.is_alive():
+            self._kill()
+        else:
+            self._conn.close()
+            self._process = self._conn = self._progress = None
+
+    def _quarantine(self, title):
+        """
+        Quarantine the rule the worker spent too long on for `title`, and
+        return whether there was one.
+        """
+        pos = self._progress.value
+        self._kill()
+        if pos < 0:
+            LOG.warning('Cleaning "%s" timed out, leaving it as is' % title)
+            return False
+        rule = self.cleaner.rules[pos]
+        rule_ids = rule.get('fused', [rule['id']])
+        LOG.warning(
+            'Rule: %s took more than %gs on "%s", quarantined it for this '
+            'run. Add it to disabled_rules in the config to disable it for '
+            'good.' % (rule['id'], self.timeout, title))
+        self.cleaner.remove_rules(rule_ids)
+        self.quarantined.extend(rule_ids)
+        return True
+
+    def _clean_chunk(self, titles):
+        results, sent = [], False
+        while len(results) < len(titles):
+            if self._process is None:
+                self._start()
+                sent = False
+            if not sent:
+                self._conn.send(titles[len(results):])
+                sent = True
+            if self._conn.poll(self.timeout):
+                results.append(self._conn.recv())
+                continue
+            title = titles[len(results)]
+            if not self._quarantine(title):
+                results.append(title)
+        return results
+
+    def clean(self, title):
+        return self._clean_chunk([title])[0]
+
+    def clean_many(self, titles):
+        titles, seen = iter(titles), {}
+        while True:
+            chunk = list(itertools.islice(titles, GUARD_CHUNK_SIZE))
+            if not chunk:
+                break
+            if len(seen) >= CLEAN_MANY_MEMO_SIZE:
+                # Bounds the memory used by long streams of titles.
+                seen.clear()
+            # Identical titles are sent to the worker once, in one batch.
+            new = list(dict.fromkeys(t for t in chunk if t not in seen))
+            seen.update(zip(new, self._clean_chunk(new)))
+            for title in chunk:
+                yield seen[title]
@@ -0,0 +1,153 @@
+import itertools
+import json
+import logging
+import os
+from collections import OrderedDict, deque
+
+LOG = logging.getLogger(__name__)
+# Number of distinct names cleaned per task, and tasks in flight per worker.
+IMPACT_CHUNK_SIZE = 1024
+IMPACT_PENDING_PER_WORKER = 4
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+# The (old, new) cleaners of a worker process, see `_init_worker`.
+_worker_cleaners = None
+
+
+def changed_rules(old_data, new_data):
+    """Return {rule ID: "added", "removed" or "modified"} of two rule sets."""
+    old = {r.get('id'): r for r in old_data.get('rules', [])}
+    new = {r.get('id'): r for r in new_data.get('rules', [])}
+    changes = {}
+    for rule_id in old.keys() | new.keys():
+        if rule_id not in new:
+            changes[rule_id] = REMOVED
+        elif rule_id not in old:
+            changes[rule_id] = ADDED
+        elif old[rule_id] != new[rule_id]:
+            changes[rule_id] = MODIFIED
+    return changes
+
+
+def load_cleaner(filename, disabled=()):
+    """
+    Return a `RegexCleaner` with the rules of `filename`. The rules are not
+    fused, so that each change is traced to the rules causing it.
+    """
+    from .cleaner import RegexCleaner
+
+    c = RegexCleaner(disabled=set(disabled), optimize=False)
+    c.load_rules(filename, snapshot=False)
+    return c
+
+
+def _init_worker(old_filename, new_filename, disabled):
+    global _worker_cleaners
+
+    _worker_cleaners = (load_cleaner(old_filename, disabled),
+                        load_cleaner(new_filename, disabled))
+
+
+def _trace_in_worker(names, changes):
+    return trace_changes(_worker_cleaners, names, changes)
+
+
+def common_prefix(old, new):
+    """
+    Return the number of leading rules the `old` and `new` cleaners share,
+    which clean a name the same way under both rule sets.
+    """
+    n = 0
+    for a, b in zip(old.rules, new.rules):
+        if any(a.get(k) != b.get(k) for k in ('id', 'rule', 'sub')):
+            break
+        n += 1
+    return n
+
+
+def trace_changes(cleaners, names, changes):
+    """
+    Clean `names` with the (old, new) `cleaners`, and return a change record
+    for each name whose result differs. The rules of a record are the ones
+    which only changed the name under one of the rule sets, or which were
+    changed themselves (see `changed_rules`), in the order they applied.
+
+    The rules both rule sets start with are only applied once.
+    """
+    old, new = cleaners
+    shared = common_prefix(old, new)
+    records = []
+    for name in names:
+        cleaned, applied = old.trace(name, stop=shared)
+        old_name, old_applied = old.trace(cleaned, start=shared)
+        new_name, new_applied = new.trace(cleaned, start=shared)
+        if old_name == new_name:
+            continue
+        old_set, new_set = set(old_applied), set(new_applied)
+        rules = [r for r in OrderedDict.fromkeys(old_applied + new_applied)
+                 if r in changes or (r in old_set) != (r in new_set)]
+        records.append({'name': name, 'old': old_name, 'new': new_name,
+                        'rules': rules})
+    return records
+
+
+def rule_impact(old_filename, new_filename, names, counts, jobs=1,
+                disabled=()):
+    """
+    Yield a change record (see `trace_changes`) for each distinct name of
+    `names` which the rules of `new_filename` clean differently from the
+    rules of `old_filename`. The "total" and "distinct" names are counted
+    in `counts`.
+
+    Each distinct name is cleaned once, under both rule sets together. With
+    more than one of `jobs` (0 for one per CPU), the names are cleaned in a
+    process pool, a bounded number of chunks ahead.
+    """
+    with open(old_filename) as f:
+        old_data = json.load(f)
+    with open(new_filename) as f:
+        new_data = json.load(f)
+    changes = changed_rules(old_data, new_data)
+    LOG.debug('Changed rules: %s' % ', '.join(
+        '%s (%s)' % i for i in sorted(changes.items())))
+
+    seen = set()
+
+    def distinct(names):
+        for name in names:
+            counts['total'] += 1
+            if name not in seen:
+                seen.add(name)
+                counts['distinct'] += 1
+                yield name
+
+    names = distinct(names)
+    if jobs == 1:
+        cleaners = (load_cleaner(old_filename, disabled),
+                    load_cleaner(new_filename, disabled))
+        while True:
+            chunk = list(itertools.islice(names, IMPACT_CHUNK_SIZE))
+            if not chunk:
+                break
+            yield from trace_changes(cleaners, chunk, changes)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(old_filename, new_filename, disabled)) as pool:
+        max_pending = workers * IMPACT_PENDING_PER_WORKER
+        pending = deque()
+        while True:
+            chunk = list(itertools.islice(names, IMPACT_CHUNK_SIZE))
+            if chunk:
+                pending.append(pool.submit(_trace_in_worker, chunk, changes))
+            if pending and (not chunk or len(pending) >= max_pending):
+                yield from pending.popleft().result()
+            elif not chunk:
+                break
@@ -0,0 +1,266 @@
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from .utils import close_cleaners
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Metric name -> (type, help). Counters are named as exposed, with the
+# "_total" suffix, which node_exporter's textfile collector expects.
+METRICS = {
+    'antiseptic_entries_scanned_total': (
+        'counter', 'Entries selected for cleaning.'),
+    'antiseptic_entries_cleaned_total': (
+        'counter', 'Entries whose names were cleaned.'),
+    'antiseptic_entries_renamed_total': (
+        'counter', 'Entries renamed or wrapped, by action.'),
+    'antiseptic_entries_skipped_total': (
+        'counter', 'Entries left as they were, by reason.'),
+    'antiseptic_entries_failed_total': (
+        'counter', 'Entries which failed to be renamed or wrapped.'),
+    'antiseptic_clean_seconds': (
+        'histogram', 'Time spent cleaning a name, by cleaner.'),
+    'antiseptic_fs_op_seconds': (
+        'histogram', 'Time spent in filesystem operations, by operation.'),
+    'antiseptic_rules_load_seconds': (
+        'gauge', 'Time spent loading the rules.'),
+    'antiseptic_update_download_seconds': (
+        'gauge', 'Time spent downloading the rules.'),
+    'antiseptic_last_run_timestamp_seconds': (
+        'gauge', 'Time the metrics were last written.'),
+}
+
+# The `Metrics` of the current run, if they are recorded (see `recording`).
+# Code on hot paths checks it is set before doing any work for it.
+current = None
+
+
+def _format_labels(labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for k, v in labels)
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of a run, see `METRICS`, written to
+    `filename` in the Prometheus text format.
+    """
+
+    def __init__(self, filename, buckets=LATENCY_BUCKETS):
+        self.filename = filename
+        self.buckets = buckets
+        # (name, labels) -> value, or [bucket counts, sum, count]
+        self.values = {}
+        # Filesystem operations may run in several threads.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        if name not in METRICS:
+            raise ValueError('Unknown metric: %s' % name)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, n=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                histogram = self.values[key]
+            except KeyError:
+                histogram = self.values[key] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe (or, for a gauge, set) the time spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if METRICS[name][0] == 'gauge':
+                self.set(name, elapsed, **labels)
+            else:
+                self.observe(name, elapsed, **labels)
+
+    def format(self):
+        with self._lock:
+            values = {k: (v if not isinstance(v, list) else
+                          [list(v[0])] + v[1:])
+                      for k, v in self.values.items()}
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            samples = sorted((labels, value)
+                             for (n, labels), value in values.items()
+                             if n == name)
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (
+                        name, _format_labels(labels), _format_value(value)))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, [('le', repr(bound))]),
+                        cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels), _format_value(total)))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), count))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Atomically replace the metrics file, so that a scraper never reads
+        a partly written one.
+        """
+        import tempfile
+
+        self.set('antiseptic_last_run_timestamp_seconds', time.time())
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(self.filename) or '.',
+                prefix='.metrics-', delete=False) as f:
+            f.write(self.format())
+        # Readable by the scraper, which may run as another user.
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, self.filename)
+
+
+@contextlib.contextmanager
+def recording(filename):
+    """Record the metrics of the block, and write them to `filename`."""
+    global current
+
+    current = Metrics(filename)
+    try:
+        yield current
+    finally:
+        try:
+            current.write()
+        except OSError as e:
+            LOG.warning('Failed to write the metrics: %s' % e)
+        finally:
+            current = None
+
+
+def counted(items, metrics, name, **labels):
+    """Yield `items`, counting them in the counter `name` of `metrics`."""
+    for item in items:
+        metrics.inc(name, **labels)
+        yield item
+
+
+def timing(name, **labels):
+    """Return `Metrics.timer` if the metrics are recorded, else a no-op."""
+    if current is None:
+        return contextlib.nullcontext()
+    return current.timer(name, **labels)
+
+
+def timed(name, func, *args, **labels):
+    """Call `func` with `args`, timing it if the metrics are recorded."""
+    if current is None:
+        return func(*args)
+    with current.timer(name, **labels):
+        return func(*args)
+
+
+class TimedCleaner(object):
+    """
+    Wraps a cleaner, observing the time it spends on each name. Wrapped by
+    a `CachedCleaner`, only the names which are not cached are timed.
+
+    It is not a `Cleaner` subclass, so that the filesystem operations can
+    be timed without importing the cleaners.
+    """
+
+    def __init__(self, cleaner, metrics):
+        self.cleaner = cleaner
+        self.metrics = metrics
+        self.name = cleaner.name
+        self.version = getattr(cleaner, 'version', None)
+        self.disabled = getattr(cleaner, 'disabled', None)
+
+    def confidence(self, result):
+        return self.cleaner.confidence(result)
+
+    def close(self):
+        close_cleaners([self.cleaner])
+
+    def clean(self, title):
+        with self.metrics.timer('antiseptic_clean_seconds', cleaner=self.name):
+            return self.cleaner.clean(title)
+
+    def clean_many(self, titles):
+        # The wrapped cleaner may pull the titles lazily, from a generator
+        # which walks the filesystem, so the time spent in the generator is
+        # not counted.
+        waiting = [0.0]
+        perf_counter = time.perf_counter
+
+        def timed_titles():
+            titles_iter = iter(titles)
+            while True:
+                start = perf_counter()
+                try:
+                    title = next(titles_iter)
+                except StopIteration:
+                    return
+                waiting[0] += perf_counter() - start
+                yield title
+
+        results = iter(self.cleaner.clean_many(timed_titles()))
+        observe = self.metrics.observe
+        while True:
+            start, waiting[0] = perf_counter(), 0.0
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+            observe('antiseptic_clean_seconds',
+                    perf_counter() - start - waiting[0], cleaner=self.name)
+            yield result
@@ -0,0 +1,324 @@
+import functools
+import json
+import logging
+import os
+from collections import Counter, deque
+
+from .fsops import directory_lock, move
+
+LOG = logging.getLogger(__name__)
+# Journal records are written and fsynced once per this many operations.
+DEFAULT_BATCH_SIZE = 100
+
+OK = 'ok'
+NOOP = 'noop'
+COLLISION = 'collision'
+EXISTS = 'exists'
+UNCLEAN = 'unclean'
+
+DONE = 'done'
+FAILED = 'failed'
+UNDONE = 'undone'
+
+
+class TargetIndex(object):
+    """
+    Detects no-op entries and entries whose targets collide, with each other
+    or with existing files, while a plan is built.
+    """
+
+    def __init__(self):
+        self._targets = {}
+
+    def check(self, source, target):
+        """Return the status of moving `source` to `target`."""
+        if target == source:
+            return NOOP
+        if target in self._targets:
+            LOG.warning('{0:s} collides with {1:s}'.format(
+                source, self._targets[target]))
+            return COLLISION
+        if os.path.lexists(target):
+            return EXISTS
+        self._targets[target] = source
+        return OK
+
+
+def plan_entry(path, new_name, cleaner, index, action='rename',
+               companions=(), shard=None, into=None):
+    """
+    Return the plan entry for moving `path` to `new_name`. The `companions`
+    of a wrapped file are moved into the same directory, which is created
+    next to the file, or in the directory `into`.
+
+    The entry of a (K, N) `shard` of a library is executed under the lock
+    of its directory, as the other shards may move entries there too.
+    """
+    source = os.path.normpath(path)
+    base, old_name = os.path.split(source)
+    entry = {
+        'action': action,
+        'source': source,
+        'cleaner': cleaner,
+    }
+    if shard is not None:
+        entry['shard'] = '%d/%d' % shard
+    if not new_name:
+        entry.update(target=None, status=UNCLEAN)
+        return entry
+    if action == 'rename':
+        entry['target'] = os.path.join(base, new_name)
+    else:
+        entry['directory'] = os.path.join(into or base, new_name)
+        entry['target'] = os.path.join(entry['directory'], old_name)
+    entry['status'] = index.check(source, entry['target'])
+    if companions:
+        entry['companions'] = []
+        for companion in companions:
+            companion = os.path.normpath(companion)
+            target = os.path.join(entry['directory'],
+                                  os.path.basename(companion))
+            status = index.check(companion, target)
+            if entry['status'] == OK:
+                entry['status'] = status
+            entry['companions'].append(
+                {'source': companion, 'target': target})
+    return entry
+
+
+def write_jsonl(records, f):
+    for record in records:
+        f.write(json.dumps(record, sort_keys=True))
+        f.write('\n')
+
+
+def read_jsonl(filename):
+    with open(filename) as f:
+        for lineno, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A crash may leave a partially written last line.
+                LOG.warning('Skipping invalid line {0:d} of {1:s}'.format(
+                    lineno, filename))
+
+
+def execute(entry):
+    """
+    Perform the move of a plan `entry`. Returns whether the target directory
+    of a wrap was created.
+    """
+    if entry.get('shard'):
+        # The directory the entry is renamed, or wrapped, in.
+        parent = os.path.dirname(entry.get('directory') or entry['source'])
+        with directory_lock(parent or '.'):
+            return _execute(entry)
+    return _execute(entry)
+
+
+def _execute(entry):
+    created_dir = False
+    if entry['action'] == 'wrap' and not os.path.isdir(entry['directory']):
+        LOG.debug('Creating a new directory: {0:s}'.format(
+            entry['directory']))
+        os.mkdir(entry['directory'])
+        created_dir = True
+    if os.path.lexists(entry['target']):
+        raise FileExistsError(
+            'Target already exists: {0:s}'.format(entry['target']))
+    LOG.debug('Moving: {0:s} to {1:s}'.format(
+        entry['source'], entry['target']))
+    move(entry['source'], entry['target'])
+    for companion in entry.get('companions', ()):
+        LOG.debug('Moving: {0:s} to {1:s}'.format(
+            companion['source'], companion['target']))
+        move(companion['source'], companion['target'])
+    return created_dir
+
+
+class Journal(object):
+    """
+    An append-only JSONL record of the executed plan entries. Records are
+    buffered and fsynced once per batch.
+    """
+
+    def __init__(self, filename, batch_size=DEFAULT_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._buffer = []
+        self._f = open(filename, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        write_jsonl(self._buffer, self._f)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+
+def journaled(journal_filename):
+    """
+    Return {plan sequence number: last record} of an existing journal, e.g.
+    "undone" for an entry moved and then moved back by `undo`.
+    """
+    if not os.path.exists(journal_filename):
+        return {}
+    return {r['seq']: r for r in read_jsonl(journal_filename)}
+
+
+def apply_plan(entries, journal_filename, batch_size=DEFAULT_BATCH_SIZE,
+               executor=None):
+    """
+    Execute the `entries` of a plan, recording them in the journal. Entries
+    already done according to the journal are skipped, so an interrupted run
+    can be resumed (and failed moves retried) by applying the same plan with
+    the same journal. Returns the counts of the outcomes.
+
+    If an `fsops.FSExecutor` is given, the moves run concurrently, and are
+    journaled in plan order as they complete.
+    """
+    done = {seq for seq, r in journaled(journal_filename).items()
+            if r['status'] == DONE}
+    counts = Counter()
+    in_flight = deque()
+
+    def finish(record, result):
+        try:
+            record['created_dir'] = result()
+        except OSError as e:
+            LOG.error('Failed to move {0:s}: {1!s}'.format(
+                record['source'], e))
+            record.update(status=FAILED, error=str(e))
+        else:
+            record['status'] = DONE
+        counts[record['status']] += 1
+        journal.append(record)
+
+    with Journal(journal_filename, batch_size=batch_size) as journal:
+        for seq, entry in enumerate(entries):
+            if entry.get('status') != OK:
+                counts[entry.get('status')] += 1
+                continue
+            if seq in done:
+                counts['resumed'] += 1
+                continue
+
+            record = {
+                'seq': seq,
+                'action': entry['action'],
+                'source': entry['source'],
+                'target': entry['target'],
+                'directory': entry.get('directory'),
+                'companions': entry.get('companions', []),
+                'created_dir': False,
+            }
+            if not os.path.lexists(entry['source']) and \
+                    os.path.lexists(entry['target']):
+                # Moved before a crash, but not journaled.
+                LOG.info('Already moved: {0:s}'.format(entry['source']))
+                record['status'] = DONE
+                counts[DONE] += 1
+                journal.append(record)
+            elif executor is None:
+                finish(record, functools.partial(execute, entry))
+            else:
+                future = executor.submit(entry['source'], execute, entry)
+                in_flight.append((record, future))
+                while in_flight and (len(in_flight) > batch_size or
+                                     in_flight[0][1].done()):
+                    record, future = in_flight.popleft()
+                    finish(record, future.result)
+        while in_flight:
+            record, future = in_flight.popleft()
+            finish(record, future.result)
+    return counts
+
+
+def merge(filenames):
+    """
+    Yield the records of the plans or journals `filenames`, e.g. of the
+    shards of a library, as those of one plan. Only the last record of each
+    entry of a journal is kept. Entries of different files moving to the
+    same target collide, and only the first one is left as planned.
+    """
+    targets = {}
+    for filename in filenames:
+        records = list(read_jsonl(filename))
+        if records and all('seq' in r for r in records):
+            # A resumed run journals the entries it retried again.
+            records = list({r['seq']: r for r in records}.values())
+        for record in records:
+            target = record.get('target')
+            if record.get('status') in (OK, DONE) and target is not None:
+                other = targets.setdefault(target, filename)
+                if other != filename and record['status'] == OK:
+                    LOG.warning('{0:s} of {1:s} collides with an entry of '
+                                '{2:s}'.format(record['source'], filename,
+                                               other))
+                    record['status'] = COLLISION
+            yield record
+
+
+def undo(journal_filename, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Reverse the moves recorded in a journal, newest first. The reversed
+    moves are journaled as "undone", so that applying the plan again with
+    the same journal moves the entries again.
+    """
+    counts = Counter()
+    records = sorted((r for r in journaled(journal_filename).values()
+                      if r.get('status') == DONE), key=lambda r: r['seq'])
+    with Journal(journal_filename, batch_size=batch_size) as journal:
+        for record in reversed(records):
+            if _undo(record, counts):
+                journal.append(dict(record, status=UNDONE))
+    return counts
+
+
+def _undo(record, counts):
+    """Reverse the move of a journal `record`, and return whether it was."""
+    source, target = record['source'], record['target']
+    if os.path.lexists(source) and not os.path.lexists(target):
+        counts['skipped'] += 1
+        return True
+    try:
+        if os.path.lexists(source):
+            raise FileExistsError(
+                'Source already exists: {0:s}'.format(source))
+        for companion in record.get('companions') or ():
+            if os.path.lexists(companion['target']) and \
+                    not os.path.lexists(companion['source']):
+                move(companion['target'], companion['source'])
+        LOG.debug('Moving: {0:s} back to {1:s}'.format(target, source))
+        move(target, source)
+        if record.get('created_dir'):
+            try:
+                os.rmdir(record['directory'])
+            except OSError:
+                LOG.warning('Not removing non-empty directory: '
+                            '{0:s}'.format(record['directory']))
+    except OSError as e:
+        LOG.error('Failed to undo the move of {0:s}: {1!s}'.format(
+            source, e))
+        counts[FAILED] += 1
+        return False
+    counts[UNDONE] += 1
+    return True
@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+from collections import Counter
+
+LOG = logging.getLogger(__name__)
+
+REPORT_FORMATS = ('json', 'jsonl', 'csv', 'table')
+# Number of records written to the output at once.
+REPORT_BATCH_SIZE = 256
+CSV_COLUMNS = ('action', 'status', 'source', 'target', 'cleaner')
+
+# The summary count each entry status is part of.
+SUMMARY = {
+    'ok': 'changed',
+    'done': 'changed',
+    'noop': 'unchanged',
+    'collision': 'collisions',
+    'exists': 'collisions',
+    'unclean': 'failed',
+    'failed': 'failed',
+}
+
+
+class Report(object):
+    """
+    Writes the records of a run, one per entry, to `file` in one of the
+    `REPORT_FORMATS`, and counts them by status.
+
+    The records are written in batches, except for the "json" format, in
+    which the records and the summary are written as one document when the
+    report is closed.
+    """
+
+    def __init__(self, fmt, file, batch_size=REPORT_BATCH_SIZE):
+        if fmt not in REPORT_FORMATS:
+            raise ValueError('Unknown report format: %s' % fmt)
+        self.fmt = fmt
+        self.file = file
+        self.batch_size = batch_size
+        self.counts = Counter()
+        self._records = []
+        self._batch = []
+        if fmt == 'csv':
+            self._batch.append(self._csv_row(CSV_COLUMNS))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _csv_row(values):
+        import csv
+        import io
+
+        buf = io.StringIO()
+        csv.writer(buf).writerow(values)
+        return buf.getvalue()
+
+    def _format(self, record):
+        if self.fmt == 'jsonl':
+            return json.dumps(record, sort_keys=True) + '\n'
+        if self.fmt == 'csv':
+            return self._csv_row([
+                '' if record.get(c) is None else record[c]
+                for c in CSV_COLUMNS])
+        target = record.get('target')
+        return '{0:<10s} {1:s} -> {2:s}\n'.format(
+            record['status'], os.path.basename(record['source']),
+            target and os.path.relpath(
+                target, os.path.dirname(record['source'])) or '-')
+
+    def add(self, record):
+        self.counts[record['status']] += 1
+        if self.fmt == 'json':
+            self._records.append(record)
+            return
+        self._batch.append(self._format(record))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.file.write(''.join(self._batch))
+            self._batch = []
+        self.file.flush()
+
+    def summary(self):
+        """Return the counts of changed, unchanged, colliding and failed."""
+        summary = Counter(changed=0, unchanged=0, collisions=0, failed=0)
+        for status, n in self.counts.items():
+            summary[SUMMARY.get(status, status)] += n
+        return dict(summary)
+
+    def close(self):
+        if self.fmt == 'json':
+            json.dump({'entries': self._records, 'summary': self.summary()},
+                      self.file, indent=2, sort_keys=True)
+            self.file.write('\n')
+        elif self.fmt == 'table':
+            self._batch.append('\n' + ', '.join(
+                '{0:d} {1:s}'.format(n, name)
+                for name, n in self.summary().items()) + '\n')
+        self.flush()
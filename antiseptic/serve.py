@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+
+from .utils import close_cleaners
+
+LOG = logging.getLogger(__name__)
+# Seconds between the checks whether the rules file changed.
+RELOAD_INTERVAL = 1.0
+# Longest accepted request line (or HTTP body), in bytes.
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+class CleaningService(object):
+    """
+    Keeps the cleaners set up by `load_cleaners()` warm, and sets them up
+    again when the rules file `rules_filename` changes.
+    """
+
+    def __init__(self, load_cleaners, rules_filename=None,
+                 reload_interval=RELOAD_INTERVAL):
+        self.load_cleaners = load_cleaners
+        self.rules_filename = rules_filename
+        self.reload_interval = reload_interval
+        self.requests = 0
+        self.cleaners = load_cleaners()
+        self._rules_stat = self._stat()
+        self._next_check = time.monotonic() + reload_interval
+
+    def _stat(self):
+        if self.rules_filename is None:
+            return None
+        try:
+            st = os.stat(self.rules_filename)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        rules_stat = self._stat()
+        if rules_stat == self._rules_stat:
+            return
+        self._rules_stat = rules_stat
+        try:
+            cleaners = self.load_cleaners()
+        except (Exception, SystemExit) as e:
+            LOG.error('Failed to reload the rules, keeping the old ones: '
+                      '%s' % e)
+            return
+        # Requests are handled one at a time, so the old cleaners are idle.
+        close_cleaners(self.cleaners)
+        self.cleaners = cleaners
+        LOG.info('Reloaded the rules.')
+
+    def close(self):
+        close_cleaners(self.cleaners)
+
+    def versions(self):
+        return {c.name: getattr(c, 'version', None) for c in self.cleaners}
+
+    def handle(self, request):
+        """Return the response to a decoded request."""
+        self.requests += 1
+        if not isinstance(request, dict) or \
+                not isinstance(request.get('names'), list) or \
+                not all(isinstance(n, str) for n in request['names']):
+            return {'error': 'expected {"names": [...]}'}
+        self.maybe_reload()
+        names = request['names']
+        columns = [(c.name, list(c.clean_many(names)))
+                   for c in self.cleaners]
+        response = {
+            'results': [
+                {name: results[i] for name, results in columns}
+                for i in range(len(names))
+            ],
+            'versions': self.versions(),
+        }
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'error': 'invalid JSON: %s' % e}
+        else:
+            response = self.handle(request)
+        return json.dumps(response).encode('utf-8') + b'\n'
+
+
+async def handle_jsonl(service, reader, writer):
+    """Answer one JSON request per line, until the client disconnects."""
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                writer.write(b'{"error": "request too large"}\n')
+                break
+            if not line:
+                break
+            if line.strip():
+                writer.write(service.handle_line(line))
+                await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_http(service, reader, writer):
+    """
+    Answer "POST /clean" requests with the same JSON objects as the JSON
+    lines protocol as their body, over HTTP/1.1 keep-alive connections.
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            length = int(headers.get('content-length', 0))
+            if length > MAX_REQUEST_SIZE:
+                status, body = '413 Payload Too Large', b'{}\n'
+            else:
+                data = await reader.readexactly(length)
+                if method == 'POST' and path == '/clean':
+                    status, body = '200 OK', service.handle_line(data)
+                else:
+                    status, body = '404 Not Found', b'{}\n'
+            writer.write((
+                'HTTP/1.1 {0:s}\r\nContent-Type: application/json\r\n'
+                'Content-Length: {1:d}\r\n\r\n'.format(status, len(body))
+            ).encode('latin-1') + body)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close' or \
+                    length > MAX_REQUEST_SIZE:
+                break
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def remove_stale_socket(path):
+    """Remove the socket file `path`, unless a server is listening on it."""
+    if not os.path.exists(path):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise SystemExit('Already serving on %s' % path)
+    finally:
+        s.close()
+
+
+async def start(service, path=None, port=None):
+    """Start listening on the Unix socket `path` and/or localhost:`port`."""
+    servers = []
+    if path is not None:
+        remove_stale_socket(path)
+        servers.append(await asyncio.start_unix_server(
+            lambda r, w: handle_jsonl(service, r, w), path,
+            limit=MAX_REQUEST_SIZE))
+        LOG.info('Serving on %s' % path)
+    if port is not None:
+        server = await asyncio.start_server(
+            lambda r, w: handle_http(service, r, w), '127.0.0.1', port,
+            limit=MAX_REQUEST_SIZE)
+        servers.append(server)
+        LOG.info('Serving on http://127.0.0.1:%d/clean' % (
+            server.sockets[0].getsockname()[1]))
+    return servers
+
+
+def serve(service, path=None, port=None):
+    """Serve until interrupted (SIGINT or SIGTERM)."""
+    import signal
+
+    async def run():
+        servers = await start(service, path=path, port=port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+        LOG.info('Served %d requests.' % service.requests)
+
+    asyncio.run(run())
+
+
+class Client(object):
+    """
+    A blocking client of the JSON lines protocol of a running server:
+
+        with Client(path) as client:
+            client.clean(['Ed.Wood.XviD.DVD-Rip'])
+    """
+
+    def __init__(self, path, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, request):
+        self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('The server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def clean(self, names):
+        """Return a {cleaner name: cleaned name} dict for each of `names`."""
+        return self.request({'names': list(names)})['results']
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
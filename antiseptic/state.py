@@ -0,0 +1,78 @@
+import logging
+import sqlite3
+
+LOG = logging.getLogger(__name__)
+
+PROCESSED = 'processed'
+DECLINED = 'declined'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, mtime, name)
+);
+'''
+
+
+def entry_key(st, name):
+    """Return the state key of an entry from its stat result and name."""
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, name)
+
+
+class StateIndex(object):
+    """
+    Remembers the entries which were already processed or declined, so that
+    unchanged entries are skipped by incremental runs.
+
+    Entries are keyed by (st_dev, inode, mtime, name). The whole index is
+    dropped when `version`, which identifies the rules, changes.
+    """
+
+    def __init__(self, filename, version):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript(SCHEMA)
+        row = self._conn.execute(
+            'SELECT value FROM meta WHERE key = ?', ('version',)).fetchone()
+        if row is None or row[0] != version:
+            if row is not None:
+                LOG.info('The rules changed, re-evaluating all entries.')
+            self._conn.execute('DELETE FROM entries')
+            self._conn.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                ('version', version))
+            self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, key):
+        return self._conn.execute(
+            'SELECT 1 FROM entries WHERE dev = ? AND ino = ? AND mtime = ? '
+            'AND name = ?', key).fetchone() is not None
+
+    def add(self, key, status=PROCESSED):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+            key + (status,))
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is None:
+            return
+        self._conn.commit()
+        self._conn.close()
+        self._conn = None
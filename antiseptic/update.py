@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import time
+
+from .utils import HTTPRequestError, fetch, split_rev
+
+LOG = logging.getLogger(__name__)
+
+# The validators of the installed rules and the last check are kept next to
+# the rules file.
+META_SUFFIX = '.meta'
+DEFAULT_CHECK_TTL = 3600
+# The instance manipulation (RFC 3229) of the rule deltas: a JSON object
+# with the "base" and new "version", the "upsert" rules and the rule IDs to
+# "delete".
+DELTA_IM = 'antiseptic-delta'
+
+
+def load_meta(rules_filename):
+    try:
+        with open(rules_filename + META_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(filename, data, **kwargs):
+    """Atomically replace `filename` with `data` as JSON."""
+    import tempfile
+
+    with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(filename) or '.', prefix='.rules-',
+            delete=False) as f:
+        json.dump(data, f, **kwargs)
+    os.replace(f.name, filename)
+
+
+def save_meta(rules_filename, meta):
+    try:
+        write_json(rules_filename + META_SUFFIX, meta, sort_keys=True)
+    except OSError as e:
+        LOG.warning('Failed to save the rules metadata: %s' % e)
+
+
+def load_local_rules(rules_filename):
+    """Return the data of the installed rules, or `None`."""
+    if not os.path.exists(rules_filename):
+        return None
+    with open(rules_filename) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            LOG.warning('Failed to load the old rules.')
+            return None
+
+
+def is_newer(version, than):
+    return split_rev(version) > split_rev(than or '000000000')
+
+
+def check_latest(rules_filename, update_server, ttl=DEFAULT_CHECK_TTL):
+    """
+    Return an (up to date, latest version) tuple for the installed rules.
+    The latest version is looked up at most once every `ttl` seconds.
+    """
+    local = load_local_rules(rules_filename) or {}
+    meta = load_meta(rules_filename)
+    age = time.time() - meta.get('checked', 0)
+    if meta.get('latest') and 0 <= age < ttl:
+        LOG.debug('Using the latest version checked %d seconds ago' % age)
+        latest = meta['latest']
+    else:
+        LOG.debug('Checking for the latest version at %s' % update_server)
+        try:
+            latest = fetch('%s/latest' % update_server).body.strip()
+            split_rev(latest)
+        except (HTTPRequestError, ValueError) as e:
+            LOG.exception(e)
+            raise SystemExit('Failed to check for the latest version online')
+        meta.update(latest=latest, checked=time.time())
+        save_meta(rules_filename, meta)
+    return not is_newer(latest, local.get('version')), latest
+
+
+def apply_delta(data, delta):
+    """Return the rules `data` patched by a rule `delta`."""
+    if delta.get('base') != data.get('version'):
+        raise ValueError('The delta is for version %s, not %s' % (
+            delta.get('base'), data.get('version')))
+    deleted = set(delta.get('delete', []))
+    upserts = {r['id']: r for r in delta.get('upsert', [])}
+    rules = []
+    for rule in data['rules']:
+        if rule.get('id') in deleted:
+            continue
+        rules.append(upserts.pop(rule.get('id'), rule))
+    rules.extend(r for r in delta.get('upsert', []) if r['id'] in upserts)
+    return dict(data, version=delta['version'], rules=rules)
+
+
+def merge_custom_rules(old_data, new_data):
+    """Keep the custom rules (whose ID starts with "_") of `old_data`."""
+    old_rules = (old_data or {}).get('rules', [])
+    custom_rules = [r for r in old_rules if r['id'].startswith('_')]
+    if custom_rules:
+        LOG.debug('%d custom rules found.' % len(custom_rules))
+        new_data['rules'].extend(custom_rules)
+    return new_data
+
+
+def fetch_rules(rules_filename, update_server, force=False, delta=True):
+    """
+    Download the rules, unless they did not change since they were
+    installed, in a single conditional request. The server may answer with
+    a delta to the installed rules (see `DELTA_IM`).
+
+    Returns a (rules data, metadata) tuple, where the data is `None` if the
+    installed rules are up to date. Install the rules and the metadata with
+    `install_rules`.
+    """
+    local = load_local_rules(rules_filename)
+    meta = load_meta(rules_filename)
+    headers = {}
+    if local is not None and not force:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+            if delta:
+                headers['A-IM'] = DELTA_IM
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    LOG.debug('Downloading latest rules')
+    try:
+        resp = fetch('%s/rules.json' % update_server, headers=headers)
+    except HTTPRequestError as e:
+        LOG.exception(e)
+        raise SystemExit('Failed to download latest rules')
+    except ValueError as e:
+        # E.g. an update server URL without a scheme.
+        raise SystemExit('Failed to download latest rules: %s' % e)
+    try:
+        if resp.status == 304:
+            LOG.debug('The rules were not modified')
+            meta['latest'] = local.get('version')
+            data = None
+        elif resp.status == 226 and \
+                DELTA_IM in resp.headers.get('IM', ''):
+            data = apply_delta(local, json.loads(resp.body))
+            LOG.debug('Applied a delta to version %s' % data['version'])
+        else:
+            data = merge_custom_rules(local, json.loads(resp.body))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        if resp.status != 226:
+            raise SystemExit('Failed to parse the latest rules: %s' % e)
+        LOG.warning('Failed to apply the rules delta (%s), downloading '
+                    'the full rules.' % e)
+        return fetch_rules(rules_filename, update_server, force=True,
+                           delta=False)
+
+    meta['checked'] = time.time()
+    if data is not None:
+        meta.update(etag=resp.headers.get('ETag'),
+                    last_modified=resp.headers.get('Last-Modified'),
+                    latest=data.get('version'))
+        if not force and local is not None and \
+                not is_newer(data['version'], local.get('version')):
+            data = None
+    return data, meta
+
+
+def install_rules(rules_filename, data, meta):
+    """Atomically replace the installed rules, then their metadata."""
+    write_json(rules_filename, data, indent='\t', sort_keys=True)
+    save_meta(rules_filename, meta)
@@ -1,14 +1,11 @@
 import copy
-import difflib
 import functools
+import itertools
 import json
 import logging
 import os
 import sys
-import socket
-
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError, URLError
+from collections import OrderedDict, namedtuple
 
 LOG = logging.getLogger(__name__)
 HOME = os.environ.get('HOME')
@@ -16,8 +13,31 @@ DEFAULT_CONFIG_DIR = os.path.join(HOME, '.config')
 DEFAULT_DATA_DIR = os.path.join(HOME, '.local', 'share')
 XDG_CONFIG_DIR = os.environ.get('XDG_CONFIG_DIR') or DEFAULT_CONFIG_DIR
 XDG_DATA_DIR = os.environ.get('XDG_DATA_HOME') or DEFAULT_DATA_DIR
+MEDIA_EXTENSIONS = frozenset({
+    '.avi', '.mkv', '.webm', '.ogv', '.mp4', '.wmv', '.mov', '.flv', '.mpg',
+    '.xvid', '.mpeg', '.rmvb',
+})
+# Files which belong with the movie file they share a stem with, and are
+# wrapped together with it.
+COMPANION_EXTENSIONS = frozenset({
+    '.srt', '.sub', '.idx', '.ass', '.ssa', '.smi', '.vtt', '.nfo', '.txt',
+    '.jpg', '.png', '.sfv',
+})
+# Separators between the stem of a movie file and the rest of the name of
+# one of its companions, e.g. "Up.2009.en.srt" or "Up.2009-sample.avi".
+COMPANION_SEPARATORS = '.-_ '
 DEFAULT_CONFIG = {
+    'cache': False,
+    'cache_max_entries': 100000,
     'disabled_rules': [],
+    'guessit': True,
+    'incremental': False,
+    # Seconds for which `antiseptic check` reuses the latest version.
+    'check_ttl': 3600,
+    'confidence_threshold': 0.6,
+    # Seconds a rule may take on a name before it is quarantined, see
+    # `antiseptic.guard`. Names are not guarded if not set.
+    'rule_timeout': None,
     'update_server': 'https://naglis.github.io/antiseptic/',
 }
 
@@ -29,14 +49,38 @@ def split_rev(version):
 
 
 def diff(before, after):
+    import difflib
+
     d = difflib.Differ()
     return d.compare(['%s\n' % before], ['%s\n' % after])
 
 
+class LazyDiff(object):
+    """
+    The diff of two strings, computed only when formatted, e.g. when a log
+    message it is an argument of is emitted.
+    """
+
+    __slots__ = ('before', 'after')
+
+    def __init__(self, before, after):
+        self.before = before
+        self.after = after
+
+    def __str__(self):
+        return ''.join(diff(self.before, self.after))
+
+
+@functools.lru_cache(maxsize=8)
+def _isatty(file):
+    return file.isatty()
+
+
 def wrap_text(text, prefix='\033[1m', postfix='\033[0m', file=sys.stdout,
               endline=''):
 
-    if file.isatty():
+    # Whether a file is a terminal is only checked once.
+    if _isatty(file):
         return '%s%s%s%s' % (prefix, text, postfix, endline)
     else:
         return '%s%s' % (text, endline)
@@ -50,62 +94,65 @@ class HTTPRequestError(Exception):
     pass
 
 
-def request(url, headers=None, max_attempts=3, timeout=10):
-    if not headers:
-        headers = {}
+# A response of `fetch`; the body is `None` for "304 Not Modified".
+Response = namedtuple('Response', 'status headers body')
+# Seconds to wait before the second attempt of a request, doubled for each
+# following one.
+DEFAULT_BACKOFF = 0.5
+
+
+def fetch(url, headers=None, max_attempts=3, timeout=10,
+          backoff=DEFAULT_BACKOFF):
+    """
+    Request `url`, accepting a gzip compressed response, and return a
+    `Response`. Failed attempts are retried after an exponential backoff,
+    unless the server rejected the request (a 4xx status).
+    """
+    import gzip
+    import socket
+    import time
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
+
+    headers = dict(headers or {}, **{'Accept-Encoding': 'gzip'})
     attempt = 0
     req = Request(url, headers=headers)
     while True:
         attempt += 1
         LOG.debug('Requesting URL: %s, attempt: %d' % (url, attempt))
         try:
-            resp = urlopen(req, timeout=timeout)
-            data = resp.read().decode('utf-8')
-        except (HTTPError, URLError, socket.timeout, socket.gaierror) as e:
-            if attempt < max_attempts:
-                continue
-            else:
+            with urlopen(req, timeout=timeout) as resp:
+                status, body = resp.status, resp.read()
+                resp_headers = resp.headers
+        except HTTPError as e:
+            if e.code == 304:
+                return Response(304, e.headers, None)
+            if (400 <= e.code < 500 and e.code != 429) or \
+                    attempt >= max_attempts:
+                raise HTTPRequestError(e)
+        except (URLError, socket.timeout, socket.gaierror) as e:
+            if attempt >= max_attempts:
                 raise HTTPRequestError(e)
         else:
-            return data
-
+            if resp_headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return Response(status, resp_headers, body.decode('utf-8'))
+        delay = backoff * 2 ** (attempt - 1)
+        LOG.debug('Retrying in %.1f seconds' % delay)
+        time.sleep(delay)
 
-def check_latest(rules_filename, update_server):
-    current_release_date, current_rev = 0, 0
-    if os.path.exists(rules_filename):
-        with open(rules_filename) as f:
-            try:
-                data = json.load(f)
-                current_release_date, current_rev = split_rev(
-                    data.get('version', '000000000'))
-            except ValueError:
-                LOG.warning('Failed to load the old rules.')
 
-    LOG.debug('Checking for the latest version at %s' % update_server)
-    try:
-        latest = request('%s/latest' % update_server)
-    except HTTPRequestError as e:
-        LOG.exception(e)
-        raise SystemExit('Failed to check for the latest version online')
-
-    latest_release_date, latest_rev = split_rev(latest)
+def request(url, headers=None, max_attempts=3, timeout=10):
+    return fetch(url, headers=headers, max_attempts=max_attempts,
+                 timeout=timeout).body
 
-    if latest_release_date > current_release_date or \
-            (latest_release_date == current_release_date and
-                latest_rev > current_rev):
-        return False, latest
-    return True, latest
 
-
-def get_new_rules(update_server):
-    LOG.debug('Downloading latest rules')
-    try:
-        data = request('%s/rules.json' % update_server)
-    except HTTPRequestError as e:
-        LOG.exception(e)
-        raise SystemExit('Failed to download latest rules')
-    else:
-        return json.loads(data)
+def close_cleaners(cleaners):
+    """Close the `cleaners` which hold resources, like worker processes."""
+    for c in cleaners:
+        close = getattr(c, 'close', None)
+        if close is not None:
+            close()
 
 
 def make_dirs(path):
@@ -115,21 +162,167 @@ def make_dirs(path):
         raise SystemExit('Failed to create config dir: %s' % str(e))
 
 
-def list_dirs(path):
-    dp, dn, _ = next(os.walk(path))
-    for n in dn:
-        yield os.path.join(dp, n)
+def walk(path, files=False, min_depth=1, max_depth=1, include=None,
+         exclude=None, extensions=None):
+    """
+    Lazily yield the `os.DirEntry` objects of the directories (or, if `files`
+    is true, the files) below `path`.
+
+    Depth 1 are the entries directly inside `path`; a `max_depth` of `None`
+    means no limit. Only entries whose name matches one of the `include`
+    globs (if any) and none of the `exclude` globs are yielded, and excluded
+    directories are not descended into. Files are further filtered by
+    `extensions`, matched case-insensitively.
+
+    Each directory is listed with a single `os.scandir` call and its entries
+    are yielded, together, after the ones of its subdirectories, so renaming
+    an entry does not invalidate the paths which are still to be yielded.
+    """
+    import fnmatch
+
+    def matches(name, patterns):
+        return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+    include, exclude = include or (), exclude or ()
+
+    def walk_dir(dir_path, depth):
+        try:
+            entries = sorted(os.scandir(dir_path), key=lambda e: e.name)
+        except OSError as e:
+            if depth == 1:
+                raise
+            LOG.warning('Failed to list directory: %s' % e)
+            return
+
+        selected = []
+        for entry in entries:
+            if exclude and matches(entry.name, exclude):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir and (max_depth is None or depth < max_depth) and \
+                    not entry.is_symlink():
+                yield from walk_dir(entry.path, depth + 1)
+            selected.append((entry, is_dir))
+
+        for entry, is_dir in selected:
+            if depth < min_depth or is_dir == files:
+                continue
+            if include and not matches(entry.name, include):
+                continue
+            if files and extensions is not None and \
+                    os.path.splitext(entry.name)[1].lower() not in extensions:
+                continue
+            yield entry
+
+    yield from walk_dir(path, 1)
+
+
+def _is_sample(rest):
+    return 'sample' in rest.lower()
+
+
+def group_companions(entries, extensions=MEDIA_EXTENSIONS):
+    """
+    Group the file `entries` (from `walk`) with their companions, yielding a
+    (movie entry, companion entries) tuple for each movie file, i.e. each
+    entry with one of the media `extensions`.
+
+    The companions of a movie file are the other files of its directory
+    whose names start with its stem and a separator, e.g. "Up.2009.srt" or
+    "Up.2009.en.srt" for "Up.2009.avi". Movie files are only companions if
+    they are samples, e.g. "Up.2009-sample.avi". A file whose name starts
+    with the stems of several movie files belongs to the longest one.
+
+    The entries of a directory must be consecutive, as `walk` yields them.
+    Each directory is indexed by stem once.
+    """
+    for _, dir_entries in itertools.groupby(
+            entries, key=lambda e: os.path.dirname(e.path)):
+        dir_entries = list(dir_entries)
+        stems = {}
+        for entry in dir_entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() in extensions:
+                stems.setdefault(stem.lower(), entry)
+
+        groups = OrderedDict()
+        owners = {}
+        for entry in dir_entries:
+            name = entry.name.lower()
+            stem, ext = os.path.splitext(name)
+            is_movie = ext in extensions
+            owner = None
+            # The longest stem of another movie file the name starts with.
+            for i in range(len(stem), 0, -1):
+                if name[i] not in COMPANION_SEPARATORS:
+                    continue
+                candidate = stems.get(name[:i])
+                if candidate is not None and candidate is not entry and \
+                        (not is_movie or _is_sample(name[i:])):
+                    owner = candidate
+                    break
+            if owner is not None:
+                owners[entry.path] = (entry, owner)
+            elif is_movie:
+                groups[entry.path] = (entry, [])
+
+        for entry, owner in owners.values():
+            # E.g. the subtitles of a sample belong to the movie file.
+            while owner.path in owners:
+                owner = owners[owner.path][1]
+            groups[owner.path][1].append(entry)
+        yield from groups.values()
+
+
+def parse_shard(value):
+    """Parse a "K/N" shard, the K-th of N (from 1), into a (K, N) tuple."""
+    try:
+        k, n = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard: %s (expected K/N)' % value)
+    if not 1 <= k <= n:
+        raise ValueError('Invalid shard: %s (K must be from 1 to N)' % value)
+    return k, n
+
+
+def shard_of(path, n):
+    """
+    Return the shard, from 1 to `n`, of the relative `path`. The shard only
+    depends on the path, so every node assigns it to the same shard.
+    """
+    import zlib
+
+    data = path.replace(os.sep, '/').encode('utf-8', 'surrogateescape')
+    return zlib.crc32(data) % n + 1
+
+
+def in_shard(items, root, shard, key=None):
+    """
+    Yield the `items` whose paths (the `key` of an item, by default its path
+    or itself), relative to `root`, belong to the (K, N) `shard`, see
+    `shard_of`. Nodes which mount the library in different places agree on
+    the shards, as long as `root` is the library.
+    """
+    if key is None:
+        def key(item):
+            return getattr(item, 'path', item)
+    k, n = shard
+    for item in items:
+        if shard_of(os.path.relpath(key(item), root), n) == k:
+            yield item
+
+
+def list_dirs(path, **kwargs):
+    for entry in walk(path, **kwargs):
+        yield entry.path
 
 
-def list_files(path):
-    media_extensions = {
-        '.avi', '.mkv', '.webm', '.ogv', '.mp4', '.wmv', '.mov', '.flv',
-        '.mpg', '.xvid', '.mpeg', '.rmvb'
-    }
-    dp, _, fn = next(os.walk(path))
-    for n in fn:
-        if os.path.splitext(n)[1] in media_extensions:
-            yield os.path.join(dp, n)
+def list_files(path, extensions=MEDIA_EXTENSIONS, **kwargs):
+    for entry in walk(path, files=True, extensions=extensions, **kwargs):
+        yield entry.path
 
 
 def prompt(question, choices, default, case_sensitive=False, color=True):
@@ -166,11 +359,16 @@ def get_config():
             custom_config = json.load(f)
             config.update(custom_config)
 
-    if not config.get('rules_filename'):
-        data_dir = os.path.join(XDG_DATA_DIR, 'antiseptic')
+    data_dir = os.path.join(XDG_DATA_DIR, 'antiseptic')
+    for key, filename in (('rules_filename', 'rules.json'),
+                          ('cache_filename', 'cache.sqlite'),
+                          ('state_filename', 'state.sqlite'),
+                          ('socket_filename', 'serve.sock')):
+        if config.get(key):
+            continue
         if not os.path.isdir(data_dir):
             LOG.debug('Creating data dir: %s' % data_dir)
             make_dirs(data_dir)
 
-        config['rules_filename'] = os.path.join(data_dir, 'rules.json')
+        config[key] = os.path.join(data_dir, filename)
     return config
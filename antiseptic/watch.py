@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+LOG = logging.getLogger(__name__)
+DEFAULT_SETTLE = 0.5
+DEFAULT_POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct('iIII')
+
+
+def signature(path, max_entries=10000):
+    """
+    Return a value which changes while `path` is being written to: its size
+    and mtime, or for a directory, those of the entries below it.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    sig = [st.st_size, st.st_mtime_ns]
+    if not os.path.isdir(path):
+        return tuple(sig)
+    stack, seen = [path], 0
+    while stack and seen < max_entries:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            seen += 1
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            sig[0] += st.st_size
+            sig[1] = max(sig[1], st.st_mtime_ns)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+    return tuple(sig)
+
+
+class InotifyWatcher(object):
+    """Reports the names of entries created in or moved into a directory."""
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(path), ctypes.c_uint32(WATCH_MASK))
+        if wd < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e), path)
+        self.path = path
+        self.overflowed = False
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        """Return the set of names with activity, waiting up to timeout."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+        names, offset = set(), 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                LOG.warning('Missed some events, the queue overflowed.')
+                self.overflowed = True
+            elif name:
+                names.add(os.fsdecode(name))
+        return names
+
+
+class PollingWatcher(object):
+    """
+    Reports the names of new or changed entries of a directory by listing it
+    every `interval` seconds.
+    """
+
+    def __init__(self, path, interval=DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._listing = self._list()
+        self._next = time.monotonic() + interval
+
+    def close(self):
+        pass
+
+    def _list(self):
+        listing = {}
+        for entry in os.scandir(self.path):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            listing[entry.name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return listing
+
+    def wait(self, timeout):
+        now = time.monotonic()
+        delay = self._next - now
+        if timeout is not None and timeout < delay:
+            time.sleep(max(timeout, 0))
+            return set()
+        time.sleep(max(delay, 0))
+        self._next = time.monotonic() + self.interval
+        listing, old = self._list(), self._listing
+        self._listing = listing
+        return {n for n, v in listing.items() if old.get(n) != v}
+
+
+def make_watcher(path, poll_interval=None):
+    """
+    Return an inotify watcher for `path` on Linux, or if unavailable or
+    `poll_interval` is given, a polling one.
+    """
+    if poll_interval is None and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            LOG.warning('inotify is unavailable (%s), polling instead.' % e)
+    return PollingWatcher(path, poll_interval or DEFAULT_POLL_INTERVAL)
+
+
+class Debouncer(object):
+    """
+    Holds back paths with recent activity until they stop changing for
+    `settle` seconds, e.g. until a download has finished.
+    """
+
+    def __init__(self, settle=DEFAULT_SETTLE, clock=time.monotonic,
+                 signature=signature):
+        self.settle = settle
+        self.clock = clock
+        self.signature = signature
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def touch(self, path):
+        _, sig = self._pending.get(path, (None, None))
+        if sig is None:
+            sig = self.signature(path)
+        self._pending[path] = (self.clock(), sig)
+
+    def timeout(self):
+        """Return the seconds until the next path may settle, or None."""
+        if not self._pending:
+            return None
+        oldest = min(t for t, _ in self._pending.values())
+        return max(oldest + self.settle - self.clock(), 0)
+
+    def ready(self):
+        """Return the paths which settled, in order of their activity."""
+        now, ready = self.clock(), []
+        for path, (t, sig) in sorted(self._pending.items(),
+                                     key=lambda i: i[1][0]):
+            if now - t < self.settle:
+                continue
+            current = self.signature(path)
+            if current is None:
+                # Removed (or moved away) before it settled.
+                del self._pending[path]
+            elif current != sig:
+                self._pending[path] = (now, current)
+            else:
+                del self._pending[path]
+                ready.append(path)
+        return ready
+
+
+def watch(path, handle, settle=DEFAULT_SETTLE, poll_interval=None,
+          stop=None):
+    """
+    Call `handle(path)` for each entry created in or moved into the directory
+    `path` once it settled, until `stop` (a `threading.Event`) is set.
+    """
+    watcher = make_watcher(path, poll_interval=poll_interval)
+    debouncer = Debouncer(settle)
+    LOG.info('Watching %s (%s)' % (path, type(watcher).__name__))
+    try:
+        while stop is None or not stop.is_set():
+            timeout = debouncer.timeout()
+            if stop is not None and (timeout is None or timeout > 0.1):
+                timeout = 0.1
+            names = watcher.wait(timeout)
+            if getattr(watcher, 'overflowed', False):
+                # Events were lost, so look at everything once.
+                watcher.overflowed = False
+                names.update(os.listdir(path))
+            for name in names:
+                debouncer.touch(os.path.join(path, name))
+            for p in debouncer.ready():
+                handle(p)
+    finally:
+        watcher.close()
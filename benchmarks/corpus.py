@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Deterministic corpus of realistic release names and synthetic rules for the
+benchmarks.
+
+    $ python benchmarks/corpus.py --count 50000 > corpus.txt
+"""
+
+import argparse
+import random
+
+TITLES = [
+    'Across the Hall', 'A Mighty Heart', 'District 9', 'Drag Me To Hell',
+    'Dragonball Evolution', 'Ed Wood', 'Gamer', 'G-Force',
+    'Ghosts Of Girlfriends Past', 'G.I. Joe The Rise Of Cobra',
+    'Harry Potter and the Half Blood Prince', 'I Served the King of England',
+    'Knowing', 'Star Trek', 'State of Play', 'The Hangover',
+    'The Hurt Locker', 'Transformers Revenge of the Fallen', 'UP',
+    'Inglourious Basterds', 'Moon', 'Zombieland', 'Coraline', 'Avatar',
+    'Sherlock Holmes', 'The Road', 'A Serious Man', 'Fantastic Mr Fox',
+    'Public Enemies', 'Watchmen', 'Adventureland', 'The Informant',
+    'In the Loop', 'Let the Right One In', 'The Wrestler', 'Milk',
+    'Slumdog Millionaire', 'Frost Nixon', 'The Reader', 'Doubt',
+    'Revolutionary Road', 'Gran Torino', 'Wall E', 'The Dark Knight',
+    'Iron Man', 'Burn After Reading', 'Tropic Thunder', 'Cloverfield',
+    'No Country for Old Men', 'There Will Be Blood', 'Amélie', 'Léon',
+]
+SEPARATORS = ['.', ' ', '_']
+SOURCES = ['DVDRip', 'DvDrip', 'DVDRiP', 'BDRip', 'BRRip', 'WEBRip',
+           'WEB-DL', 'HDTV', 'DVDSCR', 'WORKPRiNT', 'R5.LiNE', 'BluRay',
+           'DVD-Rip']
+CODECS = ['XviD', 'XViD', 'Xvid', 'DivX', 'x264', 'H.264', 'HEVC', 'x265']
+EXTRAS = ['AC3', 'AAC', 'DTS', 'AC3.5.1', '720p', '1080p', '2160p', 'REPACK',
+          'PROPER', 'LIMITED', 'UNRATED', 'ENG', 'MULTi']
+GROUPS = ['aXXo', 'FxM', 'DoNE', 'KAMERA', 'ViSiON', 'JUMANJi', 'NeDiVx',
+          'iAPULA', 'MAXSPEED', 'iMBT', 'LW', 'Noir', 'BeStDivX', 'SPARKS',
+          'DiAMOND', 'RARBG', 'YIFY', 'FGT']
+
+
+def release_name(rnd):
+    """Return a random, realistic release name."""
+    sep = rnd.choice(SEPARATORS)
+    parts = [sep.join(rnd.choice(TITLES).split(' '))]
+    year = str(rnd.randint(1950, 2015))
+    style = rnd.random()
+    if style < 0.5:
+        parts.append(year)
+    elif style < 0.7:
+        parts.append('[%s]' % year)
+    elif style < 0.85:
+        parts.append('(%s)' % year)
+    tags = [rnd.choice(SOURCES)]
+    if rnd.random() < 0.8:
+        tags.append(rnd.choice(CODECS))
+    tags.extend(rnd.sample(EXTRAS, rnd.randint(0, 2)))
+    if rnd.random() < 0.1:
+        tags = ['[%s]' % t for t in tags]
+    name = sep.join(parts + tags)
+    if rnd.random() < 0.05:
+        name += ' {1337x}'
+    if rnd.random() < 0.85:
+        name += '-' + rnd.choice(GROUPS)
+    return name
+
+
+def release_names(count, seed=0):
+    """Return `count` release names; the same for the same seed."""
+    rnd = random.Random(seed)
+    return [release_name(rnd) for _ in range(count)]
+
+
+TAGS = [
+    'dvdrip', 'bdrip', 'brrip', 'webrip', 'hdtv', 'xvid', 'divx', 'x264',
+    'h264', 'hevc', 'aac', 'ac3', 'dts', 'repack', 'proper', 'limited',
+    'workprint', 'dvdscr', 'telesync', 'cam', 'r5', 'line', 'unrated',
+]
+
+
+def synthetic_rules(count):
+    """Return `count` rules that look like the ones on the update server."""
+    rules = []
+    for i in range(count):
+        tag = TAGS[i % len(TAGS)]
+        if i % 5 == 4:
+            # Some rules have no required literal.
+            rule = r'[\.\s\-\[\(]+(?:%s|%s%d)[\]\)]?' % (tag, tag[:2], i)
+        else:
+            rule = r'(?i)[\.\s\-\[]*%s[\.\-]?%d\]?' % (tag, i)
+        rules.append({'id': 'rule%d' % i, 'rule': rule, 'weight': i % 50})
+    return rules
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--count', type=int, default=50000)
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+    for name in release_names(args.count, args.seed):
+        print(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for the cleaners, rule loading and end-to-end runs.
+
+Results are written as JSON, so that runs on different commits can be
+compared:
+
+    $ python benchmarks/run.py --output before.json
+    $ git checkout other-branch
+    $ python benchmarks/run.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from corpus import release_names, synthetic_rules
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RULES_FILENAME = os.path.join(HERE, 'rules.json')
+sys.path.insert(0, ROOT)
+
+from antiseptic.cleaner import (  # noqa: E402
+    GuessitCleaner,
+    RegexCleaner,
+    guessit_available,
+)
+
+
+def best_of(repeat, fn, *args):
+    """Return the fastest of `repeat` timings of `fn(*args)`, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def regex_cleaner():
+    c = RegexCleaner()
+    c.load_rules(RULES_FILENAME, snapshot=False)
+    return c
+
+
+def bench_throughput(names, repeat):
+    """Titles per second of the cleaners, one by one and in batches."""
+    cleaners = [('regex', regex_cleaner())]
+    if guessit_available():
+        cleaners.append(('guessit', GuessitCleaner()))
+    results = {}
+    for label, c in cleaners:
+        if label == 'guessit':
+            # Orders of magnitude slower, a sample is enough.
+            sample = names[:max(len(names) // 50, 100)]
+        else:
+            sample = names
+
+        def clean_each():
+            for name in sample:
+                c.clean(name)
+
+        def clean_many():
+            for _ in c.clean_many(sample):
+                pass
+
+        for mode, fn in (('clean', clean_each), ('clean_many', clean_many)):
+            elapsed = best_of(repeat, fn)
+            results['{0:s}.{1:s}'.format(label, mode)] = {
+                'titles': len(sample),
+                'seconds': elapsed,
+                'titles_per_second': len(sample) / elapsed,
+            }
+    return results
+
+
+def bench_load_rules(tmp_dir, rule_count, repeat):
+    """Time to load a large rules file, from JSON and from its snapshot."""
+    filename = os.path.join(tmp_dir, 'synthetic.json')
+    with open(filename, 'w') as f:
+        json.dump({'version': '201501010',
+                   'rules': synthetic_rules(rule_count)}, f)
+
+    def load(snapshot):
+        c = RegexCleaner()
+        c.load_rules(filename, snapshot=snapshot)
+        # Patterns of a snapshot are compiled when first used.
+        c.clean('Across.the.Hall.2009.DVDRip.XviD-BeStDivX')
+
+    load(True)
+    return {
+        'load_rules.{0:s}'.format(mode): {
+            'rules': rule_count,
+            'seconds': best_of(repeat, load, mode == 'snapshot'),
+        }
+        for mode in ('json', 'snapshot')
+    }
+
+
+def cli_env(tmp_dir):
+    """Return an environment with its own config and (installed) rules."""
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               XDG_CONFIG_DIR=os.path.join(tmp_dir, 'config'),
+               XDG_DATA_HOME=os.path.join(tmp_dir, 'data'))
+    data_dir = os.path.join(env['XDG_DATA_HOME'], 'antiseptic')
+    os.makedirs(data_dir, exist_ok=True)
+    shutil.copy(RULES_FILENAME, os.path.join(data_dir, 'rules.json'))
+    return env
+
+
+def run_cli(env, *args):
+    start = time.perf_counter()
+    subprocess.check_call(
+        [sys.executable, '-m', 'antiseptic', '--quiet'] + list(args),
+        env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def bench_cli(tmp_dir, names, repeat):
+    """CLI cold start, and a dry run over a generated directory tree."""
+    env = cli_env(tmp_dir)
+    empty = os.path.join(tmp_dir, 'empty')
+    os.mkdir(empty)
+    # Starts up and loads the rules, but has nothing to clean. The first run
+    # writes the rules snapshot.
+    cold_start = ('rename', '--no-cache', '-d', '-n', empty)
+    run_cli(env, *cold_start)
+    results = {
+        'cli.cold_start': {
+            'seconds': statistics.median(
+                run_cli(env, *cold_start) for _ in range(repeat)),
+        },
+    }
+
+    tree = os.path.join(tmp_dir, 'tree')
+    os.mkdir(tree)
+    for name in set(names):
+        os.mkdir(os.path.join(tree, name))
+    elapsed = min(run_cli(env, 'rename', '--no-cache', '-d', '-n', tree)
+                  for _ in range(repeat))
+    results['cli.rename_dry_run'] = {
+        'directories': len(os.listdir(tree)),
+        'seconds': elapsed,
+    }
+    return results
+
+
+def compare(old, new):
+    """Print the relative change of the shared measurements."""
+    for key in sorted(set(old['results']) & set(new['results'])):
+        o, n = old['results'][key], new['results'][key]
+        if 'titles_per_second' in n:
+            before, after = o['titles_per_second'], n['titles_per_second']
+            unit, change = 'titles/s', after / before - 1
+        else:
+            before, after = o['seconds'] * 1000, n['seconds'] * 1000
+            unit, change = 'ms', before / after - 1
+        print('{0:24s} {1:12.1f} -> {2:12.1f} {3:8s} {4:+7.1%}'.format(
+            key, before, after, unit, change))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--names', type=int, default=30000,
+                   help='number of release names in the corpus')
+    p.add_argument('--rules', type=int, default=2000,
+                   help='number of synthetic rules for load_rules')
+    p.add_argument('--repeat', type=int, default=3,
+                   help='number of repetitions of each measurement')
+    p.add_argument('--skip-cli', action='store_true',
+                   help='skip the end-to-end measurements')
+    p.add_argument('-o', '--output', help='write the results to a JSON file')
+    p.add_argument('--compare', metavar='JSON',
+                   help='compare with the results of an earlier run '
+                        '(positive changes are improvements)')
+    args = p.parse_args()
+
+    names = release_names(args.names)
+    results = bench_throughput(names, args.repeat)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results.update(bench_load_rules(tmp_dir, args.rules, args.repeat))
+        if not args.skip_cli:
+            results.update(bench_cli(tmp_dir, names, args.repeat))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Cold-start benchmark for loading the rules with and without the compiled
+rules snapshot.
+
+Every measurement runs in a fresh interpreter, so nothing is shared through
+the `re` module's compile cache.
+
+    $ python benchmarks/startup.py --rules 500 --repeat 10
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from corpus import synthetic_rules
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOAD_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+from antiseptic.cleaner import RegexCleaner
+c = RegexCleaner()
+c.load_rules(sys.argv[1], snapshot=sys.argv[2] == 'snapshot')
+c.clean('Across.the.Hall.2009.DVDRip.XviD-BeStDivX')
+print(time.perf_counter() - start)
+'''
+
+def cold_start(rules_filename, mode):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    out = subprocess.check_output(
+        [sys.executable, '-c', LOAD_SCRIPT, rules_filename, mode], env=env)
+    return time.perf_counter() - start, float(out)
+
+
+def run(rule_count, repeat):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rules_filename = os.path.join(tmp_dir, 'rules.json')
+        with open(rules_filename, 'w') as f:
+            json.dump({'version': '201501010',
+                       'rules': synthetic_rules(rule_count)}, f)
+        # Write the snapshot once, like `antiseptic update` does.
+        cold_start(rules_filename, 'snapshot')
+
+        results = {'rules': rule_count, 'repeat': repeat}
+        for mode in ('json', 'snapshot'):
+            samples = [cold_start(rules_filename, mode)
+                       for _ in range(repeat)]
+            results[mode] = {
+                'process_median_s': statistics.median(
+                    s[0] for s in samples),
+                'load_median_s': statistics.median(s[1] for s in samples),
+            }
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--rules', type=int, default=500,
+                   help='number of synthetic rules')
+    p.add_argument('--repeat', type=int, default=10,
+                   help='number of cold starts per mode')
+    p.add_argument('--json', action='store_true',
+                   help='output the results as JSON')
+    args = p.parse_args()
+
+    results = run(args.rules, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    for mode in ('json', 'snapshot'):
+        print('{0:10s} process: {1:7.1f} ms  import+load: {2:7.1f} ms'.format(
+            mode, results[mode]['process_median_s'] * 1000,
+            results[mode]['load_median_s'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
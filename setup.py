@@ -25,6 +25,7 @@ setup(
     package_dir={'antiseptic': 'antiseptic'},
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.9',
     license='GPL2',
     zip_safe=False,
     keywords='antiseptic',
@@ -34,7 +35,10 @@ setup(
         'License :: OSI Approved :: GNU General Public License v2 (GPLv2)',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
     entry_points={
         'console_scripts': [
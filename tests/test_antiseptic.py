@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+test_antiseptic
+----------------------------------
+
+tests for `antiseptic.antiseptic` module.
+"""
+
+import argparse
+import contextlib
+import errno
+import io
+import os
+from collections import Counter, OrderedDict
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from antiseptic.antiseptic import (
+    choose_confident,
+    cleaning,
+    clean_cascade,
+    format_clean,
+    iter_new_names,
+    make_parser,
+    make_pool,
+    process_entries,
+    read_names,
+    setup_cleaners,
+)
+
+from antiseptic.cleaner import confidence
+
+from .test_cleaner import (
+    RULES,
+    TITLES,
+    CountingCleaner,
+    naive_clean,
+    write_rules,
+)
+
+
+def make_args(**kwargs):
+    defaults = {'prefer_guessit': False, 'jobs': 1, 'cache': None}
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+class TestProcessEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.config = {
+            'rules_filename': write_rules(self.tmp_dir, RULES),
+            'disabled_rules': [],
+            'guessit': False,
+        }
+        self.library = os.path.join(self.tmp_dir, 'library')
+        os.mkdir(self.library)
+
+    def process(self, command, *options):
+        args = make_parser().parse_args(
+            [command, '-da'] + list(options) + [self.library])
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process_entries(args, self.config, action=command)
+
+    def test_failed_rename_sets_exit_status(self):
+        for name in ('Up.2009.DVDRip', 'Up.2009.XviD'):
+            os.mkdir(os.path.join(self.library, name))
+        with self.assertLogs('antiseptic.antiseptic', 'ERROR'):
+            self.assertEqual(self.process('rename'), 1)
+        self.assertIn('Up (2009)', os.listdir(self.library))
+
+    def test_successful_run_exits_0(self):
+        os.mkdir(os.path.join(self.library, 'Up.2009.DVDRip'))
+        self.assertIsNone(self.process('rename'))
+
+    def test_wrap_into_another_filesystem(self):
+        into = os.path.join(self.tmp_dir, 'movies')
+        os.mkdir(into)
+        for name in ('Up.2009.DVDRip.avi', 'Up.2009.DVDRip.srt'):
+            with open(os.path.join(self.library, name), 'w') as f:
+                f.write(name)
+        # Renames fail as they do between filesystems, so the files are
+        # copied.
+        with mock.patch('os.rename', side_effect=OSError(
+                errno.EXDEV, 'Invalid cross-device link')):
+            self.assertIsNone(self.process('wrap', '--into', into))
+        self.assertEqual(os.listdir(self.library), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(into, 'Up (2009)'))),
+            ['Up.2009.DVDRip.avi', 'Up.2009.DVDRip.srt'])
+
+
+class TestCleaning(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.config = {
+            'rules_filename': write_rules(self.tmp_dir, RULES),
+            'disabled_rules': [],
+            'guessit': False,
+            'rule_timeout': 5,
+        }
+
+    def test_guard_worker_exits(self):
+        with cleaning(make_args(), self.config) as (cleaners, _):
+            guarded = cleaners[0]
+            self.assertEqual(guarded.clean('Up.2009.DVDRip'), 'Up (2009)')
+            process = guarded._process
+            self.assertTrue(process.is_alive())
+        self.assertFalse(process.is_alive())
+        self.assertIsNone(guarded._process)
+
+
+class TestIterNewNames(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.config = {
+            'rules_filename': write_rules(self.tmp_dir, RULES),
+            'disabled_rules': [],
+            'guessit': False,
+        }
+        # Enough paths for several chunks, with duplicate names.
+        self.paths = [os.path.join('/movies', str(i % 7), t)
+                      for i, t in enumerate(TITLES * 20)]
+
+    def expected(self):
+        return [(p, naive_clean(RULES, os.path.basename(p)))
+                for p in self.paths]
+
+    def results(self, args):
+        cleaners = setup_cleaners(args, self.config)
+        pool = make_pool(args, self.config)
+        try:
+            return [(p, n['regex']) for p, n in iter_new_names(
+                self.paths, cleaners, pool=pool)]
+        finally:
+            if pool is not None:
+                pool.executor.shutdown()
+
+    def test_serial(self):
+        self.assertEqual(self.results(make_args()), self.expected())
+
+    def test_parallel_keeps_order(self):
+        self.assertEqual(self.results(make_args(jobs=2)), self.expected())
+
+    def test_cascade_in_parallel(self):
+        args = make_args(jobs=2)
+        cleaners = setup_cleaners(args, self.config)
+        pool = make_pool(args, self.config)
+        self.addCleanup(pool.executor.shutdown)
+        self.assertEqual(
+            [(p, n['regex']) for p, n in iter_new_names(
+                self.paths, cleaners, pool=pool, threshold=0.6)],
+            self.expected())
+
+    def test_wrap_strips_extension(self):
+        args = make_args()
+        cleaners = setup_cleaners(args, self.config)
+        (_, names), = iter_new_names(
+            ['/movies/Ed.Wood.XviD.DVD-Rip.avi'], cleaners, action='wrap')
+        self.assertEqual(names['regex'], 'Ed Wood!')
+
+
+class TestCascade(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        config = {
+            'rules_filename': write_rules(self.tmp_dir, RULES),
+            'disabled_rules': [],
+            'guessit': False,
+        }
+        self.regex, = setup_cleaners(make_args(), config)
+        self.fallback = CountingCleaner()
+        self.cleaners = [self.regex, self.fallback]
+
+    def test_fallback_only_for_unconfident_names(self):
+        # The rules leave the resolution and source tags.
+        titles = TITLES + ['Moon.2009.720p.BluRay']
+        new = clean_cascade(self.cleaners, titles, threshold=0.6)
+        unconfident = [t for t in titles
+                       if confidence(naive_clean(RULES, t)) < 0.6]
+        self.assertEqual(unconfident, ['Moon.2009.720p.BluRay'])
+        self.assertEqual(self.fallback.calls, unconfident)
+        self.assertEqual([list(n) for n in new],
+                         [['regex']] * len(TITLES) + [['regex', 'counting']])
+
+    def test_without_threshold_all_cleaners_run(self):
+        clean_cascade(self.cleaners, TITLES)
+        self.assertEqual(self.fallback.calls, TITLES)
+
+    def test_choose_confident(self):
+        items = [
+            ('a', OrderedDict([('regex', 'Knowing (2009)'),
+                               ('counting', 'KNOWING')])),
+            ('b', OrderedDict([('regex', 'Knowing XviD'),
+                               ('counting', 'Knowing (2009)')])),
+            ('c', OrderedDict([('regex', 'Knowing XviD'),
+                               ('counting', 'Knowing.XviD')])),
+        ]
+        tiers = Counter()
+        chosen = [next(iter(n.items())) for _, n in choose_confident(
+            items, self.cleaners, 0.6, tiers)]
+        self.assertEqual(chosen, [('regex', 'Knowing (2009)'),
+                                  ('counting', 'Knowing (2009)'),
+                                  ('regex', 'Knowing XviD')])
+        self.assertEqual(tiers, Counter({'regex': 2, 'counting': 1,
+                                         None: 1}))
+
+
+class TestCleanFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def write(self, data):
+        filename = os.path.join(self.tmp_dir, 'names')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def test_read_lines(self):
+        filename = self.write(b'a.b\r\n\nc/d\n')
+        self.assertEqual(list(read_names([filename])), ['a.b', '', 'c/d'])
+
+    def test_read_null_delimited(self):
+        filename = self.write(b'a\nb\0c\0')
+        self.assertEqual(list(read_names([filename], b'\0')),
+                         ['a\nb', 'c'])
+
+    def test_read_undecodable(self):
+        filename = self.write(b'caf\xe9\n')
+        name, = read_names([filename])
+        self.assertEqual(os.fsencode(name), b'caf\xe9')
+
+    def test_names_are_not_paths(self):
+        cleaner = CountingCleaner()
+        (_, new), = iter_new_names(['AC/DC.Live'], [cleaner], action='name')
+        self.assertEqual(new['counting'], 'AC/DC.LIVE')
+
+    def test_formats(self):
+        new = OrderedDict([('regex', 'Ed Wood'), ('guessit', None)])
+        self.assertEqual(format_clean('Ed.Wood', new, 'Ed Wood', 'plain'),
+                         b'Ed Wood\n')
+        self.assertEqual(format_clean('Ed.Wood', new, 'Ed Wood', 'tsv',
+                                      b'\0'), b'Ed.Wood\tEd Wood\t\0')
+        self.assertEqual(
+            format_clean('Ed.Wood', new, 'Ed Wood', 'jsonl'),
+            b'{"name": "Ed.Wood", "new": {"regex": "Ed Wood", '
+            b'"guessit": null}}\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
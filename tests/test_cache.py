@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+test_cache
+----------------------------------
+
+tests for `antiseptic.cache` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from antiseptic.cache import CachedCleaner, ResultCache
+from antiseptic.cleaner import Cleaner
+
+
+class UpperCleaner(Cleaner):
+    name = 'upper'
+    version = '1'
+
+    def __init__(self):
+        self.calls = 0
+
+    def clean(self, title):
+        self.calls += 1
+        return title.upper()
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.filename = os.path.join(self.tmp_dir, 'cache.sqlite')
+
+    def test_results_persist(self):
+        c = UpperCleaner()
+        with ResultCache(self.filename) as cache:
+            self.assertEqual(CachedCleaner(c, cache).clean('a'), 'A')
+        with ResultCache(self.filename) as cache:
+            self.assertEqual(CachedCleaner(c, cache).clean('a'), 'A')
+            self.assertEqual(cache.hits, 1)
+        self.assertEqual(c.calls, 1)
+
+    def test_version_is_part_of_the_key(self):
+        c = UpperCleaner()
+        with ResultCache(self.filename) as cache:
+            CachedCleaner(c, cache).clean('a')
+            c.version = '2'
+            CachedCleaner(c, cache).clean('a')
+        self.assertEqual(c.calls, 2)
+
+    def test_lru_eviction(self):
+        c = UpperCleaner()
+        with ResultCache(self.filename, max_entries=2) as cache:
+            cc = CachedCleaner(c, cache)
+            cc.clean('a')
+            cc.clean('b')
+            cc.clean('a')
+            cc.clean('c')
+            cache.commit()
+            self.assertEqual(cache.stats()['entries'], 2)
+            self.assertTrue(cache.get(cc._key + ('a',))[0])
+            self.assertFalse(cache.get(cc._key + ('b',))[0])
+
+    def test_invalidate(self):
+        c = UpperCleaner()
+        with ResultCache(self.filename) as cache:
+            CachedCleaner(c, cache).clean('a')
+            cache.invalidate('upper')
+            self.assertEqual(cache.stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+"""
+test_cleaner
+----------------------------------
+
+tests for `antiseptic.cleaner` module.
+"""
+
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from antiseptic.cleaner import (
+    SNAPSHOT_SUFFIX,
+    Cleaner,
+    GuessitCleaner,
+    RegexCleaner,
+    RuleProfile,
+    confidence,
+    fuse_rules,
+    lint_rules,
+    required_literal,
+    risky_constructs,
+)
+
+RULES = [
+    {'id': 'xvid', 'rule': r'(?i)[\.\s\-\[]*xvid\]?', 'weight': 10},
+    {'id': 'dvdrip', 'rule': r'(?i)[\.\s\-\[]*dvd[\.\-]?rip\]?',
+     'weight': 10},
+    {'id': '1337x', 'rule': r'(?i)\s*\{1337x\}', 'weight': 5},
+    {'id': 'group', 'rule': r'-[A-Za-z0-9]+$', 'weight': 20},
+    {'id': 'dots', 'rule': r'\.', 'sub': ' ', 'weight': 30},
+    {'id': 'year', 'rule': r'[\s\[\(]+((?:19|20)\d{2})[\]\)]?',
+     'sub': r' (\1)', 'weight': 40},
+    {'id': 'tail', 'rule': r'\s+$', 'weight': 50},
+    # Introduced by the "dots" substitution only.
+    {'id': 'ed wood', 'rule': r'Ed Wood', 'sub': 'Ed Wood!', 'weight': 35},
+]
+
+TITLES = [
+    'Across.the.Hall.2009.DVDRip.XviD-BeStDivX',
+    'Knowing (2009) [DvdRip] [Xvid] {1337x}-Noir',
+    'Ed.Wood.XviD.DVD-Rip',
+    'The.Hurt.Locker.2008.DVDRiP.XViD',
+    'UP[2009]DvDrip-LW',
+    'Amélie.2001.DVDRip.XviD',
+    'Plain Title',
+]
+
+
+def write_rules(dirname, rules, version='201501010'):
+    filename = os.path.join(dirname, 'rules.json')
+    with open(filename, 'w') as f:
+        json.dump({'version': version, 'rules': rules}, f)
+    return filename
+
+
+def naive_clean(rules, title):
+    for rule in sorted(rules, key=lambda r: r.get('weight', 0)):
+        p = re.compile(rule['rule'])
+        if p.search(title):
+            title = p.sub(rule.get('sub', ''), title)
+    return title
+
+
+class CountingCleaner(Cleaner):
+    name = 'counting'
+
+    def __init__(self):
+        self.calls = []
+
+    def clean(self, title):
+        self.calls.append(title)
+        return title.upper()
+
+
+class TestCleanMany(unittest.TestCase):
+
+    def test_results_in_order(self):
+        c = CountingCleaner()
+        self.assertEqual(list(c.clean_many(['b', 'a', 'b'])), ['B', 'A', 'B'])
+
+    def test_duplicates_cleaned_once(self):
+        c = CountingCleaner()
+        list(c.clean_many(['b', 'a', 'b', 'a']))
+        self.assertEqual(c.calls, ['b', 'a'])
+
+    def test_is_lazy(self):
+        c = CountingCleaner()
+        results = c.clean_many(iter(['a', 'b']))
+        self.assertEqual(next(results), 'A')
+        self.assertEqual(c.calls, ['a'])
+
+
+class TestGuessitCleaner(unittest.TestCase):
+
+    def test_imports_guessit_on_first_clean(self):
+        guessit = types.ModuleType('guessit')
+        guessit.guess_movie_info = mock.Mock(
+            return_value={'title': 'Up', 'year': 2009})
+        with mock.patch.dict(sys.modules, {'guessit': None}):
+            # Importing guessit would fail.
+            c = GuessitCleaner()
+        with mock.patch.dict(sys.modules, {'guessit': guessit}):
+            self.assertEqual(c.clean('Up.2009.DVDRip'), 'Up (2009)')
+            self.assertEqual(list(c.clean_many(['Up.2009.XviD'])),
+                             ['Up (2009)'])
+        self.assertEqual(guessit.guess_movie_info.call_count, 2)
+
+
+class TestConfidence(unittest.TestCase):
+
+    def test_year_raises_confidence(self):
+        self.assertGreater(confidence('Ed Wood (1994)'), confidence('Ed Wood'))
+
+    def test_leftover_tags_lower_confidence(self):
+        self.assertLess(confidence('Ed Wood (1994) XviD'), 0.6)
+        self.assertLess(confidence('Ed.Wood.1994'), 0.6)
+        self.assertEqual(confidence('G.I. Joe The Rise Of Cobra (2009)'), 1)
+
+    def test_no_result(self):
+        self.assertEqual(confidence(None), 0)
+
+
+class TestRequiredLiteral(unittest.TestCase):
+
+    def test_longest_literal(self):
+        p = re.compile(r'(?i)\bxvid\b[\.\s-]*(dvd)?rip')
+        self.assertEqual(required_literal(p), 'xvid')
+
+    def test_optional_parts_are_ignored(self):
+        self.assertIsNone(required_literal(re.compile(r'(?:abc)?\d+')))
+        self.assertEqual(required_literal(re.compile(r'(?:abc)+\d+')), 'abc')
+
+    def test_alternation_has_no_literal(self):
+        self.assertIsNone(required_literal(re.compile(r'dvdrip|bdrip')))
+
+
+class TestRiskyConstructs(unittest.TestCase):
+
+    def risks(self, rule):
+        return risky_constructs(re.compile(rule))
+
+    def test_nested_quantifiers(self):
+        for rule in (r'(a+)+$', r'(?:\w+\s?)*$', r'(\d*)*x'):
+            self.assertEqual(self.risks(rule), ['nested quantifier'], rule)
+
+    def test_separated_repeats_are_safe(self):
+        self.assertEqual(self.risks(r'(?:\.\w+)+'), [])
+        self.assertEqual(self.risks(r'(?:[\.\s]?\d\.\d)?'), [])
+
+    def test_overlapping_alternatives(self):
+        self.assertEqual(self.risks(r'(?:dvd|dvdrip)+$'),
+                         ['overlapping alternatives in a repeat'])
+        self.assertEqual(self.risks(r'(?:dvd|rip)+$'), [])
+
+    def test_rules_are_safe(self):
+        for rule in RULES:
+            self.assertEqual(self.risks(rule['rule']), [], rule['id'])
+
+    def test_lint_rules(self):
+        rules = RULES + [
+            {'id': 'dots', 'rule': r'_'},
+            {'id': 'broken', 'rule': r'(x'},
+            {'id': 'nested', 'rule': r'(x+)+y'},
+            {'rule': r'y'},
+        ]
+        problems = lint_rules({'rules': rules})
+        self.assertEqual([rule_id for rule_id, _ in problems],
+                         ['dots', 'broken', 'nested', None])
+        self.assertEqual(problems[2], ('nested', 'nested quantifier'))
+
+    def test_risky_rules_are_loaded_with_a_warning(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        filename = write_rules(tmp_dir, [{'id': 'nested', 'rule': r'(x+)+y'}])
+        c = RegexCleaner()
+        with self.assertLogs('antiseptic.cleaner', 'WARNING') as logs:
+            c.load_rules(filename, snapshot=False)
+        self.assertIn('nested', logs.output[0])
+        self.assertEqual(c.clean('xxy'), '')
+
+
+class TestRegexCleaner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.filename = write_rules(self.tmp_dir, RULES)
+
+    def test_clean_matches_naive_implementation(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        for title in TITLES:
+            self.assertEqual(c.clean(title), naive_clean(RULES, title))
+
+    def test_clean_many_matches_clean(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        self.assertEqual(list(c.clean_many(TITLES + TITLES)),
+                         [c.clean(t) for t in TITLES + TITLES])
+
+    def test_rule_enabled_by_previous_substitution(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        self.assertEqual(c.clean('Ed.Wood.XviD.DVD-Rip'), 'Ed Wood!')
+
+    def test_candidates_skip_rules_without_literal(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        ids = {c.rules[p]['id'] for p in c.candidates('Plain Title')}
+        self.assertNotIn('xvid', ids)
+        self.assertNotIn('1337x', ids)
+        self.assertNotIn('dots', ids)
+        self.assertIn('tail', ids)
+
+    def test_trace(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        self.assertEqual(c.trace('Ed.Wood.XviD.DVD-Rip'),
+                         ('Ed Wood!', ['xvid', 'dvdrip', 'dots', 'ed wood']))
+        # Up to and from the "dots" rule.
+        stop = [r['id'] for r in c.rules].index('dots')
+        self.assertEqual(c.trace('Ed.Wood.XviD', stop=stop),
+                         ('Ed.Wood', ['xvid']))
+        self.assertEqual(c.trace('Ed.Wood.XviD', start=stop),
+                         ('Ed Wood! XviD', ['dots', 'ed wood']))
+
+    def test_disabled_rules(self):
+        c = RegexCleaner(disabled={'dots'})
+        c.load_rules(self.filename)
+        self.assertNotIn('dots', [r['id'] for r in c.rules])
+
+    def test_remove_rules(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        c.remove_rules(['dots'])
+        self.assertIn('dots', c.disabled)
+        rules = [r for r in RULES if r['id'] != 'dots']
+        for title in TITLES:
+            self.assertEqual(c.clean(title), naive_clean(rules, title))
+
+
+FUSABLE_RULES = [
+    {'id': 'dots', 'rule': r'\.', 'sub': ' ', 'weight': 10},
+    {'id': 'underscores', 'rule': r'_+', 'sub': ' ', 'weight': 10},
+    {'id': 'tilde', 'rule': r'~', 'sub': ' ', 'weight': 11},
+    {'id': 'lead', 'rule': r'^[\-+]+', 'weight': 20},
+    {'id': 'brackets', 'rule': r'[\[\]{}]+', 'weight': 20},
+    {'id': 'hashes', 'rule': r'#+', 'weight': 21},
+    # Not fusable: "x-y" may be created by the removal of brackets.
+    {'id': 'xy', 'rule': r'x-y', 'weight': 22},
+    {'id': 'pipes', 'rule': r'\|', 'sub': '-', 'weight': 23},
+    {'id': 'year', 'rule': r'\s*\((\d{4})\)', 'sub': r' [\1]', 'weight': 30},
+]
+
+
+class TestFuseRules(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.filename = write_rules(self.tmp_dir, FUSABLE_RULES)
+
+    def load(self, rules):
+        for rule in rules:
+            rule['pattern'] = re.compile(rule['rule'])
+        return fuse_rules(rules)
+
+    def test_fuses_runs_of_independent_rules(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        self.assertEqual(
+            [r['id'] for r in c.rules],
+            ['dots+underscores+tilde', 'lead+brackets+hashes', 'xy',
+             'pipes', 'year'])
+
+    def test_optimize_disabled(self):
+        c = RegexCleaner(optimize=False)
+        c.load_rules(self.filename)
+        self.assertEqual(len(c.rules), len(FUSABLE_RULES))
+
+    def test_overlapping_characters_are_not_fused(self):
+        rules = self.load([
+            {'id': 'a', 'rule': r'[ab]', 'sub': ' '},
+            {'id': 'b', 'rule': r'b', 'sub': ' '},
+        ])
+        self.assertEqual([r['id'] for r in rules], ['a', 'b'])
+
+    def test_sub_feeding_a_rule_is_not_fused(self):
+        rules = self.load([
+            {'id': 'a', 'rule': r'a', 'sub': 'b'},
+            {'id': 'b', 'rule': r'b', 'sub': 'b'},
+        ])
+        self.assertEqual([r['id'] for r in rules], ['a', 'b'])
+
+    def test_unbounded_rules_are_not_fused(self):
+        rules = self.load([
+            {'id': 'a', 'rule': r'\.', 'sub': ' '},
+            {'id': 'b', 'rule': r'\s', 'sub': ' '},
+            {'id': 'c', 'rule': r'[^a]', 'sub': ' '},
+        ])
+        self.assertEqual([r['id'] for r in rules], ['a', 'b', 'c'])
+
+    def test_fused_rules_are_prefiltered(self):
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        self.assertEqual([c.rules[p]['id'] for p in c.candidates('Plain')],
+                         ['lead+brackets+hashes'])
+
+    def test_snapshot_keeps_fused_rules(self):
+        RegexCleaner().load_rules(self.filename)
+        c = RegexCleaner()
+        self.assertTrue(c.load_snapshot(self.filename))
+        self.assertEqual(len(c.rules), 5)
+        self.assertFalse(RegexCleaner(optimize=False).load_snapshot(
+            self.filename))
+
+    def test_equivalence_over_corpus(self):
+        fused, plain = RegexCleaner(), RegexCleaner(optimize=False)
+        fused.load_rules(self.filename, snapshot=False)
+        plain.load_rules(self.filename, snapshot=False)
+        rnd = random.Random(0)
+        alphabet = 'ax-y._~+[]{}#| (1999)'
+        corpus = TITLES + [''.join(p) for p in itertools.product(
+            'x-y.[#', repeat=4)]
+        corpus += [''.join(rnd.choice(alphabet) for _ in range(12))
+                   for _ in range(2000)]
+        for title in corpus:
+            self.assertEqual(fused.clean(title),
+                             naive_clean(FUSABLE_RULES, title), title)
+            self.assertEqual(fused.clean(title), plain.clean(title), title)
+
+
+class TestRuleProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cleaner = RegexCleaner()
+        self.cleaner.load_rules(write_rules(self.tmp_dir, RULES))
+        self.cleaner.profile = RuleProfile()
+
+    def test_counts(self):
+        self.assertEqual(self.cleaner.clean('Ed.Wood.XviD.DVD-Rip'),
+                         'Ed Wood!')
+        stats = {r['id']: r for r in self.cleaner.profile.as_dict()['rules']}
+        self.assertEqual(self.cleaner.profile.titles, 1)
+        self.assertEqual(stats['dots']['substitutions'], 1)
+        self.assertEqual(stats['ed wood']['matches'], 1)
+        # Skipped by the prefilter.
+        self.assertNotIn('1337x', stats)
+        for r in stats.values():
+            self.assertEqual(r['evaluations'], 1)
+
+    def test_results_unchanged(self):
+        for title in TITLES:
+            self.assertEqual(self.cleaner.clean(title),
+                             naive_clean(RULES, title))
+
+    def test_slowest_rules_first(self):
+        list(self.cleaner.clean_many(TITLES))
+        seconds = [r['seconds'] for r in
+                   self.cleaner.profile.as_dict()['rules']]
+        self.assertEqual(seconds, sorted(seconds, reverse=True))
+
+
+class TestRulesSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.filename = write_rules(self.tmp_dir, RULES)
+
+    def test_snapshot_written_on_first_load(self):
+        RegexCleaner().load_rules(self.filename)
+        self.assertTrue(os.path.exists(self.filename + SNAPSHOT_SUFFIX))
+
+    def test_snapshot_gives_same_results(self):
+        RegexCleaner().load_rules(self.filename)
+        c = RegexCleaner()
+        self.assertTrue(c.load_snapshot(self.filename))
+        self.assertEqual(c.version, '201501010')
+        for title in TITLES:
+            self.assertEqual(c.clean(title), naive_clean(RULES, title))
+
+    def test_disabled_rules_change_invalidates(self):
+        RegexCleaner().load_rules(self.filename)
+        c = RegexCleaner(disabled={'dots'})
+        self.assertFalse(c.load_snapshot(self.filename))
+
+    def test_rules_change_invalidates(self):
+        RegexCleaner().load_rules(self.filename)
+        write_rules(self.tmp_dir, RULES[:2], version='201501020')
+        c = RegexCleaner()
+        c.load_rules(self.filename)
+        self.assertEqual(c.version, '201501020')
+        self.assertEqual(len(c.rules), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+test_fsops
+----------------------------------
+
+tests for `antiseptic.fsops` module.
+"""
+
+import errno
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from antiseptic import fsops
+from antiseptic.fsops import (
+    LOCK_FILENAME,
+    FSExecutor,
+    copy_file,
+    directory_lock,
+    move,
+    rename,
+    wrap,
+)
+
+
+class TestOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_rename_refuses_to_overwrite(self):
+        for name in ('a', 'b'):
+            os.mkdir(os.path.join(self.root, name))
+        with self.assertRaises(FileExistsError):
+            rename(os.path.join(self.root, 'a'), 'b')
+
+    def test_concurrent_renames_to_one_target(self):
+        for name in ('a', 'b'):
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write(name)
+        real_move = fsops.move
+
+        def slow_move(src, dst):
+            time.sleep(0.1)
+            real_move(src, dst)
+
+        executor = FSExecutor(2)
+        with mock.patch.object(fsops, 'move', slow_move), \
+                self.assertLogs('antiseptic.fsops', 'ERROR'):
+            for name in ('a', 'b'):
+                executor.submit(os.path.join(self.root, name),
+                                rename, os.path.join(self.root, name), 'c')
+            executor.shutdown()
+        self.assertEqual(executor.failed, 1)
+        self.assertEqual(len(os.listdir(self.root)), 2)
+
+    def test_wrap(self):
+        path = os.path.join(self.root, 'Up.2009.avi')
+        open(path, 'w').close()
+        wrap(path, 'Up (2009)')
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.root, 'Up (2009)', 'Up.2009.avi')))
+
+    def test_wrap_with_companions(self):
+        paths = [os.path.join(self.root, f)
+                 for f in ('Up.2009.avi', 'Up.2009.srt', 'Up.2009.nfo')]
+        for path in paths:
+            open(path, 'w').close()
+        wrap(paths[0], 'Up (2009)', companions=paths[1:])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.root, 'Up (2009)'))),
+            ['Up.2009.avi', 'Up.2009.nfo', 'Up.2009.srt'])
+
+
+def _hold_lock(directory, locked, release):
+    with directory_lock(directory):
+        locked.set()
+        release.wait(5)
+
+
+class TestDirectoryLock(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_locked_rename(self):
+        os.mkdir(os.path.join(self.root, 'Up.2009'))
+        rename(os.path.join(self.root, 'Up.2009'), 'Up (2009)', lock=True)
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         [LOCK_FILENAME, 'Up (2009)'])
+
+    def test_excludes_threads(self):
+        inside, overlaps = [0], []
+
+        def hold():
+            with directory_lock(self.root):
+                inside[0] += 1
+                overlaps.append(inside[0])
+                time.sleep(0.01)
+                inside[0] -= 1
+
+        threads = [threading.Thread(target=hold) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(overlaps, [1] * 4)
+
+    def test_excludes_processes(self):
+        ctx = multiprocessing.get_context('fork')
+        locked, release = ctx.Event(), ctx.Event()
+        p = ctx.Process(target=_hold_lock,
+                        args=(self.root, locked, release))
+        p.start()
+        self.addCleanup(p.join)
+        self.assertTrue(locked.wait(5))
+        acquired = threading.Event()
+
+        def acquire():
+            with directory_lock(self.root):
+                acquired.set()
+
+        t = threading.Thread(target=acquire)
+        t.start()
+        self.assertFalse(acquired.wait(0.1))
+        release.set()
+        t.join(5)
+        self.assertTrue(acquired.is_set())
+
+
+class TestCrossDeviceMove(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.data = os.urandom(300000)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def write(self, *parts):
+        with open(self.path(*parts), 'wb') as f:
+            f.write(self.data)
+        os.utime(self.path(*parts), (1000000000, 1000000000))
+
+    def exdev(self):
+        # Renames fail as they do between filesystems.
+        return mock.patch('os.rename', side_effect=OSError(
+            errno.EXDEV, 'Invalid cross-device link'))
+
+    def test_copy_file_keeps_data_and_metadata(self):
+        self.write('a')
+        os.chmod(self.path('a'), 0o640)
+        with mock.patch.object(fsops, 'COPY_CHUNK_SIZE', 65536):
+            copy_file(self.path('a'), self.path('b'))
+        with open(self.path('b'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        st = os.stat(self.path('b'))
+        self.assertEqual(st.st_mode & 0o777, 0o640)
+        self.assertEqual(st.st_mtime, 1000000000)
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                         'changing the owner of a file requires root')
+    def test_copy_file_keeps_owner(self):
+        self.write('a')
+        os.chown(self.path('a'), 1234, 4321)
+        copy_file(self.path('a'), self.path('b'))
+        st = os.stat(self.path('b'))
+        self.assertEqual((st.st_uid, st.st_gid), (1234, 4321))
+
+    def test_copy_file_refuses_to_overwrite(self):
+        self.write('a')
+        self.write('b')
+        with self.assertRaises(FileExistsError):
+            copy_file(self.path('a'), self.path('b'))
+
+    def test_move_file(self):
+        self.write('a')
+        with self.exdev():
+            move(self.path('a'), self.path('b'))
+        self.assertFalse(os.path.exists(self.path('a')))
+        with open(self.path('b'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_move_directory(self):
+        os.makedirs(self.path('Up', 'Subs'))
+        self.write('Up', 'Up.avi')
+        self.write('Up', 'Subs', 'en.srt')
+        with self.exdev():
+            wrap(self.path('Up'), 'Up (2009)')
+        self.assertFalse(os.path.exists(self.path('Up')))
+        with open(self.path('Up (2009)', 'Up', 'Subs', 'en.srt'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_wrap_into(self):
+        os.mkdir(self.path('movies'))
+        self.write('Up.2009.avi')
+        self.write('Up.2009.srt')
+        with self.exdev():
+            wrap(self.path('Up.2009.avi'), 'Up (2009)',
+                 companions=[self.path('Up.2009.srt')],
+                 into=self.path('movies'), lock=True)
+        self.assertEqual(sorted(os.listdir(self.root)), ['movies'])
+        self.assertEqual(
+            sorted(os.listdir(self.path('movies', 'Up (2009)'))),
+            ['Up.2009.avi', 'Up.2009.srt'])
+
+    def test_copy_falls_back_when_nothing_is_copied(self):
+        self.write('a')
+        with mock.patch.object(
+                fsops, '_COPIES', (lambda *args: 0, fsops._read_write)), \
+                mock.patch.object(fsops, '_reflink', return_value=False):
+            copy_file(self.path('a'), self.path('b'))
+        with open(self.path('b'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_failed_copy_keeps_source(self):
+        self.write('a')
+        with self.exdev(), mock.patch.object(
+                fsops, '_COPIES', (lambda *args: 0,)), \
+                mock.patch.object(fsops, '_reflink', return_value=False):
+            with self.assertRaises(OSError):
+                move(self.path('a'), self.path('b'))
+        self.assertTrue(os.path.exists(self.path('a')))
+        self.assertFalse(os.path.exists(self.path('b')))
+
+
+class TestFSExecutor(unittest.TestCase):
+
+    def test_per_device_limit(self):
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def op():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        with FSExecutor(8, per_device=2) as executor:
+            for i in range(10):
+                executor.submit('/tmp/%d' % i, op)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(executor.done, 10)
+
+    def test_children_complete_before_parent(self):
+        order = []
+
+        def op(name, delay):
+            time.sleep(delay)
+            order.append(name)
+
+        with FSExecutor(4) as executor:
+            executor.submit('/lib/a/child', op, 'child', 0.05)
+            executor.submit('/lib/a', op, 'parent', 0)
+        self.assertEqual(order, ['child', 'parent'])
+
+    def test_failures_are_counted(self):
+        def op():
+            raise OSError('boom')
+
+        with FSExecutor(2) as executor:
+            executor.submit('/tmp/x', op)
+        self.assertEqual(executor.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+test_guard
+----------------------------------
+
+tests for `antiseptic.guard` module.
+"""
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from antiseptic.cleaner import RegexCleaner
+from antiseptic.guard import GuardedCleaner
+
+from .test_cleaner import RULES, TITLES, naive_clean, write_rules
+
+# Backtracks for minutes on a long run of "a"s which isn't followed by "b".
+SLOW_RULE = {'id': 'slow', 'rule': r'(a+)+b', 'weight': 45}
+SLOW_TITLE = 'Ed.Wood.' + 'a' * 40
+
+
+class TestGuardedCleaner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        filename = write_rules(self.tmp_dir, RULES + [SLOW_RULE])
+        c = RegexCleaner()
+        with self.assertLogs('antiseptic.cleaner', 'WARNING'):
+            c.load_rules(filename, snapshot=False)
+        self.cleaner = GuardedCleaner(c, timeout=0.5)
+        self.addCleanup(self.cleaner.close)
+
+    def test_results_unchanged(self):
+        self.assertEqual(list(self.cleaner.clean_many(TITLES)),
+                         [naive_clean(RULES + [SLOW_RULE], t)
+                          for t in TITLES])
+        self.assertEqual(self.cleaner.quarantined, [])
+
+    def test_duplicates_sent_once(self):
+        titles = TITLES[:2] * 3
+        with mock.patch.object(self.cleaner, '_clean_chunk',
+                               wraps=self.cleaner._clean_chunk) as clean:
+            results = list(self.cleaner.clean_many(titles))
+        self.assertEqual(results, [naive_clean(RULES, t) for t in titles])
+        clean.assert_called_once_with(TITLES[:2])
+
+    def test_slow_rule_is_quarantined(self):
+        titles = [TITLES[0], SLOW_TITLE] + TITLES[1:]
+        with self.assertLogs('antiseptic.guard', 'WARNING') as logs:
+            results = list(self.cleaner.clean_many(titles))
+        self.assertIn('slow', logs.output[0])
+        self.assertEqual(results, [naive_clean(RULES, t) for t in titles])
+        self.assertEqual(self.cleaner.quarantined, ['slow'])
+        self.assertIn('slow', self.cleaner.disabled)
+        self.assertEqual(self.cleaner.clean('Up.aab'), 'Up aab')
+
+    def test_quarantine_with_rules_from_snapshot(self):
+        filename = write_rules(self.tmp_dir, RULES + [SLOW_RULE])
+        with self.assertLogs('antiseptic.cleaner', 'WARNING'):
+            RegexCleaner().load_rules(filename)
+        c = RegexCleaner()
+        c.load_rules(filename)
+        self.assertTrue(all('pattern' not in r for r in c.rules))
+        cleaner = GuardedCleaner(c, timeout=0.5)
+        self.addCleanup(cleaner.close)
+        titles = [SLOW_TITLE] + TITLES
+        with self.assertLogs('antiseptic.guard', 'WARNING'):
+            results = list(cleaner.clean_many(titles))
+        self.assertEqual(results, [naive_clean(RULES, t) for t in titles])
+        self.assertEqual(cleaner.quarantined, ['slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
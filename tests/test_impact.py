@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+test_impact
+----------------------------------
+
+tests for `antiseptic.impact` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from antiseptic.impact import (
+    ADDED,
+    MODIFIED,
+    REMOVED,
+    changed_rules,
+    rule_impact,
+)
+
+from .test_cleaner import RULES, TITLES, naive_clean, write_rules
+
+NEW_RULES = [r for r in RULES if r['id'] != 'xvid'] + [
+    {'id': 'bang', 'rule': r'!$', 'weight': 60},
+]
+NEW_RULES = [dict(r, sub='_') if r['id'] == 'dots' else r
+             for r in NEW_RULES]
+
+
+class TestRuleImpact(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        for name in ('old', 'new'):
+            os.mkdir(os.path.join(self.tmp_dir, name))
+        self.old = write_rules(os.path.join(self.tmp_dir, 'old'), RULES)
+        self.new = write_rules(os.path.join(self.tmp_dir, 'new'), NEW_RULES,
+                               version='201501020')
+
+    def impact(self, names, **kwargs):
+        counts = Counter()
+        records = list(rule_impact(self.old, self.new, names, counts,
+                                   **kwargs))
+        return records, counts
+
+    def test_changed_rules(self):
+        self.assertEqual(
+            changed_rules({'rules': RULES}, {'rules': NEW_RULES}),
+            {'xvid': REMOVED, 'bang': ADDED, 'dots': MODIFIED})
+
+    def test_changes(self):
+        records, counts = self.impact(TITLES + TITLES)
+        self.assertEqual(counts, Counter(total=14, distinct=7))
+        expected = [(t, naive_clean(RULES, t), naive_clean(NEW_RULES, t))
+                    for t in TITLES]
+        self.assertEqual(
+            [(r['name'], r['old'], r['new']) for r in records],
+            [e for e in expected if e[1] != e[2]])
+
+    def test_rules_causing_changes(self):
+        records, _ = self.impact(['Ed.Wood.XviD.DVD-Rip', 'Plain Title'])
+        record, = records
+        self.assertEqual(record['old'], 'Ed Wood!')
+        self.assertEqual(record['new'], 'Ed_Wood_XviD')
+        # "dvdrip" applies under both, "ed wood" only after the old "dots".
+        self.assertEqual(record['rules'], ['xvid', 'dots', 'ed wood'])
+
+    def test_parallel_gives_same_changes(self):
+        names = TITLES * 3 + ['%s %d' % (t, i) for i, t in enumerate(TITLES)]
+        self.assertEqual(self.impact(names, jobs=2), self.impact(names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+test_import_time
+----------------------------------
+
+import time regression tests for the `antiseptic` CLI.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Generous, so that slow CI machines pass, but far below the cost of
+# importing the network, database or guessit stacks.
+IMPORT_BUDGET_US = 150000
+
+
+def import_times(module):
+    """Return {module name: cumulative import time in us} for `module`."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.STDOUT, env=env, universal_newlines=True)
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_cli_defers_heavy_imports(self):
+        times = import_times('antiseptic.antiseptic')
+        for module in ('antiseptic.cleaner', 'antiseptic.cache', 'guessit',
+                       'sqlite3', 'urllib.request', 'difflib'):
+            self.assertNotIn(module, times)
+
+    def test_cleaner_defers_guessit(self):
+        times = import_times('antiseptic.cleaner')
+        self.assertNotIn('guessit', times)
+        self.assertNotIn('urllib.request', times)
+
+    def test_cli_import_budget(self):
+        times = import_times('antiseptic.antiseptic')
+        self.assertLess(times['antiseptic'], IMPORT_BUDGET_US)
+
+
+if __name__ == '__main__':
+    unittest.main()
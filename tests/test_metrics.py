@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+test_metrics
+----------------------------------
+
+tests for `antiseptic.metrics` module.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from antiseptic import metrics
+from antiseptic.metrics import Metrics, TimedCleaner, recording
+
+from .test_cleaner import CountingCleaner
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.filename = os.path.join(self.tmp_dir, 'antiseptic.prom')
+
+    def test_counters_and_gauges(self):
+        m = Metrics(self.filename)
+        m.inc('antiseptic_entries_renamed_total', action='wrap')
+        m.inc('antiseptic_entries_renamed_total', 2, action='wrap')
+        m.inc('antiseptic_entries_skipped_total', reason='say "hi"')
+        m.set('antiseptic_rules_load_seconds', 0.5)
+        lines = m.format().splitlines()
+        self.assertIn('# TYPE antiseptic_entries_renamed_total counter',
+                      lines)
+        self.assertIn('antiseptic_entries_renamed_total{action="wrap"} 3',
+                      lines)
+        self.assertIn(
+            'antiseptic_entries_skipped_total{reason="say \\"hi\\""} 1',
+            lines)
+        self.assertIn('antiseptic_rules_load_seconds 0.5', lines)
+        self.assertEqual(lines[-1], '# EOF')
+
+    def test_histogram(self):
+        m = Metrics(self.filename, buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5.0):
+            m.observe('antiseptic_fs_op_seconds', value, op='rename')
+        lines = [l for l in m.format().splitlines()
+                 if not l.startswith('#')]
+        self.assertEqual(lines, [
+            'antiseptic_fs_op_seconds_bucket{op="rename",le="0.1"} 1',
+            'antiseptic_fs_op_seconds_bucket{op="rename",le="1.0"} 3',
+            'antiseptic_fs_op_seconds_bucket{op="rename",le="+Inf"} 4',
+            'antiseptic_fs_op_seconds_sum{op="rename"} 6.25',
+            'antiseptic_fs_op_seconds_count{op="rename"} 4',
+        ])
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            Metrics(self.filename).inc('antiseptic_unknown_total')
+
+    def test_recording_writes_atomically(self):
+        with recording(self.filename) as m:
+            self.assertIs(metrics.current, m)
+            m.inc('antiseptic_entries_scanned_total')
+        self.assertIsNone(metrics.current)
+        self.assertEqual(os.listdir(self.tmp_dir), ['antiseptic.prom'])
+        with open(self.filename) as f:
+            self.assertIn('antiseptic_entries_scanned_total 1\n', f.read())
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode),
+                         0o644)
+
+    def test_timed_without_recording(self):
+        self.assertIsNone(metrics.current)
+        self.assertEqual(
+            metrics.timed('antiseptic_fs_op_seconds', max, 1, 2, op='x'), 2)
+
+
+class TestTimedCleaner(unittest.TestCase):
+
+    def test_names_are_timed(self):
+        m = Metrics(None)
+        c = TimedCleaner(CountingCleaner(), m)
+        self.assertEqual(list(c.clean_many(['a', 'b', 'a'])),
+                         ['A', 'B', 'A'])
+        self.assertEqual(c.clean('c'), 'C')
+        _, total, count = m.values[
+            ('antiseptic_clean_seconds', (('cleaner', 'counting'),))]
+        self.assertEqual(count, 4)
+
+    def test_time_spent_producing_names_is_not_counted(self):
+        m = Metrics(None)
+        c = TimedCleaner(CountingCleaner(), m)
+
+        def slow_names():
+            for name in ('a', 'b'):
+                time.sleep(0.05)
+                yield name
+
+        self.assertEqual(list(c.clean_many(slow_names())), ['A', 'B'])
+        _, total, count = m.values[
+            ('antiseptic_clean_seconds', (('cleaner', 'counting'),))]
+        self.assertEqual(count, 2)
+        self.assertLess(total, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
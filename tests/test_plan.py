@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+test_plan
+----------------------------------
+
+tests for `antiseptic.plan` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from antiseptic.fsops import LOCK_FILENAME, FSExecutor
+from antiseptic.plan import (
+    COLLISION,
+    DONE,
+    EXISTS,
+    FAILED,
+    NOOP,
+    OK,
+    TargetIndex,
+    apply_plan,
+    journaled,
+    merge,
+    plan_entry,
+    undo,
+    write_jsonl,
+)
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.journal = os.path.join(self.root, 'plan.journal')
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def touch(self, name):
+        open(self.path(name), 'w').close()
+
+    def test_statuses(self):
+        for name in ('A.2009.DVDRip', 'A.2009.XviD', 'B (2009)', 'C'):
+            os.mkdir(self.path(name))
+        index = TargetIndex()
+        statuses = [
+            plan_entry(self.path(old), new, 'regex', index)['status']
+            for old, new in (('A.2009.DVDRip', 'A (2009)'),
+                             ('A.2009.XviD', 'A (2009)'),
+                             ('B (2009)', 'B (2009)'),
+                             ('C', 'B (2009)'))
+        ]
+        self.assertEqual(statuses, [OK, COLLISION, NOOP, EXISTS])
+
+    def test_apply_and_undo_wrap(self):
+        self.touch('Up.2009.avi')
+        index = TargetIndex()
+        entry = plan_entry(self.path('Up.2009.avi'), 'Up (2009)', 'regex',
+                           index, action='wrap')
+        counts = apply_plan([entry], self.journal)
+        self.assertEqual(counts['done'], 1)
+        self.assertTrue(os.path.isfile(self.path('Up (2009)', 'Up.2009.avi')))
+
+        counts = undo(self.journal)
+        self.assertEqual(counts['undone'], 1)
+        self.assertTrue(os.path.isfile(self.path('Up.2009.avi')))
+        self.assertFalse(os.path.exists(self.path('Up (2009)')))
+
+    def test_apply_and_undo_wrap_into(self):
+        os.mkdir(self.path('movies'))
+        self.touch('Up.2009.avi')
+        entry = plan_entry(self.path('Up.2009.avi'), 'Up (2009)', 'regex',
+                           TargetIndex(), action='wrap',
+                           into=self.path('movies'))
+        self.assertEqual(entry['target'],
+                         self.path('movies', 'Up (2009)', 'Up.2009.avi'))
+        counts = apply_plan([entry], self.journal)
+        self.assertEqual(counts['done'], 1)
+        self.assertTrue(os.path.isfile(entry['target']))
+
+        counts = undo(self.journal)
+        self.assertEqual(counts['undone'], 1)
+        self.assertTrue(os.path.isfile(self.path('Up.2009.avi')))
+        self.assertEqual(os.listdir(self.path('movies')), [])
+
+    def test_apply_and_undo_wrap_with_companions(self):
+        for name in ('Up.2009.avi', 'Up.2009.srt'):
+            self.touch(name)
+        index = TargetIndex()
+        entry = plan_entry(self.path('Up.2009.avi'), 'Up (2009)', 'regex',
+                           index, action='wrap',
+                           companions=[self.path('Up.2009.srt')])
+        self.assertEqual(entry['status'], OK)
+        apply_plan([entry], self.journal)
+        self.assertEqual(sorted(os.listdir(self.path('Up (2009)'))),
+                         ['Up.2009.avi', 'Up.2009.srt'])
+
+        counts = undo(self.journal)
+        self.assertEqual(counts['undone'], 1)
+        self.assertTrue(os.path.isfile(self.path('Up.2009.srt')))
+        self.assertFalse(os.path.exists(self.path('Up (2009)')))
+
+    def test_companion_collision(self):
+        self.touch('Up.2009.avi')
+        index = TargetIndex()
+        plan_entry(self.path('Up.2009.srt'), 'Up (2009)', 'regex', index,
+                   action='wrap')
+        entry = plan_entry(self.path('Up.2009.avi'), 'Up (2009)', 'regex',
+                           index, action='wrap',
+                           companions=[self.path('Up.2009.srt')])
+        self.assertEqual(entry['status'], COLLISION)
+
+    def test_apply_again_after_undo(self):
+        for name in ('a', 'b'):
+            self.touch(name)
+        index = TargetIndex()
+        plan = [plan_entry(self.path(n), n.upper() + '!', 'regex', index)
+                for n in ('a', 'b')]
+        apply_plan(plan, self.journal)
+        self.assertEqual(undo(self.journal)['undone'], 2)
+        self.assertEqual({r['status'] for r in
+                          journaled(self.journal).values()}, {'undone'})
+
+        counts = apply_plan(plan, self.journal)
+        self.assertEqual(counts['done'], 2)
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['A!', 'B!', 'plan.journal'])
+        self.assertEqual(undo(self.journal)['undone'], 2)
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['a', 'b', 'plan.journal'])
+
+    def test_resume(self):
+        for name in ('a', 'b'):
+            self.touch(name)
+        index = TargetIndex()
+        plan = [plan_entry(self.path(n), n.upper() + '!', 'regex', index)
+                for n in ('a', 'b')]
+        apply_plan(plan[:1], self.journal)
+        # Moved, but the crash happened before it was journaled.
+        os.rename(self.path('b'), self.path('B!'))
+
+        counts = apply_plan(plan, self.journal)
+        self.assertEqual(counts['resumed'], 1)
+        self.assertEqual(counts['done'], 1)
+        self.assertEqual(sorted(journaled(self.journal)), [0, 1])
+
+    def test_apply_concurrently(self):
+        index = TargetIndex()
+        plan = []
+        for i in range(20):
+            self.touch('m%d' % i)
+            plan.append(plan_entry(self.path('m%d' % i), 'M%d' % i, 'regex',
+                                   index))
+        with FSExecutor(4) as executor:
+            counts = apply_plan(plan, self.journal, batch_size=3,
+                                executor=executor)
+        self.assertEqual(counts['done'], 20)
+        self.assertEqual(sorted(journaled(self.journal)), list(range(20)))
+        self.assertTrue(os.path.exists(self.path('M19')))
+
+    def test_failures_are_journaled(self):
+        index = TargetIndex()
+        entry = plan_entry(self.path('missing'), 'Found', 'regex', index)
+        counts = apply_plan([entry], self.journal)
+        self.assertEqual(counts['failed'], 1)
+        self.assertEqual(journaled(self.journal)[0]['status'], 'failed')
+
+    def write_plan(self, name, moves, shard):
+        index = TargetIndex()
+        plan = [plan_entry(self.path(old), new, 'regex', index, shard=shard)
+                for old, new in moves]
+        with open(self.path(name), 'w') as f:
+            write_jsonl(plan, f)
+        return self.path(name)
+
+    def test_shard_entries_are_applied_under_lock(self):
+        os.mkdir(self.path('Up.2009'))
+        plan = self.write_plan('1.plan', [('Up.2009', 'Up (2009)')], (1, 2))
+        entry, = merge([plan])
+        self.assertEqual(entry['shard'], '1/2')
+        self.assertEqual(apply_plan([entry], self.journal)[DONE], 1)
+        self.assertTrue(os.path.exists(self.path(LOCK_FILENAME)))
+
+    def test_merge_finds_collisions_between_shards(self):
+        for name in ('Up.2009', 'Up.2009.XviD', 'Heat.1995'):
+            os.mkdir(self.path(name))
+        plans = [
+            self.write_plan('1.plan', [('Up.2009', 'Up (2009)')], (1, 2)),
+            self.write_plan('2.plan', [('Up.2009.XviD', 'Up (2009)'),
+                                       ('Heat.1995', 'Heat (1995)')], (2, 2)),
+        ]
+        self.assertEqual([r['status'] for r in merge(plans)],
+                         [OK, COLLISION, OK])
+
+    def test_merge_keeps_the_last_journal_record(self):
+        records = [{'seq': 0, 'source': 'a', 'target': 'A', 'status': FAILED},
+                   {'seq': 1, 'source': 'b', 'target': 'B', 'status': DONE},
+                   {'seq': 0, 'source': 'a', 'target': 'A', 'status': DONE}]
+        with open(self.journal, 'w') as f:
+            write_jsonl(records, f)
+        self.assertEqual([(r['source'], r['status'])
+                          for r in merge([self.journal])],
+                         [('a', DONE), ('b', DONE)])
+
+
+if __name__ == '__main__':
+    unittest.main()
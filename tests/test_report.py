@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+test_report
+----------------------------------
+
+tests for `antiseptic.report` module.
+"""
+
+import io
+import json
+import unittest
+
+from antiseptic.report import Report
+
+RECORDS = [
+    {'action': 'rename', 'status': 'ok', 'source': '/m/A.2009.DVDRip',
+     'target': '/m/A (2009)', 'cleaner': 'regex'},
+    {'action': 'rename', 'status': 'collision', 'source': '/m/A.2009.XviD',
+     'target': '/m/A (2009)', 'cleaner': 'regex'},
+    {'action': 'rename', 'status': 'noop', 'source': '/m/B (2009)',
+     'target': '/m/B (2009)', 'cleaner': 'regex'},
+    {'action': 'wrap', 'status': 'unclean', 'source': '/m/x.avi',
+     'target': None, 'cleaner': 'regex'},
+]
+
+
+class CountingWriter(io.StringIO):
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, s):
+        self.writes += 1
+        return super().write(s)
+
+
+def report(fmt, records=RECORDS, **kwargs):
+    out = CountingWriter()
+    with Report(fmt, out, **kwargs) as r:
+        for record in records:
+            r.add(dict(record))
+    return r, out
+
+
+class TestReport(unittest.TestCase):
+
+    def test_summary(self):
+        r, _ = report('jsonl')
+        self.assertEqual(r.summary(), {'changed': 1, 'unchanged': 1,
+                                       'collisions': 1, 'failed': 1})
+
+    def test_jsonl(self):
+        _, out = report('jsonl')
+        self.assertEqual([json.loads(l) for l in out.getvalue().splitlines()],
+                         RECORDS)
+
+    def test_json(self):
+        _, out = report('json')
+        data = json.loads(out.getvalue())
+        self.assertEqual(data['entries'], RECORDS)
+        self.assertEqual(data['summary']['collisions'], 1)
+
+    def test_csv(self):
+        _, out = report('csv')
+        self.assertEqual(out.getvalue().splitlines()[:2], [
+            'action,status,source,target,cleaner',
+            'rename,ok,/m/A.2009.DVDRip,/m/A (2009),regex'])
+        self.assertTrue(out.getvalue().splitlines()[-1].endswith(',,regex'))
+
+    def test_table(self):
+        _, out = report('table')
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'ok         A.2009.DVDRip -> A (2009)')
+        self.assertEqual(lines[3], 'unclean    x.avi -> -')
+        self.assertEqual(lines[-1],
+                         '1 changed, 1 unchanged, 1 collisions, 1 failed')
+
+    def test_written_in_batches(self):
+        _, out = report('jsonl', records=RECORDS * 10, batch_size=16)
+        self.assertEqual(out.writes, 3)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            Report('xml', io.StringIO())
+
+
+if __name__ == '__main__':
+    unittest.main()
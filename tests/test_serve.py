@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+test_serve
+----------------------------------
+
+tests for `antiseptic.serve` module.
+"""
+
+import asyncio
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from antiseptic.cleaner import RegexCleaner
+from antiseptic.serve import CleaningService, Client, start
+
+from .test_cleaner import RULES, write_rules
+
+
+class ClosingCleaner(object):
+    name = 'closing'
+
+    def __init__(self, closed):
+        self.closed = closed
+
+    def close(self):
+        self.closed.append(True)
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.rules_filename = write_rules(self.tmp_dir, RULES)
+        self.socket_filename = os.path.join(self.tmp_dir, 'serve.sock')
+        self.service = CleaningService(
+            self.load_cleaners, rules_filename=self.rules_filename,
+            reload_interval=0)
+
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            self.servers = loop.run_until_complete(start(
+                self.service, path=self.socket_filename, port=0))
+            started.set()
+            loop.run_forever()
+            for server in self.servers:
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        started.wait()
+        self.port = self.servers[1].sockets[0].getsockname()[1]
+
+    def load_cleaners(self):
+        c = RegexCleaner()
+        c.load_rules(self.rules_filename, snapshot=False)
+        return [c]
+
+    def test_clean(self):
+        with Client(self.socket_filename) as client:
+            self.assertEqual(client.clean(['Ed.Wood.XviD.DVD-Rip', 'UP']),
+                             [{'regex': 'Ed Wood!'}, {'regex': 'UP'}])
+            # The connection is reused.
+            self.assertEqual(client.clean(['UP[2009]DvDrip-LW']),
+                             [{'regex': 'UP (2009)'}])
+
+    def test_invalid_request(self):
+        with Client(self.socket_filename) as client:
+            with self.assertRaises(ValueError):
+                client.request({'names': 'not a list'})
+            self.assertEqual(client.clean([]), [])
+
+    def test_reloads_changed_rules(self):
+        with Client(self.socket_filename) as client:
+            self.assertEqual(client.clean(['a.b']), [{'regex': 'a b'}])
+            write_rules(self.tmp_dir, RULES[:1], version='201501020')
+            os.utime(self.rules_filename, ns=(1, 1))
+            response = client.request({'names': ['a.b']})
+        self.assertEqual(response['results'], [{'regex': 'a.b'}])
+        self.assertEqual(response['versions'], {'regex': '201501020'})
+
+    def test_reload_closes_old_cleaners(self):
+        closed = []
+        self.service.cleaners = [ClosingCleaner(closed)]
+        write_rules(self.tmp_dir, RULES[:1], version='201501020')
+        os.utime(self.rules_filename, ns=(1, 1))
+        self.service.maybe_reload()
+        self.assertEqual(closed, [True])
+        self.assertEqual(self.service.versions(), {'regex': '201501020'})
+
+    def test_http(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        self.addCleanup(conn.close)
+        for _ in range(2):
+            conn.request('POST', '/clean', json.dumps(
+                {'id': 1, 'names': ['Ed.Wood.XviD.DVD-Rip']}))
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            data = json.loads(resp.read().decode('utf-8'))
+            self.assertEqual(data['id'], 1)
+            self.assertEqual(data['results'], [{'regex': 'Ed Wood!'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
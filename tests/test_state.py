@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""
+test_state
+----------------------------------
+
+tests for `antiseptic.state` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from antiseptic.state import DECLINED, StateIndex, entry_key
+
+
+class TestStateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.filename = os.path.join(self.tmp_dir, 'state.sqlite')
+        self.movie = os.path.join(self.tmp_dir, 'Up (2009)')
+        os.mkdir(self.movie)
+
+    def key(self):
+        return entry_key(os.lstat(self.movie), 'Up (2009)')
+
+    def test_entries_persist(self):
+        with StateIndex(self.filename, 'regex=1') as state:
+            state.add(self.key())
+        with StateIndex(self.filename, 'regex=1') as state:
+            self.assertIn(self.key(), state)
+
+    def test_changed_entry_is_not_found(self):
+        with StateIndex(self.filename, 'regex=1') as state:
+            state.add(self.key(), DECLINED)
+            open(os.path.join(self.movie, 'Up.srt'), 'w').close()
+            os.utime(self.movie, ns=(0, 0))
+            self.assertNotIn(self.key(), state)
+
+    def test_rules_version_change_invalidates(self):
+        with StateIndex(self.filename, 'regex=1') as state:
+            state.add(self.key())
+        with StateIndex(self.filename, 'regex=2') as state:
+            self.assertNotIn(self.key(), state)
+
+
+if __name__ == '__main__':
+    unittest.main()
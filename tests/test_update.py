@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+test_update
+----------------------------------
+
+tests for `antiseptic.update` module.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from antiseptic.update import (
+    DELTA_IM,
+    apply_delta,
+    check_latest,
+    fetch_rules,
+    install_rules,
+    load_meta,
+)
+
+RULES_V1 = {'version': '201501010', 'rules': [
+    {'id': 'xvid', 'rule': r'(?i)xvid'},
+    {'id': 'dvdrip', 'rule': r'(?i)dvdrip'},
+]}
+RULES_V2 = {'version': '201501020', 'rules': [
+    {'id': 'xvid', 'rule': r'(?i)[\.\s]*xvid'},
+    {'id': 'x264', 'rule': r'(?i)x264'},
+]}
+DELTA_V1_V2 = {
+    'base': '201501010',
+    'version': '201501020',
+    'upsert': [RULES_V2['rules'][0], RULES_V2['rules'][1]],
+    'delete': ['dvdrip'],
+}
+
+
+class RulesHandler(BaseHTTPRequestHandler):
+    """Serves the rules like a static site, plus deltas (RFC 3229)."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers=()):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        if server.failures:
+            server.failures -= 1
+            self.send_error(503)
+        elif self.path == '/latest':
+            self.send_body(200, server.rules['version'])
+        elif self.path == '/rules.json':
+            etag = '"%s"' % server.rules['version']
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            delta = server.deltas.get(self.headers.get('If-None-Match'))
+            if delta is not None and \
+                    DELTA_IM in self.headers.get('A-IM', ''):
+                self.send_body(226, json.dumps(delta),
+                               [('ETag', etag), ('IM', DELTA_IM)])
+            else:
+                self.send_body(200, json.dumps(server.rules),
+                               [('ETag', etag)])
+        else:
+            self.send_error(404)
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.rules_filename = os.path.join(self.tmp_dir, 'rules.json')
+
+        self.server = HTTPServer(('127.0.0.1', 0), RulesHandler)
+        self.server.rules = RULES_V1
+        self.server.deltas = {}
+        self.server.requests = []
+        self.server.failures = 0
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.server_close)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def update(self, **kwargs):
+        data, meta = fetch_rules(self.rules_filename, self.url, **kwargs)
+        if data is not None:
+            install_rules(self.rules_filename, data, meta)
+        return data
+
+    def installed(self):
+        with open(self.rules_filename) as f:
+            return json.load(f)
+
+    def test_first_update_downloads_the_rules(self):
+        self.assertEqual(self.update(), RULES_V1)
+        self.assertEqual(self.installed(), RULES_V1)
+        self.assertEqual(load_meta(self.rules_filename)['etag'],
+                         '"201501010"')
+
+    def test_invalid_server_url(self):
+        with self.assertRaises(SystemExit):
+            fetch_rules(self.rules_filename, 'not-a-url')
+
+    def test_unchanged_rules_are_not_downloaded(self):
+        self.update()
+        self.assertIsNone(self.update())
+        path, headers = self.server.requests[-1]
+        self.assertEqual(headers['If-None-Match'], '"201501010"')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_changed_rules_are_downloaded(self):
+        self.update()
+        self.server.rules = RULES_V2
+        self.assertEqual(self.update(), RULES_V2)
+        self.assertEqual(self.installed(), RULES_V2)
+
+    def test_delta(self):
+        self.update()
+        self.server.rules = RULES_V2
+        self.server.deltas['"201501010"'] = DELTA_V1_V2
+        self.assertEqual(self.update(), RULES_V2)
+        self.assertEqual(self.installed(), RULES_V2)
+        self.assertEqual(load_meta(self.rules_filename)['etag'],
+                         '"201501020"')
+
+    def test_delta_for_another_base_falls_back_to_full_download(self):
+        self.update()
+        self.server.rules = RULES_V2
+        self.server.deltas['"201501010"'] = dict(DELTA_V1_V2, base='1')
+        self.assertEqual(self.update(), RULES_V2)
+        _, headers = self.server.requests[-1]
+        self.assertNotIn('A-IM', headers)
+
+    def test_custom_rules_are_kept(self):
+        custom = {'id': '_mine', 'rule': 'foo'}
+        install_rules(self.rules_filename, dict(
+            RULES_V1, rules=RULES_V1['rules'] + [custom]), {})
+        self.server.rules = RULES_V2
+        self.assertIn(custom, self.update()['rules'])
+
+    def test_retries_server_errors(self):
+        self.server.failures = 1
+        self.assertEqual(self.update(), RULES_V1)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_check_is_cached(self):
+        self.update()
+        self.assertEqual(check_latest(self.rules_filename, self.url),
+                         (True, '201501010'))
+        self.server.rules = RULES_V2
+        self.assertEqual(check_latest(self.rules_filename, self.url),
+                         (True, '201501010'))
+        self.assertEqual(check_latest(self.rules_filename, self.url, ttl=0),
+                         (False, '201501020'))
+
+
+class TestApplyDelta(unittest.TestCase):
+
+    def test_upserts_and_deletes(self):
+        self.assertEqual(apply_delta(RULES_V1, DELTA_V1_V2), RULES_V2)
+
+    def test_wrong_base(self):
+        with self.assertRaises(ValueError):
+            apply_delta(RULES_V2, DELTA_V1_V2)
+
+
+if __name__ == '__main__':
+    unittest.main()
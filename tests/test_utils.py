@@ -7,9 +7,31 @@ test_utils
 tests for `antiseptic.utils` module.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from antiseptic.utils import split_rev
+from antiseptic.utils import (
+    COMPANION_EXTENSIONS,
+    MEDIA_EXTENSIONS,
+    LazyDiff,
+    group_companions,
+    in_shard,
+    list_files,
+    parse_shard,
+    shard_of,
+    split_rev,
+    walk,
+)
+
+
+class TestLazyDiff(unittest.TestCase):
+
+    def test_formats_diff(self):
+        d = LazyDiff('a.b', 'a b')
+        self.assertEqual(str(d), '- a.b\n?  ^\n+ a b\n?  ^\n')
+        self.assertEqual('%s' % d, str(d))
 
 
 class TestSplitRev(unittest.TestCase):
@@ -24,5 +46,115 @@ class TestSplitRev(unittest.TestCase):
             _, _ = split_rev('12345678a')
 
 
+class TestShards(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/3'), (2, 3))
+        for value in ('0/3', '4/3', '3', 'a/b'):
+            with self.assertRaises(ValueError):
+                parse_shard(value)
+
+    def test_shard_of_is_stable(self):
+        self.assertEqual([shard_of(p, 4) for p in ('Up.2009', 'a/b', 'Heat')],
+                         [4, 1, 3])
+
+    def test_shards_partition_the_entries(self):
+        paths = ['/lib/%d/Movie.%d' % (i % 3, i) for i in range(100)]
+        shards = [list(in_shard(paths, '/lib', (k, 3))) for k in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(paths))
+        self.assertTrue(all(shards))
+        # The same library mounted elsewhere is sharded the same way.
+        self.assertEqual(
+            list(in_shard([p.replace('/lib', '/mnt/lib') for p in paths],
+                          '/mnt/lib', (2, 3))),
+            [p.replace('/lib', '/mnt/lib') for p in shards[1]])
+
+
+class TestWalk(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for d in ('Action/2009/Star.Trek.2009.DvDRip-FxM',
+                  'Action/2009/District.9.REPACK.R5.LiNE.XviD-KAMERA',
+                  'Drama/Ed.Wood.XviD.DVD-Rip',
+                  'Drama/.hidden'):
+            os.makedirs(os.path.join(self.root, d))
+        for f in ('Drama/Up.2009.DVDRip.AVI', 'Drama/Up.2009.nfo',
+                  'Gamer.2009.WORKPRiNT.XviD.mkv'):
+            open(os.path.join(self.root, f), 'w').close()
+
+    def names(self, **kwargs):
+        return [os.path.relpath(e.path, self.root)
+                for e in walk(self.root, **kwargs)]
+
+    def test_default_is_top_level_only(self):
+        self.assertEqual(self.names(), ['Action', 'Drama'])
+
+    def test_unlimited_depth_yields_children_first(self):
+        names = self.names(max_depth=None)
+        self.assertEqual(len(names), 7)
+        self.assertLess(names.index('Action/2009'), names.index('Action'))
+        self.assertLess(
+            names.index('Action/2009/Star.Trek.2009.DvDRip-FxM'),
+            names.index('Action/2009'))
+
+    def test_min_depth(self):
+        self.assertEqual(self.names(min_depth=3, max_depth=3), [
+            'Action/2009/District.9.REPACK.R5.LiNE.XviD-KAMERA',
+            'Action/2009/Star.Trek.2009.DvDRip-FxM',
+        ])
+
+    def test_include_and_exclude(self):
+        self.assertEqual(
+            self.names(max_depth=None, include=['*.*'], exclude=['.*']),
+            ['Action/2009/District.9.REPACK.R5.LiNE.XviD-KAMERA',
+             'Action/2009/Star.Trek.2009.DvDRip-FxM',
+             'Drama/Ed.Wood.XviD.DVD-Rip'])
+
+    def test_files_filtered_by_extension(self):
+        files = [os.path.relpath(p, self.root)
+                 for p in list_files(self.root, max_depth=2)]
+        self.assertEqual(files, ['Drama/Up.2009.DVDRip.AVI',
+                                 'Gamer.2009.WORKPRiNT.XviD.mkv'])
+
+
+class TestGroupCompanions(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'Up'))
+        for f in ('Up.2009.avi', 'Up.2009.srt', 'Up.2009.en.srt',
+                  'Up.2009-sample.avi', 'Up.2009-sample.srt',
+                  'Up.2009.Extended.avi', 'Up.2009.Extended.nfo',
+                  'Gamer.mkv', 'Other.nfo', 'Up/Up.2009.nfo', 'Up/a.mkv',
+                  'Zodiac.mkv'):
+            open(os.path.join(self.root, f), 'w').close()
+
+    def groups(self):
+        entries = walk(self.root, files=True, max_depth=None,
+                       extensions=MEDIA_EXTENSIONS | COMPANION_EXTENSIONS)
+        return [(os.path.relpath(e.path, self.root),
+                 sorted(c.name for c in companions))
+                for e, companions in group_companions(entries)]
+
+    def test_groups(self):
+        self.assertEqual(self.groups(), [
+            ('Up/a.mkv', []),
+            ('Gamer.mkv', []),
+            ('Up.2009.Extended.avi', ['Up.2009.Extended.nfo']),
+            ('Up.2009.avi', ['Up.2009-sample.avi', 'Up.2009-sample.srt',
+                             'Up.2009.en.srt', 'Up.2009.srt']),
+            ('Zodiac.mkv', []),
+        ])
+
+    def test_directory_entries_are_consecutive(self):
+        dirs = [os.path.dirname(e.path) for e in walk(
+            self.root, files=True, max_depth=None, extensions={'.mkv'})]
+        self.assertEqual(dirs, [os.path.join(self.root, 'Up'),
+                                self.root, self.root])
+
+
 if __name__ == '__main__':
     unittest.main()
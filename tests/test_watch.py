@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+test_watch
+----------------------------------
+
+tests for `antiseptic.watch` module.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from antiseptic.watch import Debouncer, watch
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDebouncer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.signatures = {}
+        self.debouncer = Debouncer(
+            settle=1, clock=self.clock, signature=self.signatures.get)
+
+    def test_settles_after_quiet_period(self):
+        self.signatures['a'] = (1, 1)
+        self.debouncer.touch('a')
+        self.clock.now = 0.5
+        self.assertEqual(self.debouncer.ready(), [])
+        self.clock.now = 1
+        self.assertEqual(self.debouncer.ready(), ['a'])
+        self.assertEqual(len(self.debouncer), 0)
+
+    def test_still_changing_is_held_back(self):
+        self.signatures['a'] = (1, 1)
+        self.debouncer.touch('a')
+        self.signatures['a'] = (2, 2)
+        self.clock.now = 1
+        self.assertEqual(self.debouncer.ready(), [])
+        self.clock.now = 2
+        self.assertEqual(self.debouncer.ready(), ['a'])
+
+    def test_removed_is_dropped(self):
+        self.signatures['a'] = (1, 1)
+        self.debouncer.touch('a')
+        del self.signatures['a']
+        self.clock.now = 1
+        self.assertEqual(self.debouncer.ready(), [])
+        self.assertEqual(len(self.debouncer), 0)
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def run_watch(self, **kwargs):
+        handled, stop = [], threading.Event()
+        t = threading.Thread(target=watch, args=(self.root, handled.append),
+                             kwargs=dict(settle=0.1, stop=stop, **kwargs))
+        t.start()
+        try:
+            time.sleep(0.2)
+            os.mkdir(os.path.join(self.root, 'Up.2009.DVDRip'))
+            deadline = time.monotonic() + 5
+            while not handled and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            t.join()
+        return handled
+
+    def test_polling(self):
+        self.assertEqual(self.run_watch(poll_interval=0.1),
+                         [os.path.join(self.root, 'Up.2009.DVDRip')])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'requires Linux')
+    def test_inotify(self):
+        self.assertEqual(self.run_watch(),
+                         [os.path.join(self.root, 'Up.2009.DVDRip')])
+
+
+if __name__ == '__main__':
+    unittest.main()